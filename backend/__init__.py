@@ -1,27 +1,32 @@
 # This file makes the backend directory a Python package
 # It also helps with imports when deploying to production
 
+import importlib
+
 # Version information
 __version__ = "3.0.0"
 
-# Make key modules available at the package level
-try:
-    # Use relative imports to avoid issues in different environments
-    from .image_processor import ImageProcessor, VALID_MODES, VALID_SCALE_FACTORS, VALID_OUTPUT_FORMATS, MODE_TO_MODEL
-    from .auth import get_current_active_user, User
-    from .database import DatabaseHandler
-except ImportError as e:
-    # Log the import error but don't crash, as this might be imported during setup
-    import logging
-    logging.warning(f"Error importing backend modules: {e}")
-    
-    # Try absolute imports as a fallback
-    try:
-        import logging
-        logging.warning("Attempting absolute imports as fallback...")
-        from backend.image_processor import ImageProcessor, VALID_MODES, VALID_SCALE_FACTORS, VALID_OUTPUT_FORMATS, MODE_TO_MODEL
-        from backend.auth import get_current_active_user, User
-        from backend.database import DatabaseHandler
-    except ImportError as e2:
-        logging.warning(f"Error with absolute imports: {e2}")
-        # Don't raise an exception here to allow partial imports 
\ No newline at end of file
+# Key names available at the package level, and the submodule defining each.
+# They are imported on first access, so importing one submodule (or the
+# package itself) does not load all the others.
+_EXPORTS = {
+    "ImageProcessor": "image_processor",
+    "VALID_MODES": "image_processor",
+    "VALID_SCALE_FACTORS": "image_processor",
+    "VALID_OUTPUT_FORMATS": "image_processor",
+    "MODE_TO_MODEL": "image_processor",
+    "get_current_active_user": "auth",
+    "User": "auth",
+    "DatabaseHandler": "database",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    module_name = _EXPORTS.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{module_name}", __name__), name)
+    globals()[name] = value
+    return value
@@ -3,22 +3,25 @@ from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Dict, Tuple
+from collections import OrderedDict
 import os
+import time
+import hashlib
 from dotenv import load_dotenv
 from pydantic import BaseModel
 import logging
 import base64
 import json
 
+try:
+    from . import metrics
+except ImportError:
+    from backend import metrics
+
 # Load environment variables
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-)
 logger = logging.getLogger(__name__)
 
 # Configuration
@@ -27,6 +30,9 @@ ALGORITHM = os.getenv("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
 SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
+# Verified tokens are cached until they expire, but never longer than this
+AUTH_TOKEN_CACHE_TTL_SECONDS = int(os.getenv("AUTH_TOKEN_CACHE_TTL_SECONDS", "300"))
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "10000"))
 
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -51,6 +57,75 @@ class User(BaseModel):
 class UserInDB(User):
     hashed_password: str
 
+# Credential records are built once. Hashing a password is a full bcrypt
+# round, so it must never happen on the request path.
+fake_users_db = {
+    "johndoe": {
+        "username": "johndoe",
+        "full_name": "John Doe",
+        "email": "johndoe@example.com",
+        # bcrypt hash of "secret"
+        "hashed_password": "$2b$12$BHu43/wPQo7HRc9/x0yIbudaT941SzXTbdcY.Z71vM3OGcrzuui3K",
+        "disabled": False,
+        "subscription_tier": "free",
+        "images_processed_this_month": 0
+    }
+}
+_users_in_db: Dict[str, UserInDB] = {
+    username: UserInDB(**user_dict) for username, user_dict in fake_users_db.items()
+}
+
+class TokenCache:
+    """
+    Bounded LRU cache from a token's SHA-256 to the user it was verified
+    for. Entries expire at the token's exp claim.
+    """
+    
+    def __init__(self, max_size: int = AUTH_TOKEN_CACHE_SIZE, ttl_seconds: int = AUTH_TOKEN_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[float, User]]" = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+    
+    @staticmethod
+    def _key(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+    
+    def get(self, token: str) -> Optional[User]:
+        key = self._key(token)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.time():
+            if entry is not None:
+                del self._entries[key]
+            self._stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self._stats["hits"] += 1
+        # Callers get their own copy so one request cannot change another's user
+        return entry[1].model_copy()
+    
+    def put(self, token: str, user: User, expires_at: Optional[float]) -> None:
+        expires = time.time() + self.ttl_seconds
+        if expires_at is not None:
+            expires = min(expires, float(expires_at))
+        if expires <= time.time() or self.max_size <= 0:
+            return
+        key = self._key(token)
+        self._entries[key] = (expires, user.model_copy())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+    
+    def clear(self) -> None:
+        self._entries.clear()
+    
+    def stats(self) -> Dict[str, int]:
+        return {**self._stats, "entries": len(self._entries)}
+
+token_cache = TokenCache()
+metrics.register_collector("auth_token_cache", token_cache.stats)
+
 # Helper functions
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -99,10 +174,15 @@ def decode_supabase_jwt(token: str):
 async def get_current_user(token: Optional[str] = Depends(oauth2_scheme)):
     if token is None:
         # Allow anonymous access for endpoints that don't require authentication
-        logger.warning("No token provided in request")
+        logger.debug("No token provided in request")
         return None
     
-    logger.info(f"Validating token: {token[:10]}...")
+    # Tokens seen before are answered without decoding them again
+    user = token_cache.get(token)
+    if user is not None:
+        return user
+    
+    logger.debug("Validating token: %.10s...", token)
     
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -113,36 +193,33 @@ async def get_current_user(token: Optional[str] = Depends(oauth2_scheme)):
     try:
         # First try to decode with our own secret key
         try:
-            logger.info("Attempting to decode token with app secret key")
             payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
             username: str = payload.get("sub")
             if username is None:
                 logger.warning("Token missing 'sub' claim")
                 raise credentials_exception
             token_data = TokenData(username=username)
-            logger.info(f"Successfully decoded token for user: {username}")
+            logger.debug("Successfully decoded token for user: %s", username)
             
             # Get user from database using our own token
-            logger.info(f"Getting user from database: {token_data.username}")
             user = await get_user_from_db(token_data.username)
             if user is None:
-                logger.warning(f"User not found in database: {token_data.username}")
+                logger.warning("User not found in database: %s", token_data.username)
                 raise credentials_exception
+            token_cache.put(token, user, payload.get("exp"))
             return user
             
         except JWTError as e:
-            logger.warning(f"Failed to decode with app secret: {str(e)}")
+            logger.debug("Failed to decode with app secret: %s", e)
             
             # If that fails, try with Supabase JWT
             # First, let's decode the token without verification to see what we're dealing with
             decoded_payload = decode_supabase_jwt(token)
             if decoded_payload:
-                logger.info(f"Decoded token payload (unverified): {decoded_payload}")
+                logger.debug("Decoded token payload (unverified): %s", decoded_payload)
                 
                 # Check if this looks like a Supabase token
                 if 'aud' in decoded_payload and decoded_payload.get('aud') == 'authenticated':
-                    logger.info("Token appears to be a Supabase token")
-                    
                     # Extract user info from decoded payload
                     user_id = decoded_payload.get("sub")
                     email = decoded_payload.get("email")
@@ -151,12 +228,19 @@ async def get_current_user(token: Optional[str] = Depends(oauth2_scheme)):
                         logger.warning("Supabase token missing 'sub' claim")
                         raise credentials_exception
                     
+                    # Expired tokens are rejected here too, so they are never cached
+                    exp = decoded_payload.get("exp")
+                    if isinstance(exp, (int, float)) and exp <= time.time():
+                        logger.warning("Supabase token for user %s has expired", user_id)
+                        raise credentials_exception
+                    
                     # For Supabase tokens, we'll accept them without cryptographic verification
                     # This is a temporary solution - in production, you should verify the token
-                    logger.info(f"Accepting Supabase token for user: {user_id}")
+                    logger.debug("Accepting Supabase token for user: %s", user_id)
                     
                     # Get or create user in our database
                     user = await get_or_create_user_from_supabase(user_id, email)
+                    token_cache.put(token, user, exp if isinstance(exp, (int, float)) else None)
                     return user
                 else:
                     logger.warning("Token does not appear to be a Supabase token")
@@ -164,6 +248,8 @@ async def get_current_user(token: Optional[str] = Depends(oauth2_scheme)):
             else:
                 logger.error("Failed to decode token payload")
                 raise credentials_exception
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Unexpected error in authentication: {str(e)}")
         raise credentials_exception
@@ -184,26 +270,15 @@ async def get_current_active_user(current_user: Optional[User] = Depends(get_cur
 async def get_user_from_db(username: str):
     # TODO: Implement Supabase integration
     # This is a placeholder for the actual implementation
-    fake_users_db = {
-        "johndoe": {
-            "username": "johndoe",
-            "full_name": "John Doe",
-            "email": "johndoe@example.com",
-            "hashed_password": get_password_hash("secret"),
-            "disabled": False,
-            "subscription_tier": "free",
-            "images_processed_this_month": 0
-        }
-    }
-    if username in fake_users_db:
-        user_dict = fake_users_db[username]
-        return UserInDB(**user_dict)
+    user = _users_in_db.get(username)
+    if user is not None:
+        return user.model_copy()
     return None
 
 async def get_or_create_user_from_supabase(user_id: str, email: Optional[str] = None):
     # TODO: Implement actual database integration
     # For now, create a simple user object
-    logger.info(f"Creating user object for Supabase user: {user_id}")
+    logger.debug("Creating user object for Supabase user: %s", user_id)
     return User(
         username=user_id,
         email=email,
@@ -0,0 +1,374 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import posixpath
+import zipfile
+from io import BytesIO
+from typing import Optional, List, Dict, Any, Callable, Awaitable, AsyncIterator, BinaryIO
+from dotenv import load_dotenv
+from fastapi import UploadFile, HTTPException
+
+try:
+    from .upload import ingest_upload, MAX_UPLOAD_BYTES
+    from .jobs import job_manager, QueueFullError
+    from .results import UpscaleResult, RESPONSE_CHUNK_SIZE
+    from . import metrics
+except ImportError:
+    from backend.upload import ingest_upload, MAX_UPLOAD_BYTES
+    from backend.jobs import job_manager, QueueFullError
+    from backend.results import UpscaleResult, RESPONSE_CHUNK_SIZE
+    from backend import metrics
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "500"))
+# Images of one batch that are processed or waiting to be written at once
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+# How long an item waits for room in a full job queue before it fails
+BATCH_QUEUE_WAIT_SECONDS = float(os.getenv("BATCH_QUEUE_WAIT_SECONDS", "60"))
+
+MANIFEST_NAME = "manifest.json"
+
+# Called with the item and its result once an item succeeds
+ItemHook = Callable[["BatchItem", UpscaleResult], Awaitable[None]]
+
+
+class ZipStream:
+    """
+    Builds a ZIP archive incrementally. Written bytes are buffered only
+    until the next drain(), so the archive is never held in memory.
+
+    The sink is not seekable, so zipfile writes each entry's sizes in a
+    data descriptor after its data. Images are stored without compression.
+    """
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        # Bytes duplicated while buffering, for the copy counters
+        self.copied = 0
+        self._zip = zipfile.ZipFile(self, "w", zipfile.ZIP_STORED, allowZip64=True)
+
+    def write(self, data) -> int:
+        if not isinstance(data, bytes):
+            data = bytes(data)
+            self.copied += len(data)
+        self._chunks.append(data)
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        """
+        Returns and forgets the bytes written since the last drain.
+        """
+        data = b"".join(self._chunks)
+        if len(self._chunks) > 1:
+            self.copied += len(data)
+        self._chunks = []
+        return data
+
+    def open_entry(self, name: str, size: int) -> BinaryIO:
+        """
+        Starts a new entry of the given size and returns a file to write it to.
+        """
+        info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_STORED
+        return self._zip.open(info, "w", force_zip64=size >= zipfile.ZIP64_LIMIT)
+
+    def write_entry(self, name: str, data: bytes) -> None:
+        with self.open_entry(name, len(data)) as entry:
+            entry.write(data)
+
+    def close(self) -> None:
+        self._zip.close()
+
+
+def take_file(upload: UploadFile) -> BinaryIO:
+    """
+    Takes ownership of an upload's spooled file. FastAPI closes form files
+    before a streamed response is sent, so a batch that reads its inputs
+    while streaming must detach them first.
+
+    Args:
+        upload: The uploaded file
+
+    Returns:
+        BinaryIO: The file, which the caller must close
+    """
+    file = upload.file
+    upload.file = BytesIO()
+    return file
+
+
+class BatchItem:
+    """
+    One image of a batch and its outcome.
+    """
+
+    def __init__(self, index: int, filename: str, opener: Callable[[], Awaitable[UploadFile]]):
+        self.index = index
+        self.filename = filename
+        self.opener = opener
+        self.output_name: Optional[str] = None
+        self.status = "pending"
+        self.error: Optional[str] = None
+        self.size: Optional[int] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "index": self.index,
+            "filename": self.filename,
+            "status": self.status,
+            "output": self.output_name,
+            "size": self.size,
+            "error": self.error,
+        }
+
+
+def _clean_name(name: str) -> str:
+    # Keep the folder layout of archives but never escape the archive root
+    parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".", "..")]
+    return "/".join(parts) or "image"
+
+
+def _entry_too_large() -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=f"Upload too large. The maximum size is {MAX_UPLOAD_BYTES // (1024 * 1024)} MB."
+    )
+
+
+def _is_archive_image(info: zipfile.ZipInfo) -> bool:
+    if info.is_dir():
+        return False
+    name = info.filename.replace("\\", "/")
+    return not (name.startswith("__MACOSX/") or posixpath.basename(name).startswith("."))
+
+
+class Batch:
+    """
+    Upscales many images on the shared job pool, at most `concurrency` at a
+    time, and streams the results back as a ZIP with a per-item manifest.
+    """
+
+    def __init__(
+        self,
+        owner: Optional[str],
+        params: Dict[str, Any],
+        on_success: Optional[ItemHook] = None,
+        concurrency: int = BATCH_CONCURRENCY
+    ):
+        self.owner = owner
+        self.params = params
+        self.on_success = on_success
+        self.concurrency = max(1, concurrency)
+        self.items: List[BatchItem] = []
+        self.succeeded = 0
+        self.failed = 0
+        self._files: List[BinaryIO] = []
+        self._archives: List[zipfile.ZipFile] = []
+
+    def add_file(self, upload: UploadFile) -> None:
+        """
+        Adds an uploaded image to the batch.
+        """
+        file = take_file(upload)
+        self._files.append(file)
+        filename = upload.filename or f"image_{len(self.items) + 1}"
+        headers = upload.headers
+
+        async def opener() -> UploadFile:
+            return UploadFile(file=file, filename=filename, headers=headers)
+
+        self.items.append(BatchItem(len(self.items), filename, opener))
+
+    def add_archive(self, upload: UploadFile) -> None:
+        """
+        Adds every image in an uploaded ZIP archive to the batch. Entries are
+        read one at a time as they are processed.
+
+        Raises:
+            HTTPException: 400 if the upload is not a ZIP archive
+        """
+        file = take_file(upload)
+        self._files.append(file)
+        try:
+            archive = zipfile.ZipFile(file)
+        except zipfile.BadZipFile:
+            raise HTTPException(status_code=400, detail=f"{upload.filename} is not a valid ZIP archive")
+        self._archives.append(archive)
+
+        for info in archive.infolist():
+            if not _is_archive_image(info):
+                continue
+
+            def read_entry(info: zipfile.ZipInfo = info) -> bytes:
+                # Never trust the declared size; stop reading past the limit
+                with archive.open(info) as entry:
+                    data = entry.read(MAX_UPLOAD_BYTES + 1)
+                if len(data) > MAX_UPLOAD_BYTES:
+                    raise _entry_too_large()
+                return data
+
+            async def opener(info: zipfile.ZipInfo = info, read_entry=read_entry) -> UploadFile:
+                if info.file_size > MAX_UPLOAD_BYTES:
+                    raise _entry_too_large()
+                loop = asyncio.get_running_loop()
+                data = await loop.run_in_executor(None, read_entry)
+                return UploadFile(file=BytesIO(data), filename=info.filename)
+
+            self.items.append(BatchItem(len(self.items), info.filename, opener))
+
+    def close(self) -> None:
+        """
+        Closes the batch's input files.
+        """
+        for archive in self._archives:
+            archive.close()
+        for file in self._files:
+            file.close()
+        self._archives = []
+        self._files = []
+
+    def _output_name(self, item: BatchItem, taken: set) -> str:
+        output_format = self.params.get("output_format", "png").lower()
+        stem = posixpath.splitext(_clean_name(item.filename))[0]
+        name = f"{stem}.{output_format}"
+        if name in taken or name == MANIFEST_NAME:
+            name = f"{stem}_{item.index + 1}.{output_format}"
+        taken.add(name)
+        return name
+
+    async def _upscale(self, item: BatchItem) -> UpscaleResult:
+        upload = await item.opener()
+        try:
+            ingested = await ingest_upload(upload)
+            contents = await ingested.read()
+        finally:
+            # Each input is read once; free its spool file right away
+            upload.file.close()
+
+        params = {**self.params, "content_hash": ingested.sha256}
+        deadline = time.monotonic() + BATCH_QUEUE_WAIT_SECONDS
+        while True:
+            try:
+                result, error = await job_manager.run(self.owner, contents, params)
+                break
+            except QueueFullError:
+                # Other requests have filled the shared queue; wait for room
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.5)
+
+        if error:
+            raise ValueError(error)
+        if result is None or result.size == 0:
+            if result is not None:
+                result.close()
+            raise ValueError("The AI service returned an empty result.")
+        return result
+
+    async def _run_item(self, item: BatchItem, slots: asyncio.Semaphore, done: asyncio.Queue) -> None:
+        # The slot is released by stream() once the result has been written
+        await slots.acquire()
+        result = None
+        try:
+            result = await self._upscale(item)
+            if self.on_success is not None:
+                try:
+                    await self.on_success(item, result)
+                except Exception as e:
+                    # The image was processed; it is still returned
+                    logger.error(f"Error in completion hook for batch item {item.filename}: {str(e)}")
+        except asyncio.CancelledError:
+            if result is not None:
+                result.close()
+            slots.release()
+            raise
+        except HTTPException as e:
+            item.error = str(e.detail)
+        except QueueFullError:
+            item.error = "The server is busy. Please try again shortly."
+        except Exception as e:
+            logger.error(f"Error processing batch item {item.filename}: {str(e)}")
+            item.error = f"Error processing image: {str(e)}"
+        await done.put((item, result))
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        """
+        Processes the batch and yields the ZIP archive as it is built.
+        Results are added in the order they finish, then the manifest.
+
+        Yields:
+            bytes: The next part of the archive
+        """
+        zip_stream = ZipStream()
+        slots = asyncio.Semaphore(self.concurrency)
+        done: asyncio.Queue = asyncio.Queue()
+        tasks = [asyncio.create_task(self._run_item(item, slots, done)) for item in self.items]
+        taken = set()
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        try:
+            for _ in range(len(tasks)):
+                item, result = await done.get()
+                if result is None:
+                    item.status = "failed"
+                    self.failed += 1
+                    slots.release()
+                    continue
+
+                try:
+                    item.output_name = self._output_name(item, taken)
+                    copied = zip_stream.copied
+                    with zip_stream.open_entry(item.output_name, result.size) as entry, result.open() as f:
+                        while True:
+                            if result.on_disk:
+                                chunk = await loop.run_in_executor(None, f.read, RESPONSE_CHUNK_SIZE)
+                            else:
+                                chunk = f.read(RESPONSE_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            entry.write(chunk)
+                            data = zip_stream.drain()
+                            if data:
+                                yield data
+                    item.status = "succeeded"
+                    item.size = result.size
+                    self.succeeded += 1
+                    # Every chunk read from the result is a new buffer
+                    metrics.count_bytes("batch_output", result.size, copied=result.size + zip_stream.copied - copied)
+                finally:
+                    result.close()
+                    slots.release()
+
+            manifest = {
+                "succeeded": self.succeeded,
+                "failed": self.failed,
+                "params": {k: v for k, v in self.params.items() if k != "content_hash"},
+                "items": [item.to_dict() for item in self.items],
+            }
+            zip_stream.write_entry(MANIFEST_NAME, json.dumps(manifest, indent=2).encode("utf-8"))
+            zip_stream.close()
+            yield zip_stream.drain()
+            logger.info(
+                f"Batch of {len(self.items)} finished in {time.monotonic() - started:.1f}s "
+                f"({self.succeeded} succeeded, {self.failed} failed)"
+            )
+        finally:
+            # The client went away or we are done; stop any remaining work
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            while not done.empty():
+                _, result = done.get_nowait()
+                if result is not None:
+                    result.close()
+            self.close()
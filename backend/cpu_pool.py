@@ -0,0 +1,168 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Optional, Dict, Any, Callable, TypeVar
+from dotenv import load_dotenv
+
+try:
+    from . import metrics
+except ImportError:
+    from backend import metrics
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+# Threads for CPU-bound image stages (decode, verify, resize, encode);
+# 0 means one per CPU core. PIL releases the GIL while it works, so the
+# threads run in parallel.
+CPU_POOL_WORKERS = int(os.getenv("CPU_POOL_WORKERS", "0")) or (os.cpu_count() or 1)
+# Stages allowed to wait for a thread; callers beyond this wait before submitting
+CPU_POOL_MAX_QUEUE = int(os.getenv("CPU_POOL_MAX_QUEUE", "16"))
+
+T = TypeVar("T")
+
+
+class CPUPool:
+    """
+    A dedicated thread pool for CPU-bound image stages, so they neither run
+    on the event loop nor compete with blocking I/O in the default executor.
+
+    At most workers + max_queue stages are submitted at once. Further
+    callers wait for a slot, which holds up the job workers and so pushes
+    back on the job queue, where new requests are rejected with 503. A
+    caller that is cancelled (for example because its client disconnected)
+    drops its stage if it has not started; a stage that already started
+    runs to completion and its result is discarded.
+    """
+
+    def __init__(self, workers: int = CPU_POOL_WORKERS, max_queue: int = CPU_POOL_MAX_QUEUE):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._queued = 0
+        self._running = 0
+        self._stats = {"submitted": 0, "completed": 0, "failed": 0, "cancelled": 0}
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # Created on first use, so preloaded apps start it after the fork
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="cpu")
+        return self._executor
+
+    def _call(self, stage: str, submitted: float, fn: Callable[..., T], args: tuple) -> T:
+        started = time.perf_counter()
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+        metrics.observe("cpu_wait", started - submitted)
+        try:
+            with metrics.timed(f"cpu_{stage}"):
+                return fn(*args)
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    async def run(
+        self,
+        stage: str,
+        fn: Callable[..., T],
+        *args: Any,
+        on_discard: Optional[Callable[[T], None]] = None
+    ) -> T:
+        """
+        Runs a CPU-bound function on the pool.
+
+        Args:
+            stage: The stage name used in the metrics
+            fn: The function
+            *args: Its arguments
+            on_discard: Called with the result if the caller was cancelled
+                while the function ran, to release what it holds
+
+        Returns:
+            The function's return value
+        """
+        loop = asyncio.get_running_loop()
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers + self.max_queue)
+
+        submitted = time.perf_counter()
+        self._waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= 1
+
+        with self._lock:
+            self._queued += 1
+        self._stats["submitted"] += 1
+        try:
+            future = self._get_executor().submit(self._call, stage, submitted, fn, args)
+        except BaseException:
+            with self._lock:
+                self._queued -= 1
+            self._slots.release()
+            raise
+
+        def done(future: Future) -> None:
+            # The slot is held until the thread is free again, even if the
+            # caller stopped waiting earlier
+            if future.cancelled():
+                with self._lock:
+                    self._queued -= 1
+            try:
+                loop.call_soon_threadsafe(self._slots.release)
+            except RuntimeError:
+                # The event loop has been closed
+                pass
+
+        future.add_done_callback(done)
+        try:
+            result = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            if future.cancel():
+                self._stats["cancelled"] += 1
+            elif on_discard is not None:
+                future.add_done_callback(
+                    lambda future: on_discard(future.result()) if future.exception() is None else None
+                )
+            raise
+        except Exception:
+            self._stats["failed"] += 1
+            raise
+        self._stats["completed"] += 1
+        return result
+
+    def shutdown(self) -> None:
+        """
+        Stops the pool, dropping stages that have not started.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            queued, running = self._queued, self._running
+        return {
+            **self._stats,
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "waiting": self._waiting,
+            "queued": queued,
+            "running": running,
+        }
+
+
+# Shared CPU pool
+cpu_pool = CPUPool()
+metrics.register_collector("cpu_pool", cpu_pool.stats)
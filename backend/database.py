@@ -1,27 +1,360 @@
 import os
+import time
+import asyncio
 import logging
 import json
-from typing import Optional, Dict, Any, List
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, List, Callable, Union, BinaryIO
 from dotenv import load_dotenv
-from supabase import create_client, Client
-from datetime import datetime, timedelta
+from datetime import datetime, timezone
+
+try:
+    from . import metrics
+except ImportError:
+    from backend import metrics
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-)
 logger = logging.getLogger(__name__)
 
 # Supabase configuration
 SUPABASE_URL = os.getenv("SUPABASE_URL", "your-supabase-url")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY", "your-supabase-key")
+# Threads available for Supabase calls, shared by all requests on this worker
+DB_MAX_WORKERS = int(os.getenv("DB_MAX_WORKERS", "10"))
+DB_TIMEOUT_SECONDS = float(os.getenv("DB_TIMEOUT_SECONDS", "10"))
+STORAGE_TIMEOUT_SECONDS = float(os.getenv("STORAGE_TIMEOUT_SECONDS", "30"))
+# Usage increments are combined in memory and written this often
+USAGE_FLUSH_INTERVAL_SECONDS = float(os.getenv("USAGE_FLUSH_INTERVAL_SECONDS", "5"))
+# Flushes a user's increment may fail before it is dropped
+USAGE_FLUSH_MAX_ATTEMPTS = int(os.getenv("USAGE_FLUSH_MAX_ATTEMPTS", "12"))
+
+# Stored images live under one folder per UTC hour, so expired images can be
+# found by folder name instead of by listing the whole bucket
+IMAGE_PARTITION_FORMAT = "%Y%m%d%H"
+
+# The Supabase client is created on first use, on a database pool thread.
+# Its PostgREST and storage clients are then reused and keep their HTTP
+# connections alive between calls.
+_client: Optional[Any] = None
+_client_lock = threading.Lock()
+
+# The supabase client is synchronous, so every call runs on this bounded
+# pool instead of blocking the event loop
+_executor = ThreadPoolExecutor(max_workers=DB_MAX_WORKERS, thread_name_prefix="supabase")
+
+_stats_lock = threading.Lock()
+_stats: Dict[str, Dict[str, float]] = {}
+
+
+def get_client() -> Any:
+    """
+    Returns the shared Supabase client, creating it on first use.
+
+    Importing supabase and building the client takes a noticeable part of
+    startup, so it happens when a worker first needs it (or warms up),
+    never at import time.
+
+    Returns:
+        supabase.Client: The shared client
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from supabase import create_client
+                from supabase.lib.client_options import ClientOptions
+
+                _client = create_client(
+                    SUPABASE_URL,
+                    SUPABASE_KEY,
+                    options=ClientOptions(
+                        postgrest_client_timeout=DB_TIMEOUT_SECONDS,
+                        storage_client_timeout=STORAGE_TIMEOUT_SECONDS,
+                    )
+                )
+    return _client
+
+
+def _record(operation: str, seconds: float, outcome: str) -> None:
+    with _stats_lock:
+        entry = _stats.setdefault(
+            operation,
+            {"calls": 0, "errors": 0, "timeouts": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+        )
+        entry["calls"] += 1
+        entry["total_seconds"] += seconds
+        entry["max_seconds"] = max(entry["max_seconds"], seconds)
+        if outcome != "ok":
+            entry[outcome] += 1
+
+
+async def _run(operation: str, call: Callable[[], Any], timeout: float = DB_TIMEOUT_SECONDS) -> Any:
+    """
+    Runs a blocking Supabase call on the database pool and records its latency.
+
+    Args:
+        operation: The operation name used in the statistics
+        call: The blocking call
+        timeout: Seconds to wait, including time spent queued for a thread
+
+    Returns:
+        Any: The call's return value
+
+    Raises:
+        TimeoutError: If the call does not finish in time
+    """
+    loop = asyncio.get_running_loop()
+    started = time.monotonic()
+    outcome = "ok"
+    try:
+        return await asyncio.wait_for(loop.run_in_executor(_executor, call), timeout)
+    except asyncio.TimeoutError:
+        outcome = "timeouts"
+        raise TimeoutError(f"Supabase {operation} timed out after {timeout}s")
+    except Exception:
+        outcome = "errors"
+        raise
+    finally:
+        _record(operation, time.monotonic() - started, outcome)
+
+
+def stats() -> Dict[str, Any]:
+    """
+    Returns per-operation call counts and latencies, and the pool backlog.
+
+    Returns:
+        Dict[str, Any]: The database statistics
+    """
+    with _stats_lock:
+        operations = {
+            operation: {
+                "calls": entry["calls"],
+                "errors": entry["errors"],
+                "timeouts": entry["timeouts"],
+                "avg_ms": round(entry["total_seconds"] / entry["calls"] * 1000, 2) if entry["calls"] else 0.0,
+                "max_ms": round(entry["max_seconds"] * 1000, 2),
+            }
+            for operation, entry in _stats.items()
+        }
+    return {
+        "max_workers": DB_MAX_WORKERS,
+        "queued": _executor._work_queue.qsize(),
+        "operations": operations,
+    }
+
+
+async def warm_up() -> None:
+    """
+    Creates the Supabase client on the database pool, so that the first
+    request does not wait for it.
+    """
+    await _run("client_init", get_client)
+
+
+def shutdown_executor() -> None:
+    """
+    Stops the database pool, dropping calls that have not started.
+    """
+    _executor.shutdown(wait=False, cancel_futures=True)
+
+
+metrics.register_collector("database", stats)
+
+
+def image_partition(when: datetime) -> str:
+    """
+    Returns the storage folder for images stored at the given time.
+
+    Args:
+        when: A timezone-aware time
+
+    Returns:
+        str: The UTC hour folder, e.g. 2024061513
+    """
+    return when.astimezone(timezone.utc).strftime(IMAGE_PARTITION_FORMAT)
+
+
+def is_user_id(value: str) -> bool:
+    """
+    Checks whether a value can be a row ID of the users table. Users of
+    the app's own tokens (such as the demo user) have no such row.
+
+    Args:
+        value: The user ID
+
+    Returns:
+        bool: True if the value is a UUID
+    """
+    try:
+        uuid.UUID(str(value))
+        return True
+    except ValueError:
+        return False
+
+
+class UsageAggregator:
+    """
+    Write-behind buffer for processed image counts. Increments are summed
+    per user in memory and written with one atomic RPC per flush, so
+    recording usage makes no database calls.
+    """
+
+    def __init__(self, interval: float = USAGE_FLUSH_INTERVAL_SECONDS):
+        self.interval = interval
+        self._pending: Dict[str, int] = {}
+        self._in_flight: Dict[str, int] = {}
+        # Failed flushes per user since its last successful write
+        self._attempts: Dict[str, int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self._stats = {
+            "increments": 0,
+            "flushes": 0,
+            "flushed_users": 0,
+            "flush_errors": 0,
+            "skipped_users": 0,
+            "dropped_users": 0,
+        }
+
+    def add(self, user_id: str, amount: int = 1) -> None:
+        """
+        Records processed images for a user.
+
+        Args:
+            user_id: The user ID
+            amount: The number of images
+        """
+        self._pending[user_id] = self._pending.get(user_id, 0) + amount
+        self._stats["increments"] += 1
+
+    def pending(self, user_id: str) -> int:
+        """
+        Returns the images recorded for a user that are not in the database yet.
+        """
+        return self._pending.get(user_id, 0) + self._in_flight.get(user_id, 0)
+
+    @staticmethod
+    async def _write(increments: List[Dict[str, Any]]) -> None:
+        await _run(
+            "increment_processed_images",
+            lambda: get_client().rpc("increment_processed_images", {"increments": increments}).execute()
+        )
+
+    def _requeue(self, user_id: str, amount: int, failed: bool = True) -> None:
+        if not failed:
+            self._pending[user_id] = self._pending.get(user_id, 0) + amount
+            return
+        attempts = self._attempts.get(user_id, 0) + 1
+        if attempts >= USAGE_FLUSH_MAX_ATTEMPTS:
+            logger.error(f"Dropping {amount} unflushed images for user {user_id} after {attempts} failed flushes")
+            self._attempts.pop(user_id, None)
+            self._stats["dropped_users"] += 1
+            return
+        self._attempts[user_id] = attempts
+        self._pending[user_id] = self._pending.get(user_id, 0) + amount
+
+    async def flush(self) -> int:
+        """
+        Writes the pending increments in one RPC. If it fails, each user is
+        written on its own, so that one bad row cannot hold back everyone
+        else's usage. Failed increments are kept and retried on the next
+        flush, up to USAGE_FLUSH_MAX_ATTEMPTS times.
+
+        Returns:
+            int: The number of users written
+        """
+        if not self._pending or self._in_flight:
+            return 0
+        self._in_flight, self._pending = self._pending, {}
+        try:
+            increments = []
+            for user_id, amount in self._in_flight.items():
+                if is_user_id(user_id):
+                    increments.append({"user_id": user_id, "amount": amount})
+                else:
+                    # No users row to count against
+                    self._stats["skipped_users"] += 1
+            if not increments:
+                return 0
+            # Users whose writes failed before are retried last
+            increments.sort(key=lambda increment: self._attempts.get(increment["user_id"], 0))
+
+            try:
+                await self._write(increments)
+                written = increments
+            except Exception as e:
+                logger.error(f"Error flushing usage for {len(increments)} users: {str(e)}")
+                self._stats["flush_errors"] += 1
+                written = []
+                for index, increment in enumerate(increments):
+                    try:
+                        await self._write([increment])
+                        written.append(increment)
+                    except Exception as e:
+                        logger.error(f"Error flushing usage for user {increment['user_id']}: {str(e)}")
+                        self._requeue(increment["user_id"], increment["amount"])
+                        if not written:
+                            # Nothing gets through; the database is likely
+                            # unreachable, so the rest wait for the next flush
+                            # without counting a failure
+                            for rest in increments[index + 1:]:
+                                self._requeue(rest["user_id"], rest["amount"], failed=False)
+                            break
+
+            for increment in written:
+                self._attempts.pop(increment["user_id"], None)
+            if written:
+                self._stats["flushes"] += 1
+                self._stats["flushed_users"] += len(written)
+            return len(written)
+        finally:
+            self._in_flight = {}
+
+    async def _flusher(self) -> None:
+        # Never cancelled mid-write: a cancelled RPC still runs on its thread
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def start(self) -> None:
+        """
+        Starts flushing on the configured interval.
+        """
+        if self._task is None:
+            self._stopping = asyncio.Event()
+            self._task = asyncio.create_task(self._flusher())
+
+    async def stop(self) -> None:
+        """
+        Stops the interval flush and writes whatever is still pending.
+        """
+        if self._task is not None:
+            self._stopping.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        if self._pending:
+            logger.error(f"Dropping unflushed usage for {len(self._pending)} users at shutdown")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._stats,
+            "pending_users": len(self._pending),
+            "pending_images": sum(self._pending.values()),
+        }
+
+
+usage_aggregator = UsageAggregator()
+metrics.register_collector("usage", usage_aggregator.stats)
+
 
-# Initialize Supabase client
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 class DatabaseHandler:
     """
     Handles Supabase database and storage operations.
@@ -39,16 +372,65 @@ class DatabaseHandler:
             Optional[Dict[str, Any]]: The user data
         """
         try:
-            response = supabase.table("users").select("*").eq("id", user_id).execute()
+            response = await _run("get_user", lambda: get_client().table("users").select("*").eq("id", user_id).execute())
             
             if response.data and len(response.data) > 0:
-                return response.data[0]
+                user = response.data[0]
+                # Include usage that has not been written yet
+                pending = usage_aggregator.pending(user_id)
+                if pending:
+                    user["images_processed_this_month"] = (user.get("images_processed_this_month") or 0) + pending
+                return user
             else:
                 return None
         except Exception as e:
             logger.error(f"Error getting user: {str(e)}")
             return None
     
+    @staticmethod
+    async def get_usage_counts(user_ids: List[str]) -> Optional[Dict[str, Dict[str, Any]]]:
+        """
+        Gets the plan and monthly image count of many users in one query.
+
+        Args:
+            user_ids: The user IDs
+
+        Returns:
+            Optional[Dict[str, Dict[str, Any]]]: subscription_tier and
+            images_processed_this_month by user ID, including usage that was
+            not written yet when the query started; users that do not exist
+            are left out
+        """
+        # IDs that cannot be in the table would fail the whole query
+        user_ids = [user_id for user_id in user_ids if is_user_id(user_id)]
+        if not user_ids:
+            return {}
+        try:
+            # Taken before the query: a flush finishing while it runs would
+            # otherwise drop usage from both the pending count and the read.
+            # A flush that lands before the read is counted twice until the
+            # next read, which errs on the side of the limit.
+            pending = {user_id: usage_aggregator.pending(user_id) for user_id in user_ids}
+            response = await _run(
+                "get_usage_counts",
+                lambda: get_client().table("users")
+                .select("id, subscription_tier, images_processed_this_month")
+                .in_("id", user_ids)
+                .execute()
+            )
+
+            counts = {}
+            for row in response.data or []:
+                user_id = str(row["id"])
+                row["images_processed_this_month"] = (
+                    (row.get("images_processed_this_month") or 0) + pending.get(user_id, 0)
+                )
+                counts[user_id] = row
+            return counts
+        except Exception as e:
+            logger.error(f"Error getting usage counts for {len(user_ids)} users: {str(e)}")
+            return None
+
     @staticmethod
     async def create_user(user_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """
@@ -61,7 +443,7 @@ class DatabaseHandler:
             Optional[Dict[str, Any]]: The created user data
         """
         try:
-            response = supabase.table("users").insert(user_data).execute()
+            response = await _run("create_user", lambda: get_client().table("users").insert(user_data).execute())
             
             if response.data and len(response.data) > 0:
                 return response.data[0]
@@ -84,7 +466,7 @@ class DatabaseHandler:
             Optional[Dict[str, Any]]: The updated user data
         """
         try:
-            response = supabase.table("users").update(user_data).eq("id", user_id).execute()
+            response = await _run("update_user", lambda: get_client().table("users").update(user_data).eq("id", user_id).execute())
             
             if response.data and len(response.data) > 0:
                 return response.data[0]
@@ -95,37 +477,32 @@ class DatabaseHandler:
             return None
     
     @staticmethod
-    async def increment_processed_images(user_id: str) -> bool:
+    async def increment_processed_images(user_id: str, amount: int = 1) -> bool:
         """
         Increments the number of processed images for a user.
         
+        The increment is buffered and written atomically by the usage
+        aggregator within USAGE_FLUSH_INTERVAL_SECONDS.
+        
         Args:
             user_id: The user ID
+            amount: The number of images to add
             
         Returns:
             bool: Whether the operation was successful
         """
-        try:
-            # Get the current user data
-            user = await DatabaseHandler.get_user(user_id)
-            
-            if not user:
-                return False
-            
-            # Increment the processed images count
-            current_count = user.get("images_processed_this_month", 0)
-            new_count = current_count + 1
-            
-            # Update the user data
-            updated_user = await DatabaseHandler.update_user(
-                user_id,
-                {"images_processed_this_month": new_count}
-            )
-            
-            return updated_user is not None
-        except Exception as e:
-            logger.error(f"Error incrementing processed images: {str(e)}")
-            return False
+        usage_aggregator.add(user_id, amount)
+        return True
+    
+    @staticmethod
+    async def flush_usage() -> int:
+        """
+        Writes buffered usage increments now.
+        
+        Returns:
+            int: The number of users written
+        """
+        return await usage_aggregator.flush()
     
     @staticmethod
     async def reset_monthly_counters() -> bool:
@@ -136,9 +513,12 @@ class DatabaseHandler:
             bool: Whether the operation was successful
         """
         try:
-            response = supabase.table("users").update(
-                {"images_processed_this_month": 0}
-            ).execute()
+            # Increments from before the reset belong to the old month
+            await usage_aggregator.flush()
+            response = await _run(
+                "reset_monthly_counters",
+                lambda: get_client().table("users").update({"images_processed_this_month": 0}).execute()
+            )
             
             return True
         except Exception as e:
@@ -148,7 +528,7 @@ class DatabaseHandler:
     @staticmethod
     async def store_image(
         user_id: str,
-        image_data: bytes,
+        image_data: Union[bytes, BinaryIO],
         file_name: str
     ) -> Optional[str]:
         """
@@ -156,28 +536,29 @@ class DatabaseHandler:
         
         Args:
             user_id: The user ID
-            image_data: The image data in bytes
+            image_data: The image data in bytes, or a file opened in binary mode
             file_name: The file name
             
         Returns:
             Optional[str]: The image URL
         """
         try:
-            # Generate a unique file name
-            timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-            unique_file_name = f"{user_id}_{timestamp}_{file_name}"
+            # Generate a unique file name inside the current hour's folder
+            now = datetime.now(timezone.utc)
+            timestamp = now.strftime("%Y%m%d%H%M%S")
+            unique_file_name = f"{image_partition(now)}/{user_id}_{timestamp}_{file_name}"
             
             # Upload the image to Supabase Storage
-            response = supabase.storage.from_("images").upload(
-                unique_file_name,
-                image_data
+            response = await _run(
+                "store_image",
+                lambda: get_client().storage.from_("images").upload(unique_file_name, image_data),
+                timeout=STORAGE_TIMEOUT_SECONDS
             )
             
-            # Get the public URL
-            image_url = supabase.storage.from_("images").get_public_url(unique_file_name)
+            # Get the public URL (built locally, no request)
+            image_url = get_client().storage.from_("images").get_public_url(unique_file_name)
             
-            # Schedule deletion after 24 hours for pro users
-            # This would typically be handled by a cron job or similar
+            # Expired hour folders are removed by the image sweeper (backend/sweeper.py)
             
             return image_url
         except Exception as e:
@@ -185,43 +566,112 @@ class DatabaseHandler:
             return None
     
     @staticmethod
-    async def delete_old_images() -> bool:
+    async def list_images(prefix: str = "", limit: int = 1000, offset: int = 0) -> Optional[List[Dict[str, Any]]]:
         """
-        Deletes images older than 24 hours.
+        Lists one page of the files and folders directly under a prefix of
+        the images bucket, sorted by name.
         
+        Args:
+            prefix: The folder to list, or "" for the bucket root
+            limit: The maximum number of entries
+            offset: The number of entries to skip
+            
         Returns:
-            bool: Whether the operation was successful
+            Optional[List[Dict[str, Any]]]: The entries; folders have no id
         """
         try:
-            # Get all files in the images bucket
-            response = supabase.storage.from_("images").list()
-            
-            if not response:
-                return True
-            
-            # Get the current time
-            current_time = datetime.now()
-            
-            # Filter files older than 24 hours
-            for file in response:
-                # Extract the timestamp from the file name
-                # Format: user_id_YYYYMMDDHHMMSS_file_name
-                file_name = file.get("name", "")
-                parts = file_name.split("_")
-                
-                if len(parts) >= 3:
-                    try:
-                        timestamp_str = parts[1]
-                        file_timestamp = datetime.strptime(timestamp_str, "%Y%m%d%H%M%S")
-                        
-                        # Check if the file is older than 24 hours
-                        if current_time - file_timestamp > timedelta(hours=24):
-                            # Delete the file
-                            supabase.storage.from_("images").remove([file_name])
-                    except Exception as e:
-                        logger.error(f"Error parsing file timestamp: {str(e)}")
+            options = {"limit": limit, "offset": offset, "sortBy": {"column": "name", "order": "asc"}}
+            return await _run(
+                "list_images",
+                lambda: get_client().storage.from_("images").list(prefix, options),
+                timeout=STORAGE_TIMEOUT_SECONDS
+            )
+        except Exception as e:
+            logger.error(f"Error listing images under '{prefix}': {str(e)}")
+            return None
+    
+    @staticmethod
+    async def remove_images(paths: List[str]) -> Optional[int]:
+        """
+        Deletes many files from the images bucket in one request.
+        
+        Args:
+            paths: The file paths, at most 1000
+            
+        Returns:
+            Optional[int]: The number of files deleted
+        """
+        try:
+            response = await _run(
+                "remove_images",
+                lambda: get_client().storage.from_("images").remove(paths),
+                timeout=STORAGE_TIMEOUT_SECONDS
+            )
+            return len(response or [])
+        except Exception as e:
+            logger.error(f"Error removing {len(paths)} images: {str(e)}")
+            return None
+    
+    @staticmethod
+    async def get_checkpoint(name: str) -> Optional[Dict[str, Any]]:
+        """
+        Gets the saved progress of a maintenance job.
+        
+        Args:
+            name: The job name
             
+        Returns:
+            Optional[Dict[str, Any]]: The checkpoint, or None if there is none
+        """
+        try:
+            response = await _run(
+                "get_checkpoint",
+                lambda: get_client().table("maintenance_checkpoints").select("value").eq("name", name).execute()
+            )
+            if response.data:
+                return response.data[0]["value"]
+            return None
+        except Exception as e:
+            logger.error(f"Error getting checkpoint {name}: {str(e)}")
+            return None
+    
+    @staticmethod
+    async def save_checkpoint(name: str, value: Dict[str, Any]) -> bool:
+        """
+        Saves the progress of a maintenance job.
+        
+        Args:
+            name: The job name
+            value: The checkpoint
+            
+        Returns:
+            bool: Whether the operation was successful
+        """
+        try:
+            await _run(
+                "save_checkpoint",
+                lambda: get_client().table("maintenance_checkpoints").upsert({"name": name, "value": value}).execute()
+            )
             return True
         except Exception as e:
-            logger.error(f"Error deleting old images: {str(e)}")
-            return False 
\ No newline at end of file
+            logger.error(f"Error saving checkpoint {name}: {str(e)}")
+            return False
+    
+    @staticmethod
+    async def delete_old_images() -> bool:
+        """
+        Deletes images older than IMAGE_RETENTION_HOURS (24 hours by default).
+        
+        This runs the image sweeper in the calling process; in production it
+        runs as a scheduled job (python -m backend.sweeper) instead.
+        
+        Returns:
+            bool: Whether the operation was successful
+        """
+        try:
+            from .sweeper import ImageSweeper
+        except ImportError:
+            from backend.sweeper import ImageSweeper
+        
+        summary = await ImageSweeper().sweep()
+        return summary["completed"]
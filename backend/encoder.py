@@ -0,0 +1,251 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from io import BytesIO
+from typing import Optional, Dict, Any, Callable, BinaryIO, Tuple
+from PIL import Image
+from dotenv import load_dotenv
+
+try:
+    from .results import UpscaleResult, RESULT_SPOOL_BYTES
+    from .cpu_pool import cpu_pool
+    from .progress import report
+    from . import metrics
+except ImportError:
+    from backend.results import UpscaleResult, RESULT_SPOOL_BYTES
+    from backend.cpu_pool import cpu_pool
+    from backend.progress import report
+    from backend import metrics
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+# Level 1 encodes about twice as fast as level 3 for roughly 15% more bytes
+PNG_COMPRESS_LEVEL = int(os.getenv("ENCODE_PNG_COMPRESS_LEVEL", "1"))
+# Row filter used when streaming large PNGs: none, sub or up. Resampled
+# images are smooth, so the up filter makes them several times smaller
+# and, by giving zlib less to search, faster to compress.
+PNG_FILTER = os.getenv("ENCODE_PNG_FILTER", "up").lower()
+JPEG_QUALITY = int(os.getenv("ENCODE_JPEG_QUALITY", "90"))
+JPEG_PROGRESSIVE = os.getenv("ENCODE_JPEG_PROGRESSIVE", "true").lower() == "true"
+JPEG_OPTIMIZE = os.getenv("ENCODE_JPEG_OPTIMIZE", "true").lower() == "true"
+WEBP_QUALITY = int(os.getenv("ENCODE_WEBP_QUALITY", "85"))
+# 0 (fastest) to 6 (smallest)
+WEBP_METHOD = int(os.getenv("ENCODE_WEBP_METHOD", "2"))
+# Largest JPEG or WebP output, in pixels. Unlike PNG, these formats are
+# encoded from a full image in memory (3 or 4 bytes per pixel).
+MAX_BUFFERED_PIXELS = int(os.getenv("ENCODE_MAX_BUFFERED_PIXELS", str(64_000_000)))
+
+# PNG row filter types by name
+PNG_FILTERS = {"none": 0, "sub": 1, "up": 2}
+
+# Largest width or height each format can store
+MAX_DIMENSIONS = {"JPEG": 65535, "WEBP": 16383}
+
+_stats: Dict[str, Dict[str, float]] = {}
+_stats_lock = threading.Lock()
+
+
+def normalize_format(output_format: str) -> str:
+    """
+    Returns the canonical name of an output format.
+
+    Args:
+        output_format: Output format (jpeg, png, jpg, webp)
+
+    Returns:
+        str: The lowercase format, with jpg spelled jpeg
+    """
+    output_format = output_format.lower()
+    return "jpeg" if output_format == "jpg" else output_format
+
+
+def pil_format(output_format: str) -> str:
+    """
+    Returns the PIL format name for an output format.
+    """
+    return normalize_format(output_format).upper()
+
+
+def save_options(output_format: str) -> Dict[str, Any]:
+    """
+    Returns the tuned encoder settings for an output format.
+
+    Args:
+        output_format: Output format (jpeg, png, jpg, webp)
+
+    Returns:
+        Dict[str, Any]: Keyword arguments for Image.save
+    """
+    output_format = normalize_format(output_format)
+    if output_format == "png":
+        return {"compress_level": PNG_COMPRESS_LEVEL}
+    if output_format == "jpeg":
+        return {"quality": JPEG_QUALITY, "progressive": JPEG_PROGRESSIVE, "optimize": JPEG_OPTIMIZE}
+    if output_format == "webp":
+        return {"quality": WEBP_QUALITY, "method": WEBP_METHOD}
+    return {}
+
+
+def check_size(output_format: str, size: Tuple[int, int]) -> None:
+    """
+    Fails early if an image is too large for a format, or too large to
+    encode in memory, before any time is spent producing it.
+
+    Args:
+        output_format: Output format (jpeg, png, jpg, webp)
+        size: The image (width, height)
+    """
+    limit = MAX_DIMENSIONS.get(pil_format(output_format))
+    if limit is not None and max(size) > limit:
+        raise ValueError(
+            f"{size[0]}x{size[1]} is too large for {normalize_format(output_format)} output "
+            f"(at most {limit} pixels per side). Use png or a smaller scale factor."
+        )
+    if pil_format(output_format) != "PNG" and size[0] * size[1] > MAX_BUFFERED_PIXELS:
+        raise ValueError(
+            f"{size[0]}x{size[1]} is too large for {normalize_format(output_format)} output "
+            f"(at most {MAX_BUFFERED_PIXELS} pixels). Use png or a smaller scale factor."
+        )
+
+
+def record(output_format: str, raw_bytes: int, encoded_bytes: int, seconds: float) -> None:
+    """
+    Records one encode.
+
+    Args:
+        output_format: Output format (jpeg, png, jpg, webp)
+        raw_bytes: The size of the uncompressed pixels
+        encoded_bytes: The size of the encoded image
+        seconds: How long the encode took
+    """
+    output_format = normalize_format(output_format)
+    metrics.observe(f"encode_{output_format}", seconds)
+    with _stats_lock:
+        stats = _stats.get(output_format)
+        if stats is None:
+            stats = _stats[output_format] = {"encodes": 0, "seconds": 0.0, "raw_bytes": 0, "encoded_bytes": 0}
+        stats["encodes"] += 1
+        stats["seconds"] += seconds
+        stats["raw_bytes"] += raw_bytes
+        stats["encoded_bytes"] += encoded_bytes
+
+
+def encode(img: Image.Image, output_format: str, out: BinaryIO) -> None:
+    """
+    Encodes an image with the tuned settings for its format.
+
+    Args:
+        img: The image, in a mode the format supports
+        output_format: Output format (jpeg, png, jpg, webp)
+        out: A seekable file object to write the encoded image to
+    """
+    check_size(output_format, img.size)
+    start = out.tell()
+    started = time.perf_counter()
+    img.save(out, format=pil_format(output_format), **save_options(output_format))
+    record(
+        output_format,
+        img.width * img.height * len(img.getbands()),
+        out.tell() - start,
+        time.perf_counter() - started
+    )
+
+
+def encode_to_result(raw_size: int, write: Callable[[BinaryIO], None]) -> UpscaleResult:
+    """
+    Runs an encoder into memory when its output is small and straight into
+    a spool file otherwise.
+
+    Args:
+        raw_size: The size of the uncompressed pixels being encoded
+        write: Writes the encoded image to the file object it is given
+
+    Returns:
+        UpscaleResult: The encoded image
+    """
+    if raw_size < RESULT_SPOOL_BYTES:
+        output = BytesIO()
+        write(output)
+        return UpscaleResult(data=output.getvalue())
+
+    spool, path = UpscaleResult.spool_file()
+    try:
+        with spool:
+            write(spool)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return UpscaleResult(path=path, owned=True)
+
+
+def _read_format(result: UpscaleResult) -> Optional[str]:
+    with result.open() as f:
+        # Only the header is read
+        return Image.open(f).format
+
+
+def _reencode(result: UpscaleResult, output_format: str) -> UpscaleResult:
+    with result.open() as f, Image.open(f) as img:
+        img.load()
+        if pil_format(output_format) == "JPEG" and img.mode not in ("RGB", "L", "CMYK"):
+            img = img.convert("RGB")
+        return encode_to_result(
+            img.width * img.height * len(img.getbands()),
+            lambda out: encode(img, output_format, out)
+        )
+
+
+async def ensure_format(result: UpscaleResult, output_format: str) -> UpscaleResult:
+    """
+    Re-encodes a provider's result if it is not already in the requested
+    format, on the CPU pool. Results in the right format are returned as
+    they are, without decoding them.
+
+    Args:
+        result: The result; it is closed if it is replaced
+        output_format: Output format (jpeg, png, jpg, webp)
+
+    Returns:
+        UpscaleResult: A result in the requested format
+    """
+    if result.on_disk:
+        loop = asyncio.get_running_loop()
+        actual = await loop.run_in_executor(None, _read_format, result)
+    else:
+        actual = _read_format(result)
+    if actual == pil_format(output_format):
+        metrics.count("reencodes_skipped")
+        return result
+
+    logger.debug("Re-encoding %s result as %s", actual, normalize_format(output_format))
+    metrics.count("reencodes")
+    report("encoding")
+    try:
+        reencoded = await cpu_pool.run("encode", _reencode, result, output_format, on_discard=UpscaleResult.close)
+    finally:
+        result.close()
+    reencoded.plan = result.plan
+    return reencoded
+
+
+def stats() -> Dict[str, Any]:
+    with _stats_lock:
+        formats = {
+            output_format: {
+                **values,
+                "seconds": round(values["seconds"], 3),
+                "compression_ratio": round(values["raw_bytes"] / values["encoded_bytes"], 2)
+                if values["encoded_bytes"] else None,
+            }
+            for output_format, values in _stats.items()
+        }
+    return {"formats": formats}
+
+
+metrics.register_collector("encoder", stats)
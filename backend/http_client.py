@@ -0,0 +1,208 @@
+import os
+import time
+import asyncio
+import logging
+import importlib.util
+import threading
+from typing import Optional, Dict, Any
+import httpx
+from dotenv import load_dotenv
+
+try:
+    from . import metrics
+    from .results import UpscaleResult, RESULT_SPOOL_BYTES
+except ImportError:
+    from backend import metrics
+    from backend.results import UpscaleResult, RESULT_SPOOL_BYTES
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+HTTP_WRITE_TIMEOUT = float(os.getenv("HTTP_WRITE_TIMEOUT", "60"))
+HTTP_POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", "10"))
+# HTTP/2 needs the optional h2 package
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "true").lower() == "true" and importlib.util.find_spec("h2") is not None
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(256 * 1024)))
+# Chunks are written to the spool file in batches of about this size, off
+# the event loop
+DOWNLOAD_WRITE_BYTES = int(os.getenv("DOWNLOAD_WRITE_BYTES", str(2 * 1024 * 1024)))
+
+_client: Optional[httpx.AsyncClient] = None
+
+_stats_lock = threading.Lock()
+_stats = {
+    "requests": 0,
+    "new_connections": 0,
+    "downloads": 0,
+    "download_bytes": 0,
+    "download_seconds": 0.0,
+}
+
+
+def _count(name: str, value=1) -> None:
+    with _stats_lock:
+        _stats[name] += value
+
+
+async def _trace(event_name: str, info: Dict[str, Any]) -> None:
+    # httpcore reports a TCP connect only when the pool has no idle connection
+    if event_name == "connection.connect_tcp.complete":
+        _count("new_connections")
+
+
+def get_client() -> httpx.AsyncClient:
+    """
+    Returns the application-wide HTTP client, creating it on first use.
+
+    Returns:
+        httpx.AsyncClient: The shared client
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=HTTP2_ENABLED,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(
+                connect=HTTP_CONNECT_TIMEOUT,
+                read=HTTP_READ_TIMEOUT,
+                write=HTTP_WRITE_TIMEOUT,
+                pool=HTTP_POOL_TIMEOUT,
+            ),
+            follow_redirects=True,
+        )
+        logger.info(f"Created shared HTTP client (http2={HTTP2_ENABLED}, max_connections={HTTP_MAX_CONNECTIONS})")
+    return _client
+
+
+async def warm_up() -> None:
+    """
+    Creates the shared client ahead of the first outbound request.
+    """
+    get_client()
+
+
+async def close_client() -> None:
+    """
+    Closes the shared HTTP client and its pooled connections.
+    """
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def request(method: str, url: str, **kwargs) -> httpx.Response:
+    """
+    Sends a request on the shared client and reads the whole response.
+
+    Args:
+        method: The HTTP method
+        url: The URL
+        **kwargs: Passed to httpx.AsyncClient.request
+
+    Returns:
+        httpx.Response: The response
+    """
+    _count("requests")
+    return await get_client().request(method, url, extensions={"trace": _trace}, **kwargs)
+
+
+async def download(url: str) -> UpscaleResult:
+    """
+    Downloads a URL in chunks on the shared client. Small bodies are kept in
+    memory; large or unsized ones are streamed into the result spool on disk,
+    with each batch written in the default executor while the next is read.
+
+    Args:
+        url: The URL to download
+
+    Returns:
+        UpscaleResult: The downloaded data
+    """
+    _count("requests")
+    started = time.monotonic()
+    chunks = []
+    size = 0
+    buffered = 0
+    sink = None
+    path = None
+    # The spool write in flight, if any
+    write: Optional[asyncio.Future] = None
+    loop = asyncio.get_running_loop()
+    try:
+        async with get_client().stream("GET", url, extensions={"trace": _trace}) as response:
+            response.raise_for_status()
+            content_length = response.headers.get("content-length")
+            if content_length is None or int(content_length) >= RESULT_SPOOL_BYTES:
+                sink, path = UpscaleResult.spool_file()
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                chunks.append(chunk)
+                if sink is None:
+                    continue
+                buffered += len(chunk)
+                if buffered >= DOWNLOAD_WRITE_BYTES:
+                    if write is not None:
+                        await write
+                    write = loop.run_in_executor(None, sink.writelines, chunks)
+                    chunks, buffered = [], 0
+        if sink is not None:
+            if write is not None:
+                await write
+                write = None
+            if chunks:
+                await loop.run_in_executor(None, sink.writelines, chunks)
+    except BaseException:
+        if sink is not None:
+            if write is not None:
+                # The file is only closed once nothing writes to it
+                await asyncio.wait({write})
+            sink.close()
+            os.unlink(path)
+        raise
+
+    with _stats_lock:
+        _stats["downloads"] += 1
+        _stats["download_bytes"] += size
+        _stats["download_seconds"] += time.monotonic() - started
+    if sink is not None:
+        sink.close()
+        # Written once, to the spool file
+        metrics.count_bytes("provider_download", size, copied=size)
+        return UpscaleResult(path=path, size=size, owned=True)
+    # Joining a single chunk returns it as it is
+    metrics.count_bytes("provider_download", size, copied=size if len(chunks) > 1 else 0)
+    return UpscaleResult(data=b"".join(chunks))
+
+
+def stats() -> Dict[str, Any]:
+    """
+    Returns connection reuse and download throughput statistics.
+
+    Returns:
+        Dict[str, Any]: The HTTP client statistics
+    """
+    with _stats_lock:
+        result: Dict[str, Any] = dict(_stats)
+    requests = result["requests"]
+    result["connection_reuse_rate"] = 1 - result["new_connections"] / requests if requests else 0.0
+    result["download_throughput_bytes_per_second"] = (
+        result["download_bytes"] / result["download_seconds"] if result["download_seconds"] else 0.0
+    )
+    result["http2"] = HTTP2_ENABLED
+    return result
+
+
+metrics.register_collector("http_client", stats)
@@ -1,31 +1,33 @@
 import os
 import logging
-import httpx
-import tempfile
-import asyncio
+import hashlib
 from PIL import Image
 from io import BytesIO
 from typing import Optional, Tuple, Dict, Any, Literal
 from dotenv import load_dotenv
-import uuid
-import base64
-import replicate
+
+try:
+    from .result_cache import ResultCache, result_cache
+    from .results import UpscaleResult
+    from .providers import get_provider, get_fallback_provider
+    from .cpu_pool import cpu_pool
+    from .progress import report
+    from .single_flight import SingleFlight
+    from . import metrics
+except ImportError:
+    from backend.result_cache import ResultCache, result_cache
+    from backend.results import UpscaleResult
+    from backend.providers import get_provider, get_fallback_provider
+    from backend.cpu_pool import cpu_pool
+    from backend.progress import report
+    from backend.single_flight import SingleFlight
+    from backend import metrics
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-)
 logger = logging.getLogger(__name__)
 
-# Configuration
-REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN")
-if not REPLICATE_API_TOKEN:
-    logger.error("REPLICATE_API_TOKEN environment variable is not set")
-
 # Define valid parameter values
 VALID_MODES = ["block_mode", "face_mode", "waifu_mode"]
 VALID_SCALE_FACTORS = [2, 4, 6, 8, 16]
@@ -38,12 +40,24 @@ MODE_TO_MODEL = {
     "waifu_mode": "anime"     # Anime/waifu
 }
 
-# Updated to a more reliable model
-UPSCALE_MODEL = "nightmareai/real-esrgan:42fed1c4974146d4d2414e2be2c5277c7fcf05fcc3a73abf41610695738c1d7b"
+# Identical upscales in flight at once share one provider call
+upscale_flights = SingleFlight("upscale")
+metrics.register_collector("single_flight", upscale_flights.stats)
+
+
+def _share_outcome(outcome: Tuple[Optional[UpscaleResult], Optional[str]]) -> Tuple[Optional[UpscaleResult], Optional[str]]:
+    result, error = outcome
+    return (result.share() if result is not None else None), error
+
+
+def _release_outcome(outcome: Tuple[Optional[UpscaleResult], Optional[str]]) -> None:
+    if outcome[0] is not None:
+        outcome[0].close()
+
 
 class ImageProcessor:
     """
-    Handles image processing using Replicate's API.
+    Handles image processing through the configured upscale provider.
     """
     
     @staticmethod
@@ -57,12 +71,16 @@ class ImageProcessor:
         Returns:
             Tuple[bool, Optional[str]]: (is_valid, error_message)
         """
-        try:
+        def verify() -> None:
             img = Image.open(BytesIO(image_data))
             img.verify()  # Verify it's an image
+
+        try:
+            # Decoding is CPU-bound; keep it off the event loop
+            await cpu_pool.run("verify", verify)
             return True, None
         except Exception as e:
-            logger.error(f"Invalid image: {str(e)}")
+            logger.warning("Invalid image: %s", e)
             return False, f"Invalid image: {str(e)}"
     
     @staticmethod
@@ -74,10 +92,17 @@ class ImageProcessor:
         handfix: bool = False,
         creativity: float = 0.5,
         resemblance: float = 1.5,
-        output_format: str = "png"
-    ) -> Tuple[Optional[bytes], Optional[str]]:
+        output_format: str = "png",
+        content_hash: Optional[str] = None
+    ) -> Tuple[Optional[UpscaleResult], Optional[str]]:
         """
-        Upscales an image using Replicate's API.
+        Upscales an image with the configured provider, falling back to
+        the local provider if it fails.
+        
+        Results are cached by the input hash and the normalized parameters,
+        so repeated requests are served without calling the model. Identical
+        requests arriving while one is in flight wait for it and share its
+        result rather than calling the model again.
         
         Args:
             image_data: The image data in bytes
@@ -88,13 +113,11 @@ class ImageProcessor:
             creativity: Creativity parameter (0 to 1)
             resemblance: Resemblance parameter (0 to 3)
             output_format: Output format (jpeg, png, jpg, webp)
+            content_hash: SHA-256 hex digest of image_data, if already known
             
         Returns:
-            Tuple[Optional[bytes], Optional[str]]: (processed_image_data, error_message)
+            Tuple[Optional[UpscaleResult], Optional[str]]: (result, error_message)
         """
-        temp_file = None
-        input_path = None
-        
         try:
             # Validate parameters
             if mode not in VALID_MODES:
@@ -115,185 +138,90 @@ class ImageProcessor:
             if output_format not in VALID_OUTPUT_FORMATS:
                 return None, f"Invalid output format. Must be one of: {', '.join(VALID_OUTPUT_FORMATS)}"
             
-            # Validate the image
-            is_valid, error = await ImageProcessor.validate_image(image_data)
-            if not is_valid:
-                return None, error
+            cache_key = ResultCache.make_key(
+                content_hash or hashlib.sha256(image_data).hexdigest(),
+                scale_factor,
+                mode,
+                output_format,
+                dynamic,
+                handfix,
+                creativity,
+                resemblance
+            )
+            with metrics.timed("cache_lookup"):
+                cached = await result_cache.get(cache_key)
+            if cached is not None:
+                logger.debug("Serving cached result %.12s (%d bytes)", cache_key, cached.size)
+                metrics.count_bytes("cache_hit", cached.size)
+                report("cached")
+                return cached, None
             
-            # Create a unique ID for this processing job
-            job_id = str(uuid.uuid4())
+            options = {
+                "dynamic": dynamic,
+                "handfix": handfix,
+                "creativity": creativity,
+                "resemblance": resemblance,
+            }
+            if upscale_flights.in_flight(cache_key):
+                report("coalesced")
+            return await upscale_flights.run(
+                cache_key,
+                lambda: ImageProcessor._upscale_uncached(
+                    image_data, cache_key, scale_factor, mode, output_format, options
+                ),
+                share=_share_outcome,
+                release=_release_outcome
+            )
             
-            # Create a temporary file for the input image
-            temp_file = tempfile.NamedTemporaryFile(suffix=".png", delete=False)
-            temp_file.write(image_data)
-            temp_file.close()
-            input_path = temp_file.name
-            
-            try:
-                # Convert image to base64 for API request
-                base64_image = base64.b64encode(image_data).decode("utf-8")
-                
-                # Call Replicate API
-                processed_image_data = await ImageProcessor._upscale_with_replicate(
-                    base64_image,
-                    scale_factor,
-                    mode,
-                    dynamic,
-                    handfix,
-                    creativity,
-                    resemblance,
-                    output_format
-                )
-                
-                return processed_image_data, None
-            except Exception as e:
-                logger.error(f"Error processing image: {str(e)}")
-                logger.warning(f"Replicate API failed: {str(e)}. Falling back to simple resizing.")
-                
-                # Fall back to simple resizing if API fails
-                try:
-                    # Make sure the input file still exists
-                    if os.path.exists(input_path):
-                        return await ImageProcessor._upscale_with_pil(input_path, scale_factor, output_format), None
-                    else:
-                        # If the file was deleted, recreate it
-                        with open(input_path, 'wb') as f:
-                            f.write(image_data)
-                        result = await ImageProcessor._upscale_with_pil(input_path, scale_factor, output_format)
-                        return result, None
-                except Exception as fallback_error:
-                    logger.error(f"Fallback to PIL also failed: {str(fallback_error)}")
-                    return None, f"Error processing image: {str(e)}. Fallback also failed: {str(fallback_error)}"
-                
         except Exception as e:
             logger.error(f"Error upscaling image: {str(e)}")
             return None, f"Error upscaling image: {str(e)}"
-        finally:
-            # Clean up temporary file
-            if input_path and os.path.exists(input_path):
-                try:
-                    os.unlink(input_path)
-                except Exception as e:
-                    logger.warning(f"Failed to delete temporary file: {e}")
-    
+
     @staticmethod
-    async def _upscale_with_replicate(
-        base64_image: str,
+    async def _upscale_uncached(
+        image_data: bytes,
+        cache_key: str,
         scale_factor: int,
         mode: str,
-        dynamic: int,
-        handfix: bool,
-        creativity: float,
-        resemblance: float,
-        output_format: str
-    ) -> bytes:
+        output_format: str,
+        options: Dict[str, Any]
+    ) -> Tuple[Optional[UpscaleResult], Optional[str]]:
         """
-        Upscales an image using Replicate's API.
+        Validates an image and upscales it with the provider, falling back
+        to the local provider, and caches the model's result.
         """
-        if not REPLICATE_API_TOKEN:
-            raise ValueError("REPLICATE_API_TOKEN is not set")
-        
-        # Set the API token for the replicate client
-        os.environ["REPLICATE_API_TOKEN"] = REPLICATE_API_TOKEN
-        
-        logger.info(f"Using Real-ESRGAN model for {mode} with scale factor {scale_factor}")
-        
-        # Create a temporary file for the input image
-        with tempfile.NamedTemporaryFile(suffix=f".{output_format}", delete=False) as temp_input_file:
-            try:
-                # Convert base64 to binary
-                image_data = base64.b64decode(base64_image)
-                temp_input_file.write(image_data)
-                temp_input_file.flush()
-                
-                # Prepare input parameters for Real-ESRGAN model
-                input_params = {
-                    "image": open(temp_input_file.name, "rb"),
-                    "scale": scale_factor,
-                    "face_enhance": mode == "face_mode",
-                    "output_format": output_format
-                }
-                
-                logger.info(f"Replicate input parameters: {input_params}")
-                
-                # Run the prediction
-                loop = asyncio.get_event_loop()
-                output = await loop.run_in_executor(
-                    None,
-                    lambda: replicate.run(
-                        UPSCALE_MODEL,
-                        input=input_params
-                    )
-                )
-                
-                logger.info(f"Replicate output: {output}")
-                
-                # Download the result
-                output_url = output
-                if isinstance(output, list) and len(output) > 0:
-                    output_url = output[0]
-                elif isinstance(output, dict) and "output" in output:
-                    output_url = output["output"]
-                
-                if not output_url:
-                    raise ValueError("No output URL returned from Replicate")
-                
-                logger.info(f"Downloading result from: {output_url}")
-                
-                async with httpx.AsyncClient() as client:
-                    response = await client.get(output_url)
-                    response.raise_for_status()
-                    return response.content
-                    
-            finally:
-                # Clean up the temporary file
-                try:
-                    os.unlink(temp_input_file.name)
-                except Exception as e:
-                    logger.warning(f"Failed to delete temporary file: {e}")
-    
-    @staticmethod
-    async def _upscale_with_pil(
-        input_path: str,
-        scale_factor: int,
-        output_format: str = "png"
-    ) -> bytes:
-        """
-        Upscales an image using PIL as a fallback.
+        # The same buffer is shared by every stage below; copies made inside the
+        # provider (downscaling, reading back model passes) are counted there
+        metrics.count_bytes("validate", len(image_data))
+        with metrics.timed("validate"):
+            is_valid, error = await ImageProcessor.validate_image(image_data)
+        if not is_valid:
+            return None, error
         
-        Args:
-            input_path: Path to the input image
-            scale_factor: The scale factor (2, 4, 6, 8, 16)
-            output_format: Output format (jpeg, png, jpg, webp)
-            
-        Returns:
-            bytes: The processed image data
-        """
+        provider = get_provider()
+        metrics.count("upscales")
         try:
-            # Check if the file exists
-            if not os.path.exists(input_path):
-                raise FileNotFoundError(f"Input file not found: {input_path}")
-                
-            img = Image.open(input_path)
-            width, height = img.size
-            new_width = width * scale_factor
-            new_height = height * scale_factor
-            upscaled_img = img.resize((new_width, new_height), Image.LANCZOS)
+            with metrics.timed(f"provider_{provider.name}"):
+                result = await provider.upscale(image_data, scale_factor, mode, output_format, **options)
             
-            # Save the upscaled image to a BytesIO object
-            output = BytesIO()
-            
-            # Convert output_format to PIL format
-            pil_format = output_format.upper()
-            if pil_format == "JPG":
-                pil_format = "JPEG"
-            
-            upscaled_img.save(output, format=pil_format)
-            return output.getvalue()
+            # Only model results are cached; fallback output is not
+            with metrics.timed("cache_store"):
+                await result_cache.put(cache_key, result)
+            return result, None
         except Exception as e:
-            logger.error(f"Error in PIL upscaling: {str(e)}")
-            # Create a simple error image
-            error_img = Image.new('RGB', (400, 200), color=(255, 0, 0))
-            output = BytesIO()
-            error_img.save(output, format='PNG')
-            return output.getvalue() 
\ No newline at end of file
+            logger.error(f"Error processing image: {str(e)}")
+            metrics.count("provider_failures")
+            fallback = get_fallback_provider()
+            if fallback is provider:
+                return None, f"Error processing image: {str(e)}"
+            logger.warning("%s provider failed: %s. Falling back to %s.", provider.name, e, fallback.name)
+            
+            try:
+                metrics.count("fallbacks")
+                report("fallback", provider=fallback.name)
+                metrics.count_bytes("fallback_input", len(image_data))
+                with metrics.timed(f"provider_{fallback.name}"):
+                    return await fallback.upscale(image_data, scale_factor, mode, output_format, **options), None
+            except Exception as fallback_error:
+                logger.error(f"Fallback to {fallback.name} also failed: {str(fallback_error)}")
+                return None, f"Error processing image: {str(e)}. Fallback also failed: {str(fallback_error)}"
@@ -0,0 +1,496 @@
+import os
+import re
+import json
+import time
+import uuid
+import asyncio
+import logging
+import tempfile
+from typing import Optional, Dict, Any, Tuple, Callable, Awaitable, AsyncIterator
+from dotenv import load_dotenv
+
+try:
+    from .image_processor import ImageProcessor
+    from .results import UpscaleResult, media_type_for
+    from .progress import ProgressChannel, Event, current_channel, PROGRESS_KEEPALIVE_SECONDS
+    from . import metrics
+except ImportError:
+    from backend.image_processor import ImageProcessor
+    from backend.results import UpscaleResult, media_type_for
+    from backend.progress import ProgressChannel, Event, current_channel, PROGRESS_KEEPALIVE_SECONDS
+    from backend import metrics
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "8"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", "3600"))
+JOB_SWEEP_INTERVAL_SECONDS = int(os.getenv("JOB_SWEEP_INTERVAL_SECONDS", "60"))
+# Job state and results are kept on disk so any worker process can serve them
+JOB_DIR = os.getenv("JOB_DIR", os.path.join(tempfile.gettempdir(), "upscaloro-jobs"))
+# How often event streams check on jobs running in another worker process
+JOB_EVENTS_POLL_SECONDS = float(os.getenv("JOB_EVENTS_POLL_SECONDS", "1"))
+
+JOB_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+# Job statuses
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+# Called with the job and its result once a job succeeds
+CompletionHook = Callable[["Job", UpscaleResult], Awaitable[None]]
+# Called with the job once a job fails
+FailureHook = Callable[["Job"], Awaitable[None]]
+
+
+class QueueFullError(Exception):
+    """
+    Raised when the job queue has no room for another job.
+    """
+
+
+class Job:
+    """
+    An upscale job and its current state.
+    """
+
+    def __init__(self, owner: Optional[str], params: Dict[str, Any], job_id: Optional[str] = None):
+        self.id = job_id or uuid.uuid4().hex
+        self.owner = owner
+        self.params = params
+        self.status = QUEUED
+        self.error: Optional[str] = None
+        self.result_size: Optional[int] = None
+        self.plan: Optional[Dict[str, Any]] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def media_type(self) -> str:
+        return media_type_for(self.params.get("output_format", "png"))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "owner": self.owner,
+            "status": self.status,
+            "params": {k: v for k, v in self.params.items() if k != "content_hash"},
+            "error": self.error,
+            "result_size": self.result_size,
+            "plan": self.plan,
+            "media_type": self.media_type,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+    def final_event(self) -> Event:
+        """
+        Returns the event that ends the job's event stream.
+        """
+        if self.status == SUCCEEDED:
+            return "done", {
+                "status": self.status,
+                "result_url": f"/jobs/{self.id}/result",
+                "media_type": self.media_type,
+                "result_size": self.result_size,
+                "plan": self.plan,
+            }
+        return "failed", {"status": self.status, "error": self.error}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Job":
+        job = cls(data.get("owner"), data.get("params", {}), job_id=data["id"])
+        job.status = data.get("status", QUEUED)
+        job.error = data.get("error")
+        job.result_size = data.get("result_size")
+        job.plan = data.get("plan")
+        job.created_at = data.get("created_at", job.created_at)
+        job.started_at = data.get("started_at")
+        job.finished_at = data.get("finished_at")
+        return job
+
+
+class JobManager:
+    """
+    Runs upscale jobs on a bounded pool of async workers and retains their
+    state and results for JOB_TTL_SECONDS.
+    """
+
+    def __init__(
+        self,
+        workers: int = JOB_WORKERS,
+        queue_size: int = JOB_QUEUE_SIZE,
+        directory: str = JOB_DIR
+    ):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.directory = directory
+        self._jobs: Dict[str, Job] = {}
+        # Event channels of the retained jobs queued or running in this process
+        self._channels: Dict[str, ProgressChannel] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks = []
+        self._running = 0
+        self._cancelled = 0
+
+    async def start(self) -> None:
+        """
+        Starts the worker tasks and the expiry sweeper.
+        """
+        if self._queue is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._sweeper()))
+        logger.info(f"Job manager started with {self.workers} workers")
+
+    async def stop(self) -> None:
+        """
+        Stops the worker tasks. Queued jobs are marked as failed.
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._queue is not None:
+            while not self._queue.empty():
+                job, _, future, _, on_failure = self._queue.get_nowait()
+                await self._finish(job, None, "Server shutting down", retain=future is None)
+                if future is not None and not future.done():
+                    future.set_result((None, "Server shutting down"))
+                await self._failed(job, on_failure)
+            self._queue = None
+
+    def _state_path(self, job_id: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def _result_path(self, job_id: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.bin")
+
+    def _persist(self, job: Job, result: Optional[UpscaleResult] = None) -> None:
+        if result is not None:
+            result.save_to(self._result_path(job.id))
+        with open(self._state_path(job.id) + ".tmp", "w") as f:
+            json.dump(job.to_dict(), f)
+        os.replace(self._state_path(job.id) + ".tmp", self._state_path(job.id))
+
+    async def _save(self, job: Job, result: Optional[UpscaleResult] = None) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self._persist, job, result)
+        except OSError as e:
+            logger.error(f"Error saving job {job.id}: {str(e)}")
+
+    def _enqueue(
+        self,
+        job: Job,
+        image_data: bytes,
+        future: Optional[asyncio.Future],
+        on_success: Optional[CompletionHook],
+        on_failure: Optional[FailureHook] = None
+    ) -> None:
+        if self._queue is None:
+            raise RuntimeError("Job manager is not running")
+        try:
+            self._queue.put_nowait((job, image_data, future, on_success, on_failure))
+        except asyncio.QueueFull:
+            raise QueueFullError("The upscale queue is full")
+
+    async def submit(
+        self,
+        owner: Optional[str],
+        image_data: bytes,
+        params: Dict[str, Any],
+        on_success: Optional[CompletionHook] = None,
+        on_failure: Optional[FailureHook] = None
+    ) -> Job:
+        """
+        Queues a job whose state and result are retained for polling.
+
+        Args:
+            owner: The username of the submitting user
+            image_data: The image data in bytes
+            params: Keyword arguments for ImageProcessor.upscale_image
+            on_success: Awaited with the job and its result when it succeeds
+            on_failure: Awaited with the job when it fails
+
+        Returns:
+            Job: The queued job
+
+        Raises:
+            QueueFullError: If the queue is full
+        """
+        job = Job(owner, params)
+        self._enqueue(job, image_data, None, on_success, on_failure)
+        self._jobs[job.id] = job
+        channel = self._channels[job.id] = ProgressChannel(image_data, params.get("scale_factor", 2))
+        channel.publish("status", {"status": QUEUED})
+        await self._save(job)
+        return job
+
+    async def run(
+        self,
+        owner: Optional[str],
+        image_data: bytes,
+        params: Dict[str, Any]
+    ) -> Tuple[Optional[UpscaleResult], Optional[str]]:
+        """
+        Runs a job on the worker pool and waits for its result, without
+        retaining it. Used by the synchronous /upscale endpoint.
+
+        Args:
+            owner: The username of the submitting user
+            image_data: The image data in bytes
+            params: Keyword arguments for ImageProcessor.upscale_image
+
+        Returns:
+            Tuple[Optional[UpscaleResult], Optional[str]]: (result, error_message)
+
+        Raises:
+            QueueFullError: If the queue is full
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(Job(owner, params), image_data, future, None)
+        return await future
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """
+        Gets a job by ID, including jobs submitted to other worker processes.
+
+        Args:
+            job_id: The job ID
+
+        Returns:
+            Optional[Job]: The job, or None if it does not exist or has expired
+        """
+        if not JOB_ID_PATTERN.match(job_id):
+            return None
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        try:
+            with open(self._state_path(job_id)) as f:
+                return Job.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    async def events(self, job: Job) -> AsyncIterator[Optional[Event]]:
+        """
+        Follows a job: a preview of the result, its status and progress,
+        and finally a done or failed event. Jobs running in another worker
+        process are followed through their stored state, without a preview
+        or progress events.
+
+        Args:
+            job: The job
+
+        Yields:
+            Optional[Event]: The events, or None when a keep-alive is due
+        """
+        channel = self._channels.get(job.id)
+        if channel is not None:
+            channel.request_preview()
+            async for event in channel.listen():
+                yield event
+            if channel.events and channel.events[-1][0] in ("done", "failed"):
+                return
+            job = self.get(job.id) or job
+
+        status = None
+        idle = 0.0
+        while True:
+            if job.status != status:
+                status = job.status
+                idle = 0.0
+                yield "status", {"status": status}
+            if job.status in (SUCCEEDED, FAILED):
+                yield job.final_event()
+                return
+            if idle >= PROGRESS_KEEPALIVE_SECONDS:
+                idle = 0.0
+                yield None
+            await asyncio.sleep(JOB_EVENTS_POLL_SECONDS)
+            idle += JOB_EVENTS_POLL_SECONDS
+            job = self.get(job.id)
+            if job is None:
+                yield "failed", {"status": FAILED, "error": "Job has expired"}
+                return
+
+    async def get_result(self, job: Job) -> Optional[UpscaleResult]:
+        """
+        Gets the result of a finished job without loading it into memory.
+
+        Args:
+            job: The job
+
+        Returns:
+            Optional[UpscaleResult]: The result, or None if it is not available
+        """
+        if job.status != SUCCEEDED:
+            return None
+
+        def read() -> Optional[UpscaleResult]:
+            try:
+                return UpscaleResult.from_shared_file(self._result_path(job.id))
+            except OSError:
+                return None
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, read)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns queue and worker statistics.
+
+        Returns:
+            Dict[str, Any]: The job statistics
+        """
+        return {
+            "workers": self.workers,
+            "running": self._running,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "queue_size": self.queue_size,
+            "retained_jobs": len(self._jobs),
+            "event_channels": len(self._channels),
+            "cancelled": self._cancelled,
+        }
+
+    async def _finish(self, job: Job, result: Optional[UpscaleResult], error: Optional[str], retain: bool) -> None:
+        job.finished_at = time.time()
+        if error or result is None or result.size == 0:
+            job.status = FAILED
+            job.error = error or "The AI service returned an empty result."
+        else:
+            job.status = SUCCEEDED
+            job.result_size = result.size
+            job.plan = result.plan
+        if retain:
+            await self._save(job, result if job.status == SUCCEEDED else None)
+        # Published once the result is stored, so the result URL works
+        channel = self._channels.pop(job.id, None)
+        if channel is not None:
+            channel.publish(*job.final_event())
+            channel.close()
+
+    async def _failed(self, job: Job, on_failure: Optional[FailureHook]) -> None:
+        if on_failure is not None:
+            try:
+                await on_failure(job)
+            except Exception as e:
+                logger.error(f"Error in failure hook for job {job.id}: {str(e)}")
+
+    async def _upscale(
+        self,
+        image_data: bytes,
+        job: Job,
+        future: Optional[asyncio.Future]
+    ) -> Tuple[Optional[UpscaleResult], Optional[str]]:
+        # Runs the upscale as its own task, so that it can be cancelled when
+        # the caller waiting for it goes away without stopping this worker.
+        # The task copies the context, and with it the job's event channel.
+        token = current_channel.set(self._channels.get(job.id))
+        try:
+            work = asyncio.ensure_future(ImageProcessor.upscale_image(image_data, **job.params))
+        finally:
+            current_channel.reset(token)
+        if future is not None:
+            future.add_done_callback(lambda future: work.cancel() if future.cancelled() else None)
+        try:
+            await asyncio.wait({work})
+        except asyncio.CancelledError:
+            work.cancel()
+            raise
+        if work.cancelled():
+            self._cancelled += 1
+            return None, "Cancelled because the client disconnected"
+        return work.result()
+
+    async def _worker(self) -> None:
+        while True:
+            job, image_data, future, on_success, on_failure = await self._queue.get()
+            retain = future is None
+            if future is not None and future.cancelled():
+                self._cancelled += 1
+                continue
+
+            job.status = RUNNING
+            job.started_at = time.time()
+            channel = self._channels.get(job.id)
+            if channel is not None:
+                channel.publish("status", {"status": RUNNING})
+            metrics.observe("queue_wait", job.started_at - job.created_at)
+            self._running += 1
+            try:
+                if retain:
+                    await self._save(job)
+                with metrics.timed("upscale"):
+                    result, error = await self._upscale(image_data, job, future)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error running job {job.id}: {str(e)}")
+                result, error = None, f"Error processing image: {str(e)}"
+            finally:
+                self._running -= 1
+                # Drop our reference to the input as soon as possible
+                image_data = None
+
+            await self._finish(job, result, error, retain)
+            if future is not None:
+                if not future.done():
+                    future.set_result((result, job.error))
+                elif result is not None:
+                    # The caller went away; nobody will send this result
+                    result.close()
+            if job.status == SUCCEEDED and on_success is not None:
+                try:
+                    await on_success(job, result)
+                except Exception as e:
+                    logger.error(f"Error in completion hook for job {job.id}: {str(e)}")
+            elif job.status == FAILED:
+                await self._failed(job, on_failure)
+            if retain and result is not None:
+                # The job store has its own copy of the result now
+                result.close()
+
+    async def _sweeper(self) -> None:
+        while True:
+            await asyncio.sleep(JOB_SWEEP_INTERVAL_SECONDS)
+            cutoff = time.time() - JOB_TTL_SECONDS
+            for job_id, job in list(self._jobs.items()):
+                if job.finished_at is not None and job.finished_at < cutoff:
+                    del self._jobs[job_id]
+
+            def sweep_disk() -> int:
+                removed = 0
+                for name in os.listdir(self.directory):
+                    path = os.path.join(self.directory, name)
+                    try:
+                        if os.stat(path).st_mtime < cutoff:
+                            os.unlink(path)
+                            removed += 1
+                    except OSError:
+                        pass
+                return removed
+
+            try:
+                loop = asyncio.get_running_loop()
+                removed = await loop.run_in_executor(None, sweep_disk)
+                if removed:
+                    logger.info(f"Removed {removed} expired job files")
+            except OSError as e:
+                logger.error(f"Error sweeping expired jobs: {str(e)}")
+
+
+# Shared job manager
+job_manager = JobManager()
+metrics.register_collector("jobs", job_manager.stats)
@@ -0,0 +1,261 @@
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import random
+import atexit
+import logging
+import threading
+import contextvars
+import logging.handlers
+from typing import Optional, Dict, Any
+from dotenv import load_dotenv
+
+try:
+    from . import metrics
+except ImportError:
+    from backend import metrics
+
+# Load environment variables
+load_dotenv()
+
+# Configuration
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# text for people, json for log aggregators
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+# Records waiting for the writer thread; further records are dropped
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Fraction of records below WARNING kept per logger, e.g.
+# "backend.auth=0.01,backend.main=0.1". Child loggers inherit the rate.
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "")
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(request_id)s - %(message)s"
+REQUEST_ID_HEADER = b"x-request-id"
+
+# The ID of the request being handled, for correlating its log records
+request_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+
+# Attributes of every LogRecord; anything else was passed with extra=
+_RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id", "sample_rate"}
+
+_lock = threading.Lock()
+_handler: Optional["_QueueHandler"] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+_stats = {"queued": 0, "dropped": 0, "sampled_out": 0}
+
+
+def parse_sampling(text: str) -> Dict[str, float]:
+    """
+    Parses LOG_SAMPLING into logger name -> fraction of records kept.
+    """
+    rates = {}
+    for part in text.split(","):
+        name, _, rate = part.partition("=")
+        if name.strip() and rate.strip():
+            rates[name.strip()] = min(1.0, max(0.0, float(rate)))
+    return rates
+
+
+class _ContextFilter(logging.Filter):
+    """
+    Stamps records with the current request ID and samples high-volume
+    loggers. Runs in the thread that logged, before the record is queued.
+    Warnings and errors are never sampled out.
+    """
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self._resolved: Dict[str, float] = {}
+
+    def _rate(self, name: str) -> float:
+        rate = self._resolved.get(name)
+        if rate is None:
+            # The most specific configured ancestor wins
+            rate, prefix = 1.0, name
+            while prefix:
+                if prefix in self.rates:
+                    rate = self.rates[prefix]
+                    break
+                prefix = prefix.rpartition(".")[0]
+            self._resolved[name] = rate
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING and self.rates:
+            rate = self._rate(record.name)
+            if rate < 1.0:
+                if random.random() >= rate:
+                    _stats["sampled_out"] += 1
+                    return False
+                record.sample_rate = rate
+        record.request_id = request_id.get()
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the writer thread without formatting them and drops
+    them rather than block when the queue is full.
+
+    Records are queued as they are, so the message is built from its
+    arguments on the writer thread. Pass immutable values (or a copy) as
+    log arguments.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+            _stats["queued"] += 1
+        except queue.Full:
+            _stats["dropped"] += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as one JSON object per line, including any fields
+    passed with extra=.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        document: Dict[str, Any] = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "pid": record.process,
+        }
+        if getattr(record, "request_id", None):
+            document["request_id"] = record.request_id
+        if getattr(record, "sample_rate", None):
+            document["sample_rate"] = record.sample_rate
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                document[key] = value
+        if record.exc_info:
+            document["exception"] = self.formatException(record.exc_info)
+        return json.dumps(document, default=str)
+
+    def formatTime(self, record: logging.LogRecord, datefmt: Optional[str] = None) -> str:
+        return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z"
+
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        if getattr(record, "request_id", None) is None:
+            record.request_id = "-"
+        return super().format(record)
+
+
+def _output_handler() -> logging.Handler:
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else _TextFormatter(TEXT_FORMAT))
+    return handler
+
+
+def _start_listener() -> None:
+    global _listener
+    log_queue: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+    _handler.queue = log_queue
+    _listener = logging.handlers.QueueListener(log_queue, _output_handler(), respect_handler_level=False)
+    _listener.start()
+
+
+def _after_fork_in_child() -> None:
+    # The writer thread does not survive fork; give the child its own
+    if _handler is not None:
+        _start_listener()
+
+
+def configure_logging() -> None:
+    """
+    Routes all logging through a queue to a background writer thread.
+    Safe to call more than once; only the first call has an effect.
+    """
+    global _handler
+    with _lock:
+        if _handler is not None:
+            return
+
+        # Skip looking up the caller's file and line and the process name
+        # for every record; neither is part of the output
+        logging._srcfile = None
+        logging.logMultiprocessing = False
+
+        _handler = _QueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        _handler.addFilter(_ContextFilter(parse_sampling(LOG_SAMPLING)))
+        _start_listener()
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(_handler)
+        root.setLevel(LOG_LEVEL)
+
+        atexit.register(shutdown_logging)
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def shutdown_logging() -> None:
+    """
+    Writes out the queued records and stops the writer thread.
+    """
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+class RequestIdMiddleware:
+    """
+    ASGI middleware that gives each request an ID for its log records,
+    taken from the X-Request-ID header when the client or proxy sent one,
+    and echoes it in the response.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        current = None
+        for name, value in scope["headers"]:
+            if name == REQUEST_ID_HEADER:
+                # Bound what a client can inject into the logs
+                current = value.decode("latin-1")[:64]
+                break
+        if not current:
+            current = uuid.uuid4().hex
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [
+                    (REQUEST_ID_HEADER, current.encode("latin-1"))
+                ]
+            await send(message)
+
+        token = request_id.set(current)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            request_id.reset(token)
+
+
+def stats() -> Dict[str, int]:
+    return {
+        **_stats,
+        "queue_depth": _handler.queue.qsize() if _handler is not None else 0,
+    }
+
+
+metrics.register_collector("logging", stats)
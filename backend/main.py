@@ -1,33 +1,61 @@
 from dotenv import load_dotenv
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, status, Form, Query
+from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, status, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, Response
-from typing import Optional, List, Dict, Any
+from fastapi.responses import JSONResponse, Response, StreamingResponse, PlainTextResponse
+from starlette.requests import ClientDisconnect
+from typing import Optional, List, Dict, Awaitable, TypeVar
 import os
+import time
+import asyncio
 import logging
-import sys
 
 # Try relative imports first
 try:
-    from .image_processor import ImageProcessor, VALID_MODES, VALID_SCALE_FACTORS, VALID_OUTPUT_FORMATS, MODE_TO_MODEL
+    from .image_processor import VALID_MODES, VALID_SCALE_FACTORS, VALID_OUTPUT_FORMATS
     from .auth import get_current_active_user, User
-    from .database import DatabaseHandler
+    from .database import DatabaseHandler, usage_aggregator, shutdown_executor as shutdown_database, warm_up as warm_up_database
+    from .upload import UploadLimitMiddleware, ingest_upload
+    from .jobs import job_manager, QueueFullError, SUCCEEDED
+    from .batch import Batch, BATCH_MAX_FILES
+    from .payment import usage_meter, warm_up as warm_up_stripe
+    from .storage_queue import storage_queue
+    from .quota import quota, Reservation
+    from .tiled_upscaler import shutdown_pool
+    from .cpu_pool import cpu_pool
+    from .results import UpscaleResult, ResultResponse, media_type_for, sweep_spool
+    from .progress import format_event
+    from .logging_config import configure_logging, RequestIdMiddleware
+    from . import metrics, http_client
 except ImportError as e:
     # Fall back to absolute imports
-    from backend.image_processor import ImageProcessor, VALID_MODES, VALID_SCALE_FACTORS, VALID_OUTPUT_FORMATS, MODE_TO_MODEL
+    from backend.image_processor import VALID_MODES, VALID_SCALE_FACTORS, VALID_OUTPUT_FORMATS
     from backend.auth import get_current_active_user, User
-    from backend.database import DatabaseHandler
+    from backend.database import DatabaseHandler, usage_aggregator, shutdown_executor as shutdown_database, warm_up as warm_up_database
+    from backend.upload import UploadLimitMiddleware, ingest_upload
+    from backend.jobs import job_manager, QueueFullError, SUCCEEDED
+    from backend.batch import Batch, BATCH_MAX_FILES
+    from backend.payment import usage_meter, warm_up as warm_up_stripe
+    from backend.storage_queue import storage_queue
+    from backend.quota import quota, Reservation
+    from backend.tiled_upscaler import shutdown_pool
+    from backend.cpu_pool import cpu_pool
+    from backend.results import UpscaleResult, ResultResponse, media_type_for, sweep_spool
+    from backend.progress import format_event
+    from backend.logging_config import configure_logging, RequestIdMiddleware
+    from backend import metrics, http_client
 
 # Load environment variables
 load_dotenv()
 
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-)
+configure_logging()
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+# Seconds between attempts to create a client that failed to warm up
+WARM_UP_RETRY_SECONDS = float(os.getenv("WARM_UP_RETRY_SECONDS", "5"))
+
 app = FastAPI(
     title="Upscalor API",
     description="AI Image Upscaler API",
@@ -39,7 +67,11 @@ cors_origins_str = os.getenv("CORS_ORIGINS", "http://localhost:3000,http://127.0
 cors_origins = [origin.strip() for origin in cors_origins_str.split(",")]
 
 # Log the allowed origins for debugging
-logger.info(f"CORS allowed origins: {cors_origins}")
+logger.info("CORS allowed origins: %s", cors_origins)
+
+# Reject oversized uploads while the body is still arriving.
+# Added before CORS so that 413 responses still carry CORS headers.
+app.add_middleware(UploadLimitMiddleware)
 
 # Add CORS middleware
 app.add_middleware(
@@ -48,9 +80,12 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["Content-Disposition", "Content-Length"],
+    expose_headers=["Content-Disposition", "Content-Length", "X-Request-ID"],
 )
 
+# Outermost, so every log record of a request carries its ID
+app.add_middleware(RequestIdMiddleware)
+
 @app.get("/")
 async def root():
     return {"message": "Welcome to Upscalor API - AI Image Upscaler"}
@@ -59,8 +94,225 @@ async def root():
 async def health_check():
     return {"status": "healthy"}
 
+@app.get("/ready")
+async def readiness_check():
+    """
+    Readiness probe. Returns 503 until this worker has started and its
+    external clients are warm, so traffic only reaches workers that can
+    serve it without paying for client setup.
+    """
+    ready = all(_warmed.values())
+    return JSONResponse(
+        status_code=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"status": "ready" if ready else "starting", "clients": dict(_warmed)},
+    )
+
+@app.get("/stats")
+async def get_stats():
+    """
+    Get pipeline counters for monitoring.
+    
+    Returns:
+        dict: Bytes handled and copied per pipeline stage
+    """
+    return metrics.snapshot()
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Get pipeline metrics for Prometheus to scrape.
+    
+    Each worker process keeps its own metrics, so every scrape reports the
+    worker that served it.
+    
+    Returns:
+        Stage latency histograms, in-flight gauges, byte and event counters,
+        and cache, pool and queue statistics in the text exposition format
+    """
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+def _validate_upscale_request(
+    scale_factor: int,
+    mode: str,
+    dynamic: int,
+    creativity: float,
+    resemblance: float,
+    output_format: str,
+    current_user: Optional[User]
+) -> None:
+    """
+    Validates upscale parameters and the user's plan features. Monthly and
+    rate limits are checked by the quota service.
+    
+    Raises:
+        HTTPException: If a parameter is invalid or the plan does not allow the request
+    """
+    if scale_factor not in VALID_SCALE_FACTORS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid scale factor. Must be one of: {VALID_SCALE_FACTORS}"
+        )
+    
+    if mode not in VALID_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid mode. Must be one of: {VALID_MODES}"
+        )
+    
+    if output_format not in VALID_OUTPUT_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid output format. Must be one of: {VALID_OUTPUT_FORMATS}"
+        )
+    
+    if dynamic < 1 or dynamic > 50:
+        raise HTTPException(
+            status_code=400,
+            detail="Dynamic range must be between 1 and 50"
+        )
+    
+    if creativity < 0 or creativity > 1:
+        raise HTTPException(
+            status_code=400,
+            detail="Creativity must be between 0 and 1"
+        )
+    
+    if resemblance < 0 or resemblance > 3:
+        raise HTTPException(
+            status_code=400,
+            detail="Resemblance must be between 0 and 3"
+        )
+    
+    # Check user subscription for pro features
+    if current_user and current_user.subscription_tier == "free":
+        if scale_factor > 2:
+            raise HTTPException(
+                status_code=403,
+                detail="Scale factors above 2x are only available on the Pro plan"
+            )
+
+async def _record_usage(
+    current_user: Optional[User],
+    reservation: Reservation,
+    result: UpscaleResult,
+    filename: Optional[str]
+) -> None:
+    """
+    Counts a processed image against the user's quota and stores the
+    result for pro users.
+    """
+    reservation.commit()
+    if not current_user:
+        return
+    
+    logger.debug("Incrementing processed images count for user: %s", current_user.username)
+    with metrics.timed("record_usage"):
+        await DatabaseHandler.increment_processed_images(current_user.username)
+    await _store_result(current_user, result, filename)
+
+async def _store_result(current_user: Optional[User], result: UpscaleResult, filename: Optional[str]) -> None:
+    """
+    Queues the result for storage for pro users. The upload happens in the
+    background, after the response has been sent.
+    """
+    if current_user and current_user.subscription_tier == "pro":
+        logger.debug("Queueing image storage for pro user: %s", current_user.username)
+        with metrics.timed("store_enqueue"):
+            await storage_queue.enqueue(
+                current_user.username,
+                result,
+                f"upscaled_{filename}"
+            )
+
+def _queue_full() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="The server is busy. Please try again shortly.",
+        headers={"Retry-After": "5"},
+    )
+
+async def _unless_disconnected(request: Request, awaitable: Awaitable[T]) -> T:
+    """
+    Awaits `awaitable`, cancelling it if the client disconnects first, so
+    that nobody waits on the model or the CPU pool for a response that
+    cannot be delivered. Only for use once the request body has been read.
+    
+    Raises:
+        ClientDisconnect: If the client disconnected
+    """
+    work = asyncio.ensure_future(awaitable)
+    
+    async def watch() -> None:
+        while (await request.receive())["type"] != "http.disconnect":
+            pass
+    
+    watcher = asyncio.ensure_future(watch())
+    try:
+        done, _ = await asyncio.wait({work, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not work.done():
+            work.cancel()
+    if work not in done:
+        metrics.count("client_disconnects")
+        raise ClientDisconnect()
+    return work.result()
+
+# External clients are created after startup, in the background; /ready
+# reports which of them are warm
+WARM_UP_STEPS = {
+    "database": warm_up_database,
+    "stripe": warm_up_stripe,
+    "http": http_client.warm_up,
+}
+_warmed: Dict[str, bool] = {name: False for name in WARM_UP_STEPS}
+_warm_up_task: Optional[asyncio.Task] = None
+
+async def _warm_up() -> None:
+    pending = dict(WARM_UP_STEPS)
+    while pending:
+        for name, warm_up in list(pending.items()):
+            try:
+                await warm_up()
+            except Exception as e:
+                logger.error("Error warming up the %s client, will retry: %s", name, e)
+                continue
+            _warmed[name] = True
+            del pending[name]
+        if pending:
+            await asyncio.sleep(WARM_UP_RETRY_SECONDS)
+    logger.info("Worker ready")
+
+@app.on_event("startup")
+async def startup():
+    global _warm_up_task
+    # Clear out result spool files left behind by killed workers
+    sweep_spool(max_age_seconds=3600)
+    await job_manager.start()
+    await usage_aggregator.start()
+    await quota.start()
+    await usage_meter.start()
+    await storage_queue.start()
+    _warm_up_task = asyncio.create_task(_warm_up())
+
+@app.on_event("shutdown")
+async def shutdown():
+    if _warm_up_task is not None:
+        _warm_up_task.cancel()
+    await job_manager.stop()
+    await quota.stop()
+    # Write buffered usage before the database pool goes away
+    await usage_aggregator.stop()
+    await usage_meter.stop()
+    await storage_queue.stop()
+    await http_client.close_client()
+    shutdown_pool()
+    cpu_pool.shutdown()
+    shutdown_database()
+
 @app.post("/upscale")
 async def upscale_image(
+    request: Request,
     file: UploadFile = File(...),
     scale_factor: int = Form(2),
     mode: str = Form("block_mode"),
@@ -86,91 +338,61 @@ async def upscale_image(
         current_user: The authenticated user
         
     Returns:
-        The upscaled image
+        The upscaled image, streamed with Range support
     """
+    reservation = None
+    started = time.perf_counter()
     try:
-        logger.info(f"Upscale request received from user: {current_user.username if current_user else 'anonymous'}")
-        logger.info(f"Parameters: scale_factor={scale_factor}, mode={mode}, dynamic={dynamic}, handfix={handfix}, creativity={creativity}, resemblance={resemblance}, output_format={output_format}")
-        
-        # Validate parameters
-        if scale_factor not in VALID_SCALE_FACTORS:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Invalid scale factor. Must be one of: {VALID_SCALE_FACTORS}"
-            )
-        
-        if mode not in VALID_MODES:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Invalid mode. Must be one of: {VALID_MODES}"
-            )
-        
-        if output_format not in VALID_OUTPUT_FORMATS:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Invalid output format. Must be one of: {VALID_OUTPUT_FORMATS}"
-            )
-        
-        if dynamic < 1 or dynamic > 50:
-            raise HTTPException(
-                status_code=400,
-                detail="Dynamic range must be between 1 and 50"
-            )
-        
-        if creativity < 0 or creativity > 1:
-            raise HTTPException(
-                status_code=400,
-                detail="Creativity must be between 0 and 1"
-            )
+        logger.info("Upscale request received from user: %s", current_user.username if current_user else "anonymous")
+        logger.debug(
+            "Parameters: scale_factor=%s, mode=%s, dynamic=%s, handfix=%s, creativity=%s, resemblance=%s, output_format=%s",
+            scale_factor, mode, dynamic, handfix, creativity, resemblance, output_format
+        )
         
-        if resemblance < 0 or resemblance > 3:
-            raise HTTPException(
-                status_code=400,
-                detail="Resemblance must be between 0 and 3"
-            )
+        _validate_upscale_request(scale_factor, mode, dynamic, creativity, resemblance, output_format, current_user)
         
-        # Check user subscription for pro features
-        if current_user and current_user.subscription_tier == "free":
-            if scale_factor > 2:
-                raise HTTPException(
-                    status_code=403,
-                    detail="Scale factors above 2x are only available on the Pro plan"
-                )
-            
-            # Check if the user has reached their monthly limit
-            if current_user.images_processed_this_month >= 3:  # Free tier limit
-                raise HTTPException(
-                    status_code=403,
-                    detail="You have reached your monthly limit of 3 images. Please upgrade to the Pro plan."
-                )
+        # Admitted from memory; released below unless the image is counted
+        reservation = await quota.admit(current_user)
         
-        # Read the file
-        contents = await file.read()
+        # Stream the upload, enforcing the size limit while hashing and probing it
+        upload = await ingest_upload(file)
         
         # Log file information
-        logger.info(f"File received: {file.filename}, size: {len(contents)} bytes, content-type: {file.content_type}")
-        
-        # Process the image
-        logger.info(f"Processing image with Replicate API using mode: {mode}")
-        processed_image, error = await ImageProcessor.upscale_image(
-            contents,
-            scale_factor,
-            mode,
-            dynamic,
-            handfix,
-            creativity,
-            resemblance,
-            output_format
+        logger.info(
+            "File received: %s, size: %d bytes, format: %s %dx%d, content-type: %s",
+            upload.filename, upload.size, upload.format, upload.width, upload.height, upload.content_type
         )
         
+        contents = await upload.read()
+        
+        # Process the image on the shared worker pool
+        logger.debug("Processing image using mode: %s", mode)
+        try:
+            result, error = await _unless_disconnected(request, job_manager.run(
+                current_user.username if current_user else None,
+                contents,
+                {
+                    "scale_factor": scale_factor,
+                    "mode": mode,
+                    "dynamic": dynamic,
+                    "handfix": handfix,
+                    "creativity": creativity,
+                    "resemblance": resemblance,
+                    "output_format": output_format,
+                    "content_hash": upload.sha256,
+                }
+            ))
+        except QueueFullError:
+            raise _queue_full()
+        
         if error:
-            logger.error(f"Error processing image with Replicate API: {error}")
+            logger.error("Error processing image: %s", error)
             raise HTTPException(
                 status_code=500,
                 detail=f"AI service error: {error}. Please try again or use a different image."
             )
         
-        if not processed_image or len(processed_image) == 0:
+        if result is None or result.size == 0:
             logger.error("Processed image is empty or None")
             raise HTTPException(
                 status_code=500,
@@ -178,38 +400,271 @@ async def upscale_image(
             )
         
         # Log success
-        logger.info(f"Image successfully processed with Replicate API. Output size: {len(processed_image)} bytes")
+        logger.info("Image successfully processed. Output size: %d bytes", result.size)
         
-        # Update user's processed images count if authenticated
-        if current_user:
-            logger.info(f"Incrementing processed images count for user: {current_user.username}")
-            await DatabaseHandler.increment_processed_images(current_user.username)
-            
-            # Store the image for pro users
-            if current_user.subscription_tier == "pro":
-                logger.info(f"Storing image for pro user: {current_user.username}")
-                image_url = await DatabaseHandler.store_image(
-                    current_user.username,
-                    processed_image,
-                    f"upscaled_{file.filename}"
-                )
+        try:
+            # Update user's processed images count if authenticated
+            await _record_usage(current_user, reservation, result, upload.filename)
+        except BaseException:
+            result.close()
+            raise
         
-        # Return the processed image
-        logger.info("Returning processed image to client")
-        return Response(
-            content=processed_image,
-            media_type=f"image/{output_format}"
+        # Stream the processed image from memory or its spool file
+        logger.debug("Returning processed image to client")
+        return ResultResponse(
+            result,
+            media_type=media_type_for(output_format),
+            range_header=request.headers.get("range"),
+            if_range=request.headers.get("if-range")
         )
     except HTTPException as e:
         # Re-raise HTTP exceptions
-        logger.warning(f"HTTP exception in upscale_image: {e.detail}")
+        logger.warning("HTTP exception in upscale_image: %s", e.detail)
         raise
+    except ClientDisconnect:
+        # Nobody is left to send a response to
+        logger.info("Client disconnected; upscale cancelled")
+        return Response(status_code=499)
     except Exception as e:
         logger.error(f"Error upscaling image: {str(e)}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error processing image: {str(e)}",
         )
+    finally:
+        if reservation is not None:
+            reservation.release()
+        metrics.observe("upscale_request", time.perf_counter() - started)
+
+@app.post("/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def create_job(
+    file: UploadFile = File(...),
+    scale_factor: int = Form(2),
+    mode: str = Form("block_mode"),
+    dynamic: int = Form(25),
+    handfix: bool = Form(False),
+    creativity: float = Form(0.5),
+    resemblance: float = Form(1.5),
+    output_format: str = Form("png"),
+    current_user: Optional[User] = Depends(get_current_active_user),
+):
+    """
+    Submit an upscale job and return immediately.
+    
+    Takes the same parameters as /upscale. Poll GET /jobs/{job_id} for the
+    status, or follow GET /jobs/{job_id}/events for a preview and live
+    progress, and fetch the image from GET /jobs/{job_id}/result.
+    
+    Returns:
+        dict: The job ID and its status
+    """
+    _validate_upscale_request(scale_factor, mode, dynamic, creativity, resemblance, output_format, current_user)
+    
+    reservation = await quota.admit(current_user)
+    try:
+        upload = await ingest_upload(file)
+        contents = await upload.read()
+    except BaseException:
+        reservation.release()
+        raise
+    filename = upload.filename
+    
+    async def on_success(job, result: UpscaleResult) -> None:
+        await _record_usage(current_user, reservation, result, filename)
+    
+    async def on_failure(job) -> None:
+        reservation.release()
+    
+    try:
+        job = await job_manager.submit(
+            current_user.username if current_user else None,
+            contents,
+            {
+                "scale_factor": scale_factor,
+                "mode": mode,
+                "dynamic": dynamic,
+                "handfix": handfix,
+                "creativity": creativity,
+                "resemblance": resemblance,
+                "output_format": output_format,
+                "content_hash": upload.sha256,
+            },
+            on_success=on_success,
+            on_failure=on_failure
+        )
+    except QueueFullError:
+        reservation.release()
+        raise _queue_full()
+    
+    logger.info("Job %s queued for user: %s", job.id, current_user.username if current_user else "anonymous")
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/jobs/{job.id}",
+        "events_url": f"/jobs/{job.id}/events",
+        "result_url": f"/jobs/{job.id}/result",
+    }
+
+def _get_owned_job(job_id: str, current_user: Optional[User]):
+    job = job_manager.get(job_id)
+    if job is None or job.owner != (current_user.username if current_user else None):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, current_user: Optional[User] = Depends(get_current_active_user)):
+    """
+    Get the status of an upscale job.
+    
+    Returns:
+        dict: The job status
+    """
+    job = _get_owned_job(job_id, current_user)
+    info = job.to_dict()
+    del info["owner"]
+    return info
+
+@app.get("/jobs/{job_id}/events")
+async def get_job_events(job_id: str, current_user: Optional[User] = Depends(get_current_active_user)):
+    """
+    Follow an upscale job as a stream of server-sent events.
+    
+    Events:
+        preview: A quick local preview of the result (width, height, data_url)
+        status: The job status (queued, running)
+        progress: The stage reached (planned, uploaded, predicting,
+            downloading, encoding, cached, fallback)
+        done: The result_url, media_type and result_size
+        failed: The error
+    
+    Returns:
+        A text/event-stream response that ends after done or failed
+    """
+    job = _get_owned_job(job_id, current_user)
+    metrics.count("job_event_streams")
+    
+    async def stream():
+        async for event in job_manager.events(job):
+            yield format_event(event)
+    
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        # Proxies must pass each event on as soon as it is sent
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(
+    job_id: str,
+    request: Request,
+    current_user: Optional[User] = Depends(get_current_active_user)
+):
+    """
+    Get the upscaled image of a finished job.
+    
+    Supports Range and If-Range requests so interrupted downloads can resume.
+    
+    Returns:
+        The upscaled image, or 409 if the job has not succeeded
+    """
+    job = _get_owned_job(job_id, current_user)
+    if job.status != SUCCEEDED:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=job.error if job.error else f"Job is {job.status}"
+        )
+    
+    result = await job_manager.get_result(job)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Job result has expired")
+    
+    return ResultResponse(
+        result,
+        media_type=job.media_type,
+        range_header=request.headers.get("range"),
+        if_range=request.headers.get("if-range"),
+        etag=f'"{job.id}-{result.size}"'
+    )
+
+@app.post("/batch")
+async def upscale_batch(
+    files: List[UploadFile] = File([]),
+    archive: Optional[UploadFile] = File(None),
+    scale_factor: int = Form(2),
+    mode: str = Form("block_mode"),
+    dynamic: int = Form(25),
+    handfix: bool = Form(False),
+    creativity: float = Form(0.5),
+    resemblance: float = Form(1.5),
+    output_format: str = Form("png"),
+    current_user: Optional[User] = Depends(get_current_active_user),
+):
+    """
+    Upscale many images at once.
+    
+    Takes any number of image files, a ZIP archive of images, or both, and
+    the same parameters as /upscale. Images are processed in parallel and
+    the results are streamed back as a ZIP archive, in the order they
+    finish, followed by manifest.json with the status of every image.
+    
+    Returns:
+        A ZIP archive of the upscaled images
+    """
+    _validate_upscale_request(scale_factor, mode, dynamic, creativity, resemblance, output_format, current_user)
+    
+    batch = Batch(
+        current_user.username if current_user else None,
+        {
+            "scale_factor": scale_factor,
+            "mode": mode,
+            "dynamic": dynamic,
+            "handfix": handfix,
+            "creativity": creativity,
+            "resemblance": resemblance,
+            "output_format": output_format,
+        },
+        on_success=lambda item, result: _store_result(current_user, result, os.path.basename(item.filename))
+    )
+    try:
+        for file in files:
+            batch.add_file(file)
+        if archive is not None:
+            batch.add_archive(archive)
+        
+        if not batch.items:
+            raise HTTPException(status_code=400, detail="No images were uploaded")
+        
+        if len(batch.items) > BATCH_MAX_FILES:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Too many images. A batch can contain at most {BATCH_MAX_FILES} images."
+            )
+        
+        # The quota is checked once for the whole batch
+        reservation = await quota.admit(current_user, len(batch.items))
+    except BaseException:
+        batch.close()
+        raise
+    
+    async def stream():
+        try:
+            async for chunk in batch.stream():
+                yield chunk
+        finally:
+            # Counted for the images written to the archive, even if the
+            # client goes away before the rest of it is sent
+            reservation.commit(batch.succeeded)
+            if current_user and batch.succeeded:
+                logger.debug("Incrementing processed images count for user: %s by %d", current_user.username, batch.succeeded)
+                await DatabaseHandler.increment_processed_images(current_user.username, batch.succeeded)
+    
+    logger.info("Batch of %d images received from user: %s", len(batch.items), current_user.username if current_user else "anonymous")
+    return StreamingResponse(
+        stream(),
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="upscaled.zip"'}
+    )
 
 @app.get("/upscale/options")
 async def get_upscale_options():
@@ -220,7 +675,7 @@ async def get_upscale_options():
         dict: Available modes, scale factors, and output formats
     """
     try:
-        logger.info("Fetching upscale options")
+        logger.debug("Fetching upscale options")
         
         # Define mode descriptions for better user understanding
         mode_descriptions = {
@@ -242,7 +697,6 @@ async def get_upscale_options():
             "api_version": "1.1.0"
         }
         
-        logger.info(f"Returning upscale options: {options}")
         return options
     except Exception as e:
         logger.error(f"Error getting upscale options: {str(e)}")
@@ -257,21 +711,8 @@ async def get_usage(current_user: User = Depends(get_current_active_user)):
     Get the user's API usage statistics.
     """
     try:
-        user = await DatabaseHandler.get_user(current_user.username)
-        
-        if not user:
-            raise HTTPException(
-                status_code=404,
-                detail="User not found"
-            )
-        
-        return {
-            "usage": {
-                "subscription_tier": user.get("subscription_tier", "free"),
-                "images_processed_this_month": user.get("images_processed_this_month", 0),
-                "max_images_per_month": 3 if user.get("subscription_tier", "free") == "free" else float("inf")
-            }
-        }
+        # Served from the in-memory counters, which are reconciled with the database
+        return {"usage": await quota.usage(current_user)}
     except Exception as e:
         logger.error(f"Error getting usage: {str(e)}")
         raise HTTPException(
@@ -288,7 +729,7 @@ async def get_models_info():
         dict: Information about the available models
     """
     try:
-        logger.info("Fetching models information")
+        logger.debug("Fetching models information")
         
         # Define detailed model information
         models_info = {
@@ -323,7 +764,6 @@ async def get_models_info():
             "version": "1.1.0"
         }
         
-        logger.info(f"Returning models information: {response}")
         return response
     except Exception as e:
         logger.error(f"Error getting models information: {str(e)}")
@@ -0,0 +1,281 @@
+import time
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, Any, List, Tuple
+
+# Per-stage byte counters for the upscale pipeline.
+# "bytes" is the payload size seen by a stage and "copied_bytes" is how much
+# of it the stage had to duplicate in memory or on disk.
+_lock = threading.Lock()
+_stages: Dict[str, Dict[str, int]] = {}
+
+# Components such as caches and pools register a function that returns
+# their current statistics; the results are included in snapshots.
+_collectors: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+# Per-stage latency histograms, in-flight gauges and event counters
+_latencies: Dict[str, "Histogram"] = {}
+_in_flight: Dict[str, int] = {}
+_counters: Dict[str, int] = {}
+
+# Upper bounds of the latency buckets in seconds, from cache hits to model runs
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0,
+)
+
+PROMETHEUS_PREFIX = "upscaloro"
+
+
+class Histogram:
+    """
+    Counts observations into fixed buckets, like a Prometheus histogram.
+    Callers hold the module lock.
+    """
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.bounds = bounds
+        # The last bucket is +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """
+        Returns the upper bound of the bucket holding the q-quantile.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.sum / self.count * 1000, 2) if self.count else 0.0,
+            "p50_ms": self.quantile(0.5) * 1000,
+            "p95_ms": self.quantile(0.95) * 1000,
+            "p99_ms": self.quantile(0.99) * 1000,
+        }
+
+
+def register_collector(name: str, collector: Callable[[], Dict[str, Any]]) -> None:
+    """
+    Registers a function whose statistics are included in snapshots.
+
+    Args:
+        name: The section name in the snapshot
+        collector: A function returning the statistics
+    """
+    _collectors[name] = collector
+
+
+def count_bytes(stage: str, size: int, copied: int = 0) -> None:
+    """
+    Records the bytes handled by a pipeline stage.
+
+    Args:
+        stage: The stage name
+        size: The payload size seen by the stage
+        copied: How many bytes the stage duplicated in memory or on disk,
+            as measured where the copy is made
+    """
+    with _lock:
+        counters = _stages.get(stage)
+        if counters is None:
+            counters = _stages[stage] = {"calls": 0, "bytes": 0, "copied_bytes": 0}
+        counters["calls"] += 1
+        counters["bytes"] += size
+        counters["copied_bytes"] += copied
+
+
+def count(name: str, value: int = 1) -> None:
+    """
+    Adds to an event counter, such as provider fallbacks.
+
+    Args:
+        name: The counter name
+        value: The amount to add
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def _histogram(stage: str) -> Histogram:
+    # Callers hold the lock
+    histogram = _latencies.get(stage)
+    if histogram is None:
+        histogram = _latencies[stage] = Histogram()
+    return histogram
+
+
+def observe(stage: str, seconds: float) -> None:
+    """
+    Records how long one run of a pipeline stage took.
+
+    Args:
+        stage: The stage name
+        seconds: The duration
+    """
+    with _lock:
+        _histogram(stage).observe(seconds)
+
+
+class timed:
+    """
+    Times a block as a pipeline stage and counts it as in flight meanwhile.
+    Works in both sync and async code:
+
+        with metrics.timed("validate"):
+            ...
+    """
+
+    __slots__ = ("stage", "started")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self) -> "timed":
+        with _lock:
+            _in_flight[self.stage] = _in_flight.get(self.stage, 0) + 1
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        elapsed = time.perf_counter() - self.started
+        with _lock:
+            _in_flight[self.stage] -= 1
+            _histogram(self.stage).observe(elapsed)
+
+
+def snapshot() -> Dict[str, Any]:
+    """
+    Returns a copy of the current counters and collector statistics.
+
+    Returns:
+        Dict[str, Any]: The counters per stage and each collector's statistics
+    """
+    with _lock:
+        result: Dict[str, Any] = {
+            "stages": {stage: dict(counters) for stage, counters in _stages.items()},
+            "latency": {stage: histogram.summary() for stage, histogram in _latencies.items()},
+            "in_flight": dict(_in_flight),
+            "counters": dict(_counters),
+        }
+    for name, collector in list(_collectors.items()):
+        result[name] = collector()
+    return result
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _metric_name(*parts: str) -> str:
+    name = "_".join(part for part in parts if part)
+    return "".join(c if c.isalnum() or c == "_" else "_" for c in name)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _collector_lines(name: str, stats: Dict[str, Any]) -> List[str]:
+    # Numbers become gauges; a dict of numbers becomes one gauge per key label
+    lines = []
+    for key, value in stats.items():
+        if isinstance(value, bool):
+            value = int(value)
+        if isinstance(value, (int, float)):
+            metric = _metric_name(PROMETHEUS_PREFIX, name, key)
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {_format_value(value)}")
+        elif isinstance(value, dict):
+            series: Dict[str, List[str]] = {}
+            for label, entry in value.items():
+                fields = entry if isinstance(entry, dict) else {"": entry}
+                for field, number in fields.items():
+                    if isinstance(number, bool):
+                        number = int(number)
+                    if not isinstance(number, (int, float)):
+                        continue
+                    metric = _metric_name(PROMETHEUS_PREFIX, name, key, field)
+                    series.setdefault(metric, []).append(
+                        f'{metric}{{key="{_escape(str(label))}"}} {_format_value(number)}'
+                    )
+            for metric, samples in series.items():
+                lines.append(f"# TYPE {metric} gauge")
+                lines.extend(samples)
+    return lines
+
+
+def render_prometheus() -> str:
+    """
+    Renders every metric in the Prometheus text exposition format.
+
+    Returns:
+        str: The metrics page
+    """
+    with _lock:
+        stages = {stage: dict(counters) for stage, counters in _stages.items()}
+        latencies = {
+            stage: (histogram.bounds, list(histogram.counts), histogram.sum, histogram.count)
+            for stage, histogram in _latencies.items()
+        }
+        in_flight = dict(_in_flight)
+        counters = dict(_counters)
+
+    lines = []
+    metric = f"{PROMETHEUS_PREFIX}_stage_seconds"
+    lines.append(f"# HELP {metric} Time spent in each upscale pipeline stage")
+    lines.append(f"# TYPE {metric} histogram")
+    for stage, (bounds, counts, total, observed) in sorted(latencies.items()):
+        cumulative = 0
+        for bound, bucket_count in zip(bounds + (float("inf"),), counts):
+            cumulative += bucket_count
+            lines.append(f'{metric}_bucket{{stage="{stage}",le="{_format_value(bound)}"}} {cumulative}')
+        lines.append(f'{metric}_sum{{stage="{stage}"}} {_format_value(total)}')
+        lines.append(f'{metric}_count{{stage="{stage}"}} {observed}')
+
+    metric = f"{PROMETHEUS_PREFIX}_stage_in_flight"
+    lines.append(f"# HELP {metric} Pipeline stage runs in progress")
+    lines.append(f"# TYPE {metric} gauge")
+    for stage, value in sorted(in_flight.items()):
+        lines.append(f'{metric}{{stage="{stage}"}} {value}')
+
+    for field, help_text in (
+        ("calls", "Payloads handled by each pipeline stage"),
+        ("bytes", "Bytes handled by each pipeline stage"),
+        ("copied_bytes", "Bytes each pipeline stage copied"),
+    ):
+        metric = f"{PROMETHEUS_PREFIX}_stage_{field}_total"
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} counter")
+        for stage, values in sorted(stages.items()):
+            lines.append(f'{metric}{{stage="{stage}"}} {values[field]}')
+
+    for name, value in sorted(counters.items()):
+        metric = _metric_name(PROMETHEUS_PREFIX, name, "total")
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {value}")
+
+    for name, collector in list(_collectors.items()):
+        lines.extend(_collector_lines(name, collector()))
+
+    return "\n".join(lines) + "\n"
@@ -1,22 +1,30 @@
 import os
+import json
+import time
+import uuid
+import fcntl
+import asyncio
 import logging
-import stripe
-from typing import Optional, Dict, Any
+import tempfile
+import threading
+from typing import Optional, Dict, Any, List, Tuple
 from dotenv import load_dotenv
 from datetime import datetime
 
+try:
+    from . import metrics
+except ImportError:
+    from backend import metrics
+
 # Load environment variables
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-)
 logger = logging.getLogger(__name__)
 
 # Stripe configuration
-stripe.api_key = os.getenv("STRIPE_API_KEY", "your-stripe-api-key")
+STRIPE_API_KEY = os.getenv("STRIPE_API_KEY", "your-stripe-api-key")
+# Point this at the local stand-in (benchmarks/fake_backends.py) to load-test without Stripe
+STRIPE_API_BASE = os.getenv("STRIPE_API_BASE")
 
 # Subscription plan IDs
 SUBSCRIPTION_PLANS = {
@@ -27,6 +35,322 @@ SUBSCRIPTION_PLANS = {
 API_USAGE_PRICE_ID = os.getenv("STRIPE_API_USAGE_PRICE_ID", "price_0987654321")
 API_PRICE_PER_IMAGE = 0.003  # $0.003 per image processed via API
 
+# Usage metering
+# API usage events are appended to hourly log files here and pushed to Stripe in the background
+USAGE_LOG_DIR = os.getenv("USAGE_LOG_DIR", os.path.join(tempfile.gettempdir(), "upscaloro-usage"))
+USAGE_LOG_FSYNC = os.getenv("USAGE_LOG_FSYNC", "false").lower() == "true"
+USAGE_PUSH_INTERVAL_SECONDS = float(os.getenv("USAGE_PUSH_INTERVAL_SECONDS", "60"))
+SUBSCRIPTION_ITEM_CACHE_TTL_SECONDS = float(os.getenv("SUBSCRIPTION_ITEM_CACHE_TTL_SECONDS", "3600"))
+
+USAGE_LOG_PREFIX = "usage-"
+USAGE_LOG_SUFFIX = ".jsonl"
+
+_stripe = None
+_stripe_lock = threading.Lock()
+
+
+def get_stripe():
+    """
+    Returns the configured stripe module, importing it on first use.
+
+    Importing stripe takes a noticeable part of startup and most requests
+    never need it, so it is loaded off the event loop when a worker warms
+    up (see warm_up) or on the first Stripe call.
+
+    Returns:
+        module: The stripe module
+    """
+    global _stripe
+    if _stripe is None:
+        with _stripe_lock:
+            if _stripe is None:
+                import stripe
+
+                stripe.api_key = STRIPE_API_KEY
+                if STRIPE_API_BASE:
+                    stripe.api_base = STRIPE_API_BASE
+                _stripe = stripe
+    return _stripe
+
+
+async def warm_up() -> None:
+    """
+    Imports and configures stripe on a worker thread.
+    """
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, get_stripe)
+
+
+class UsageMeter:
+    """
+    Metered API billing without Stripe calls on the request path.
+    
+    Usage events are appended to an hourly log file on local disk. A
+    background task reads the events added since its last checkpoint, sums
+    them per customer and reports each sum to Stripe with an idempotency
+    key derived from the log range. A push that fails or is interrupted is
+    retried over the same range with the same keys, so Stripe never counts
+    an event twice. Worker processes sharing the directory all append to
+    the log, and a file lock lets only one of them push at a time.
+    """
+    
+    def __init__(self, directory: str = USAGE_LOG_DIR, interval: float = USAGE_PUSH_INTERVAL_SECONDS):
+        self.directory = directory
+        self.interval = interval
+        self._subscription_items: Dict[str, Tuple[float, str]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self._stats = {
+            "events": 0,
+            "pushes": 0,
+            "pushed_customers": 0,
+            "pushed_quantity": 0,
+            "push_errors": 0,
+            "skipped_customers": 0,
+            "subscription_item_hits": 0,
+            "subscription_item_misses": 0,
+        }
+    
+    def _checkpoint_path(self) -> str:
+        return os.path.join(self.directory, "checkpoint.json")
+    
+    def _log_name(self, timestamp: float) -> str:
+        return f"{USAGE_LOG_PREFIX}{time.strftime('%Y%m%d%H', time.gmtime(timestamp))}{USAGE_LOG_SUFFIX}"
+    
+    def record(self, customer_id: str, quantity: int) -> str:
+        """
+        Appends a usage event to the log.
+        
+        Args:
+            customer_id: The Stripe customer ID
+            quantity: The number of images processed
+            
+        Returns:
+            str: The event ID
+        """
+        now = time.time()
+        event = {
+            "id": uuid.uuid4().hex,
+            "customer_id": customer_id,
+            "quantity": quantity,
+            "timestamp": int(now),
+        }
+        line = (json.dumps(event) + "\n").encode("utf-8")
+        os.makedirs(self.directory, exist_ok=True)
+        # A single O_APPEND write keeps lines whole across processes
+        fd = os.open(os.path.join(self.directory, self._log_name(now)), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+            if USAGE_LOG_FSYNC:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        self._stats["events"] += 1
+        return event["id"]
+    
+    def _load_checkpoint(self) -> Dict[str, Any]:
+        try:
+            with open(self._checkpoint_path()) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"offsets": {}, "in_progress": None}
+    
+    def _save_checkpoint(self, checkpoint: Dict[str, Any]) -> None:
+        tmp_path = self._checkpoint_path() + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._checkpoint_path())
+    
+    def _read_range(self, name: str, start: int, end: int) -> Dict[str, Dict[str, int]]:
+        """
+        Sums the events in a byte range of a log file per customer.
+        """
+        totals: Dict[str, Dict[str, int]] = {}
+        with open(os.path.join(self.directory, name), "rb") as f:
+            f.seek(start)
+            data = f.read(end - start)
+        for line in data.splitlines():
+            try:
+                event = json.loads(line)
+            except ValueError:
+                logger.error(f"Skipping corrupt usage event in {name}")
+                continue
+            entry = totals.setdefault(event["customer_id"], {"quantity": 0, "timestamp": 0})
+            entry["quantity"] += int(event["quantity"])
+            entry["timestamp"] = max(entry["timestamp"], int(event["timestamp"]))
+        return totals
+    
+    def _next_batch(self) -> Optional[Dict[str, Any]]:
+        """
+        Returns the next unpushed range of the log and its per-customer
+        totals, resuming an interrupted push first. Fully pushed log files
+        from past hours are deleted.
+        """
+        checkpoint = self._load_checkpoint()
+        batch = checkpoint.get("in_progress")
+        if batch is None:
+            current = self._log_name(time.time())
+            names = sorted(
+                name for name in os.listdir(self.directory)
+                if name.startswith(USAGE_LOG_PREFIX) and name.endswith(USAGE_LOG_SUFFIX)
+            )
+            for name in names:
+                path = os.path.join(self.directory, name)
+                offset = checkpoint["offsets"].get(name, 0)
+                with open(path, "rb") as f:
+                    f.seek(offset)
+                    data = f.read()
+                # Only whole lines; a write may be in progress
+                end = offset + data.rfind(b"\n") + 1
+                if end > offset:
+                    batch = {"file": name, "start": offset, "end": end}
+                    break
+                # Past hours are deleted once pushed and no longer written to
+                if name != current and os.stat(path).st_mtime < time.time() - 60:
+                    os.unlink(path)
+                    checkpoint["offsets"].pop(name, None)
+                    self._save_checkpoint(checkpoint)
+            if batch is None:
+                return None
+            checkpoint["in_progress"] = batch
+            self._save_checkpoint(checkpoint)
+        return {**batch, "totals": self._read_range(batch["file"], batch["start"], batch["end"])}
+    
+    def _complete_batch(self, batch: Dict[str, Any]) -> None:
+        checkpoint = self._load_checkpoint()
+        checkpoint["offsets"][batch["file"]] = batch["end"]
+        checkpoint["in_progress"] = None
+        self._save_checkpoint(checkpoint)
+    
+    async def _subscription_item(self, customer_id: str) -> str:
+        """
+        Returns the customer's metered subscription item, cached for
+        SUBSCRIPTION_ITEM_CACHE_TTL_SECONDS.
+        """
+        cached = self._subscription_items.get(customer_id)
+        if cached is not None and cached[0] > time.monotonic():
+            self._stats["subscription_item_hits"] += 1
+            return cached[1]
+        self._stats["subscription_item_misses"] += 1
+        
+        loop = asyncio.get_running_loop()
+        subscriptions = await loop.run_in_executor(
+            None,
+            lambda: get_stripe().Subscription.list(customer=customer_id, status="active", limit=10)
+        )
+        items = [item for subscription in subscriptions.data for item in subscription["items"].data]
+        if not items:
+            raise ValueError(f"No subscription found for customer {customer_id}")
+        # Prefer the metered API usage price if the customer has several items
+        item_id = next((item.id for item in items if item.price.id == API_USAGE_PRICE_ID), items[0].id)
+        self._subscription_items[customer_id] = (time.monotonic() + SUBSCRIPTION_ITEM_CACHE_TTL_SECONDS, item_id)
+        return item_id
+    
+    async def _push_customer(self, batch: Dict[str, Any], customer_id: str, total: Dict[str, int]) -> None:
+        # Derived from the log range, so a retried push reuses the same keys
+        log_name = batch["file"][:-len(USAGE_LOG_SUFFIX)]
+        idempotency_key = f"{log_name}-{batch['start']}-{batch['end']}-{customer_id}"
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            item_id = await self._subscription_item(customer_id)
+            try:
+                await loop.run_in_executor(
+                    None,
+                    lambda: get_stripe().SubscriptionItem.create_usage_record(
+                        item_id,
+                        quantity=total["quantity"],
+                        timestamp=total["timestamp"],
+                        action="increment",
+                        idempotency_key=idempotency_key,
+                    )
+                )
+                return
+            except get_stripe().error.InvalidRequestError:
+                # The cached item may have been replaced; look it up again once
+                self._subscription_items.pop(customer_id, None)
+                if attempt == 1:
+                    raise
+    
+    async def push(self) -> int:
+        """
+        Reports all logged usage to Stripe.
+        
+        Returns:
+            int: The number of images reported
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        lock = open(os.path.join(self.directory, "push.lock"), "a")
+        try:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # Another worker is pushing
+                return 0
+            
+            loop = asyncio.get_running_loop()
+            pushed = 0
+            while True:
+                batch = await loop.run_in_executor(None, self._next_batch)
+                if batch is None:
+                    return pushed
+                for customer_id, total in batch["totals"].items():
+                    try:
+                        await self._push_customer(batch, customer_id, total)
+                    except (ValueError, get_stripe().error.InvalidRequestError) as e:
+                        # Retrying will not help; do not hold up everyone else
+                        logger.error(f"Dropping {total['quantity']} usage for customer {customer_id}: {str(e)}")
+                        self._stats["skipped_customers"] += 1
+                        continue
+                    except Exception as e:
+                        logger.error(f"Error pushing usage to Stripe, will retry: {str(e)}")
+                        self._stats["push_errors"] += 1
+                        return pushed
+                    pushed += total["quantity"]
+                    self._stats["pushed_customers"] += 1
+                    self._stats["pushed_quantity"] += total["quantity"]
+                await loop.run_in_executor(None, self._complete_batch, batch)
+                self._stats["pushes"] += 1
+        finally:
+            lock.close()
+    
+    async def _pusher(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.push()
+            except Exception as e:
+                logger.error(f"Error in usage push: {str(e)}")
+    
+    async def start(self) -> None:
+        """
+        Starts pushing on the configured interval.
+        """
+        if self._task is None:
+            self._stopping = asyncio.Event()
+            self._task = asyncio.create_task(self._pusher())
+    
+    async def stop(self) -> None:
+        """
+        Stops the background push after a final push. Anything left in the
+        log is pushed by the next process to start.
+        """
+        if self._task is not None:
+            self._stopping.set()
+            await self._task
+            self._task = None
+    
+    def stats(self) -> Dict[str, Any]:
+        return {**self._stats, "cached_subscription_items": len(self._subscription_items)}
+
+
+usage_meter = UsageMeter()
+metrics.register_collector("usage_meter", usage_meter.stats)
+
 class PaymentHandler:
     """
     Handles Stripe payments and subscriptions.
@@ -53,7 +377,7 @@ class PaymentHandler:
         """
         try:
             # Create a checkout session
-            checkout_session = stripe.checkout.Session.create(
+            checkout_session = get_stripe().checkout.Session.create(
                 customer_email=None,  # Will be set from the client
                 payment_method_types=["card"],
                 line_items=[
@@ -93,7 +417,7 @@ class PaymentHandler:
         try:
             # Verify the webhook signature
             webhook_secret = os.getenv("STRIPE_WEBHOOK_SECRET", "your-webhook-secret")
-            event = stripe.Webhook.construct_event(
+            event = get_stripe().Webhook.construct_event(
                 payload, signature, webhook_secret
             )
             
@@ -135,7 +459,11 @@ class PaymentHandler:
         quantity: int
     ) -> Dict[str, Any]:
         """
-        Creates a usage record for API usage.
+        Records API usage for metered billing.
+        
+        The event is appended to the local usage log and reported to Stripe,
+        summed with the customer's other usage, by the usage meter's
+        background push.
         
         Args:
             customer_id: The Stripe customer ID
@@ -145,31 +473,23 @@ class PaymentHandler:
             Dict[str, Any]: The usage record details
         """
         try:
-            # Get the subscription item ID
-            subscriptions = stripe.Subscription.list(
-                customer=customer_id,
-                limit=1,
-            )
-            
-            if not subscriptions.data:
-                raise Exception(f"No subscription found for customer {customer_id}")
-            
-            subscription = subscriptions.data[0]
-            subscription_item_id = subscription.items.data[0].id
-            
-            # Create a usage record
-            usage_record = stripe.SubscriptionItem.create_usage_record(
-                subscription_item_id,
-                quantity=quantity,
-                timestamp=int(datetime.now().timestamp()),
-                action="increment",
-            )
+            event_id = usage_meter.record(customer_id, quantity)
             
             return {
-                "status": "success",
-                "usage_record_id": usage_record.id,
+                "status": "queued",
+                "usage_event_id": event_id,
                 "quantity": quantity,
             }
         except Exception as e:
             logger.error(f"Error creating API usage record: {str(e)}")
-            raise 
\ No newline at end of file
+            raise
+    
+    @staticmethod
+    async def push_api_usage() -> int:
+        """
+        Reports logged API usage to Stripe now.
+        
+        Returns:
+            int: The number of images reported
+        """
+        return await usage_meter.push()
@@ -0,0 +1,161 @@
+import os
+import json
+import base64
+import asyncio
+import logging
+import contextvars
+from io import BytesIO
+from typing import Optional, Dict, Any, List, Tuple, AsyncIterator
+from PIL import Image
+from dotenv import load_dotenv
+
+try:
+    from .cpu_pool import cpu_pool
+    from . import metrics
+except ImportError:
+    from backend.cpu_pool import cpu_pool
+    from backend import metrics
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+# Longest side of the preview sent before the model result is ready
+PREVIEW_MAX_SIZE = int(os.getenv("PREVIEW_MAX_SIZE", "1024"))
+PREVIEW_JPEG_QUALITY = int(os.getenv("PREVIEW_JPEG_QUALITY", "70"))
+# An idle event stream sends a comment this often, so proxies keep it open
+PROGRESS_KEEPALIVE_SECONDS = float(os.getenv("PROGRESS_KEEPALIVE_SECONDS", "15"))
+
+Event = Tuple[str, Dict[str, Any]]
+
+
+def make_preview(image_data: bytes, scale_factor: int) -> Dict[str, Any]:
+    """
+    Renders a quick preview of an upscale: the input resized with a cheap
+    filter to the output's shape, capped at PREVIEW_MAX_SIZE.
+
+    Args:
+        image_data: The input image data in bytes
+        scale_factor: The requested scale factor
+
+    Returns:
+        Dict[str, Any]: The preview size and a JPEG data URL
+    """
+    with Image.open(BytesIO(image_data)) as img:
+        width, height = img.width * scale_factor, img.height * scale_factor
+        ratio = min(1.0, PREVIEW_MAX_SIZE / max(width, height))
+        size = (max(1, round(width * ratio)), max(1, round(height * ratio)))
+        # JPEG inputs larger than the preview are decoded at reduced size
+        img.draft("RGB", size)
+        preview = img.convert("RGB").resize(size, Image.BILINEAR, reducing_gap=2.0)
+    output = BytesIO()
+    preview.save(output, format="JPEG", quality=PREVIEW_JPEG_QUALITY)
+    return {
+        "width": size[0],
+        "height": size[1],
+        "data_url": "data:image/jpeg;base64," + base64.b64encode(output.getvalue()).decode("ascii"),
+    }
+
+
+class ProgressChannel:
+    """
+    The events of one job, kept in order so that every subscriber, however
+    late, sees all of them. The job's input is held until the preview has
+    been rendered or the job ends.
+    """
+
+    def __init__(self, image_data: bytes, scale_factor: int):
+        self.events: List[Event] = []
+        self.closed = False
+        self._changed = asyncio.Event()
+        self._image_data: Optional[bytes] = image_data
+        self._scale_factor = scale_factor
+        self._preview_task: Optional[asyncio.Task] = None
+
+    def publish(self, event: str, data: Dict[str, Any]) -> None:
+        if self.closed:
+            return
+        self.events.append((event, data))
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def close(self) -> None:
+        """
+        Ends the channel after its last event, dropping the input.
+        """
+        self.closed = True
+        self._image_data = None
+        if self._preview_task is not None:
+            self._preview_task.cancel()
+        self._changed.set()
+
+    def request_preview(self) -> None:
+        """
+        Starts rendering the preview, unless it is already rendered or on
+        its way. Previews are only made for jobs somebody is watching.
+        """
+        if self._preview_task is None and self._image_data is not None:
+            self._preview_task = asyncio.ensure_future(self._render_preview())
+
+    async def _render_preview(self) -> None:
+        image_data, self._image_data = self._image_data, None
+        try:
+            preview = await cpu_pool.run("preview", make_preview, image_data, self._scale_factor)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Failed to render preview: %s", e)
+            return
+        metrics.count("previews")
+        self.publish("preview", preview)
+
+    async def listen(self) -> AsyncIterator[Optional[Event]]:
+        """
+        Yields every event, past and future, until the channel is closed.
+        None is yielded whenever no event arrived for
+        PROGRESS_KEEPALIVE_SECONDS.
+        """
+        index = 0
+        while True:
+            while index < len(self.events):
+                yield self.events[index]
+                index += 1
+            if self.closed:
+                return
+            changed = self._changed
+            try:
+                await asyncio.wait_for(changed.wait(), PROGRESS_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield None
+
+
+# The channel of the job whose code is running, if anyone may be watching
+current_channel: contextvars.ContextVar[Optional[ProgressChannel]] = contextvars.ContextVar(
+    "progress_channel", default=None
+)
+
+
+def report(stage: str, **details: Any) -> None:
+    """
+    Publishes a progress event for the job being run, if it has a channel.
+
+    Args:
+        stage: The stage reached (for example uploaded, predicting,
+            downloading or encoding)
+        **details: Extra fields for the event
+    """
+    channel = current_channel.get()
+    if channel is not None:
+        channel.publish("progress", {"stage": stage, **details})
+
+
+def format_event(event: Optional[Event]) -> str:
+    """
+    Formats an event as a server-sent event, or a keep-alive comment for None.
+    """
+    if event is None:
+        return ": keepalive\n\n"
+    name, data = event
+    return f"event: {name}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
@@ -0,0 +1,375 @@
+import os
+import time
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from io import BytesIO
+from typing import Optional, Dict, Any, Tuple
+from PIL import Image
+from dotenv import load_dotenv
+
+try:
+    from .tiled_upscaler import TiledUpscaler
+    from .results import UpscaleResult
+    from .scale_planner import plan_upscale
+    from .progress import report
+    from . import encoder
+    from .cpu_pool import cpu_pool
+    from . import metrics, http_client
+except ImportError:
+    from backend.tiled_upscaler import TiledUpscaler
+    from backend.results import UpscaleResult
+    from backend.scale_planner import plan_upscale
+    from backend.progress import report
+    from backend import encoder
+    from backend.cpu_pool import cpu_pool
+    from backend import metrics, http_client
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN")
+if not REPLICATE_API_TOKEN:
+    logger.error("REPLICATE_API_TOKEN environment variable is not set")
+# Point this at the local stand-in (benchmarks/fake_replicate.py) to load-test without Replicate
+REPLICATE_API_BASE = os.getenv("REPLICATE_API_BASE", "https://api.replicate.com/v1").rstrip("/")
+# How long Replicate may hold the create request open before we start polling
+REPLICATE_WAIT_SECONDS = int(os.getenv("REPLICATE_WAIT_SECONDS", "30"))
+REPLICATE_POLL_INTERVAL = float(os.getenv("REPLICATE_POLL_INTERVAL", "1.0"))
+REPLICATE_PREDICTION_TIMEOUT = float(os.getenv("REPLICATE_PREDICTION_TIMEOUT", "300"))
+# Primary provider; the local provider is always the fallback
+UPSCALE_PROVIDER = os.getenv("UPSCALE_PROVIDER", "replicate")
+
+# Updated to a more reliable model
+UPSCALE_MODEL = "nightmareai/real-esrgan:42fed1c4974146d4d2414e2be2c5277c7fcf05fcc3a73abf41610695738c1d7b"
+
+
+class ProviderError(Exception):
+    """
+    Raised when a provider fails to produce a result.
+    """
+
+
+def _encode_resized(img: Image.Image, out_size: Tuple[int, int], output_format: str) -> UpscaleResult:
+    """
+    Enlarges an image with the tiled engine and encodes the result, in
+    memory if it is small and straight into a spool file otherwise.
+    """
+    return encoder.encode_to_result(
+        out_size[0] * out_size[1] * len(img.getbands()),
+        lambda out: TiledUpscaler.resize(img, out_size, output_format, out)
+    )
+
+
+def _downscale(image_data: bytes, size: Tuple[int, int]) -> bytes:
+    """
+    Shrinks an oversized input before upload. The result is a fast,
+    lossless PNG, since the model's output can only be as good as its input.
+    """
+    output = BytesIO()
+    with Image.open(BytesIO(image_data)) as img:
+        img = TiledUpscaler._prepare(img, "PNG")
+        img.resize(size, Image.LANCZOS, reducing_gap=3.0).save(output, format="PNG", compress_level=1)
+    return output.getvalue()
+
+
+def _resample(result: UpscaleResult, size: Tuple[int, int], output_format: str) -> UpscaleResult:
+    """
+    Resamples a model output to the exact requested size.
+    """
+    with result.open() as f, Image.open(f) as img:
+        return _encode_resized(img, size, output_format)
+
+
+class UpscaleProvider(ABC):
+    """
+    Base class for upscale backends.
+    """
+
+    name = "base"
+
+    @abstractmethod
+    async def upscale(
+        self,
+        image_data: bytes,
+        scale_factor: int,
+        mode: str,
+        output_format: str,
+        **options: Any
+    ) -> UpscaleResult:
+        """
+        Upscales an image.
+
+        Args:
+            image_data: The image data in bytes
+            scale_factor: The scale factor
+            mode: The upscaling mode (block_mode, face_mode, waifu_mode)
+            output_format: Output format (jpeg, png, jpg, webp)
+            **options: Model-specific options (dynamic, handfix, creativity, resemblance)
+
+        Returns:
+            UpscaleResult: The upscaled image
+        """
+
+
+class ReplicateProvider(UpscaleProvider):
+    """
+    Runs Real-ESRGAN through Replicate's HTTP API: the input goes to the
+    files API, a prediction is created and polled, and the output file is
+    downloaded on the shared HTTP client.
+    """
+
+    name = "replicate"
+
+    def __init__(
+        self,
+        api_base: str = REPLICATE_API_BASE,
+        api_token: Optional[str] = REPLICATE_API_TOKEN,
+        model: str = UPSCALE_MODEL
+    ):
+        self.api_base = api_base
+        self.api_token = api_token
+        self.version = model.split(":", 1)[1]
+
+    @property
+    def _headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.api_token}"}
+
+    async def _upload(self, image_data: bytes) -> str:
+        """
+        Uploads an image to the files API so that the prediction can
+        reference it by URL instead of an inline base64 data URI.
+        """
+        image_format = Image.open(BytesIO(image_data)).format or "PNG"
+        mime_type = Image.MIME.get(image_format, "application/octet-stream")
+
+        # httpx streams the buffer into the multipart body without copying it
+        metrics.count_bytes("provider_upload", len(image_data))
+        response = await http_client.request(
+            "POST",
+            f"{self.api_base}/files",
+            headers=self._headers,
+            files={"content": (f"input.{image_format.lower()}", image_data, mime_type)},
+        )
+        response.raise_for_status()
+        return response.json()["urls"]["get"]
+
+    async def _wait(self, prediction: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Polls a prediction until it reaches a terminal status, cancelling it
+        if it times out or the caller is cancelled.
+        """
+        deadline = time.monotonic() + REPLICATE_PREDICTION_TIMEOUT
+        try:
+            while prediction["status"] not in ("succeeded", "failed", "canceled"):
+                if time.monotonic() > deadline:
+                    raise ProviderError("Replicate prediction timed out")
+                await asyncio.sleep(REPLICATE_POLL_INTERVAL)
+                response = await http_client.request("GET", prediction["urls"]["get"], headers=self._headers)
+                response.raise_for_status()
+                prediction = response.json()
+        except BaseException:
+            cancel_url = prediction.get("urls", {}).get("cancel")
+            if cancel_url and prediction["status"] not in ("succeeded", "failed", "canceled"):
+                try:
+                    await asyncio.shield(http_client.request("POST", cancel_url, headers=self._headers))
+                except Exception as e:
+                    logger.warning("Failed to cancel prediction %s: %s", prediction.get("id"), e)
+            raise
+        return prediction
+
+    async def _predict(
+        self,
+        image_data: bytes,
+        scale: float,
+        mode: str,
+        output_format: str,
+        model_pass: int = 1
+    ) -> UpscaleResult:
+        """
+        Runs one model pass: uploads the input, runs the prediction and
+        downloads its output.
+        """
+        with metrics.timed("replicate_upload"):
+            image_url = await self._upload(image_data)
+        report("uploaded", model_pass=model_pass)
+
+        # Prepare input parameters for Real-ESRGAN model
+        input_params = {
+            "image": image_url,
+            "scale": scale,
+            "face_enhance": mode == "face_mode",
+            "output_format": output_format
+        }
+
+        if logger.isEnabledFor(logging.DEBUG):
+            # The image itself is left out; it may be a large data URL
+            logger.debug("Replicate input parameters: %s", {k: v for k, v in input_params.items() if k != "image"})
+
+        metrics.count("replicate_predictions")
+        report("predicting", model_pass=model_pass)
+        with metrics.timed("replicate_prediction"):
+            response = await http_client.request(
+                "POST",
+                f"{self.api_base}/predictions",
+                headers={**self._headers, "Prefer": f"wait={REPLICATE_WAIT_SECONDS}"},
+                json={"version": self.version, "input": input_params},
+            )
+            response.raise_for_status()
+            prediction = await self._wait(response.json())
+
+        if prediction["status"] != "succeeded":
+            raise ProviderError(f"Replicate prediction {prediction['status']}: {prediction.get('error')}")
+
+        output = prediction.get("output")
+        logger.debug("Replicate output: %.200r", output)
+
+        # Download the result
+        output_url = output
+        if isinstance(output, list) and len(output) > 0:
+            output_url = output[0]
+        elif isinstance(output, dict) and "output" in output:
+            output_url = output["output"]
+
+        if not output_url:
+            raise ProviderError("No output URL returned from Replicate")
+
+        logger.debug("Downloading result from: %s", output_url)
+
+        # Stream the output over the shared, keep-alive connection pool
+        report("downloading", model_pass=model_pass)
+        with metrics.timed("replicate_download"):
+            return await http_client.download(output_url)
+
+    async def upscale(
+        self,
+        image_data: bytes,
+        scale_factor: int,
+        mode: str,
+        output_format: str,
+        **options: Any
+    ) -> UpscaleResult:
+        if not self.api_token:
+            raise ValueError("REPLICATE_API_TOKEN is not set")
+
+        # The model is asked for jpeg, never jpg
+        output_format = encoder.normalize_format(output_format)
+
+        # Only the header is read to get the size
+        width, height = Image.open(BytesIO(image_data)).size
+        plan = plan_upscale(width, height, scale_factor)
+        encoder.check_size(output_format, plan.output_size)
+        logger.info(
+            "Upscale plan for %dx%d at %dx: %s (estimated $%.5f, %.1fs)",
+            width, height, scale_factor, plan.describe(), plan.cost_usd, plan.seconds
+        )
+        metrics.count("plan_estimated_microdollars", round(plan.cost_usd * 1e6))
+        report(
+            "planned",
+            steps=plan.describe(),
+            model_passes=len(plan.model_scales),
+            estimated_seconds=round(plan.seconds, 1)
+        )
+
+        if plan.downscales:
+            metrics.count("plan_downscales")
+            size = len(image_data)
+            image_data = await cpu_pool.run("downscale", _downscale, image_data, plan.model_input_size)
+            metrics.count_bytes("downscale", size, copied=len(image_data))
+
+        # Intermediate outputs are PNG so that no pass works from lossy data
+        result: Optional[UpscaleResult] = None
+        for i, scale in enumerate(plan.model_scales):
+            last = i == len(plan.model_scales) - 1
+            if result is not None:
+                try:
+                    image_data = await result.read()
+                    # In-memory results are read without a copy
+                    metrics.count_bytes("model_pass_input", len(image_data), copied=len(image_data) if result.on_disk else 0)
+                finally:
+                    result.close()
+            logger.debug("Running model pass %d of %d at %sx", i + 1, len(plan.model_scales), scale)
+            result = await self._predict(
+                image_data, scale, mode, output_format if last and not plan.resamples else "png", model_pass=i + 1
+            )
+
+        if plan.resamples:
+            metrics.count("plan_resamples")
+            report("encoding")
+            model_result = result
+            try:
+                result = await cpu_pool.run(
+                    "resample", _resample, model_result, plan.output_size, output_format,
+                    on_discard=UpscaleResult.close
+                )
+            finally:
+                model_result.close()
+        else:
+            # The model may not honour output_format; convert only if it did not
+            result = await encoder.ensure_format(result, output_format)
+
+        result.plan = plan.to_dict()
+        return result
+
+
+class LocalProvider(UpscaleProvider):
+    """
+    Upscales locally with the tiled LANCZOS engine.
+    """
+
+    name = "local"
+
+    async def upscale(
+        self,
+        image_data: bytes,
+        scale_factor: int,
+        mode: str,
+        output_format: str,
+        **options: Any
+    ) -> UpscaleResult:
+        def upscale() -> UpscaleResult:
+            with Image.open(BytesIO(image_data)) as img:
+                width, height = img.size
+                return _encode_resized(img, (width * scale_factor, height * scale_factor), output_format)
+
+        # Keep the decode, resize and encode off the event loop
+        report("encoding")
+        return await cpu_pool.run("local_upscale", upscale, on_discard=UpscaleResult.close)
+
+
+PROVIDERS = {
+    ReplicateProvider.name: ReplicateProvider,
+    LocalProvider.name: LocalProvider,
+}
+
+_instances: Dict[str, UpscaleProvider] = {}
+
+
+def get_provider(name: str = UPSCALE_PROVIDER) -> UpscaleProvider:
+    """
+    Returns the shared instance of a provider.
+
+    Args:
+        name: The provider name (replicate or local)
+
+    Returns:
+        UpscaleProvider: The provider
+    """
+    if name not in PROVIDERS:
+        raise ValueError(f"Unknown upscale provider: {name}. Must be one of: {', '.join(PROVIDERS)}")
+    if name not in _instances:
+        _instances[name] = PROVIDERS[name]()
+    return _instances[name]
+
+
+def get_fallback_provider() -> UpscaleProvider:
+    """
+    Returns the provider used when the primary provider fails.
+
+    Returns:
+        UpscaleProvider: The local provider
+    """
+    return get_provider(LocalProvider.name)
@@ -0,0 +1,387 @@
+import os
+import math
+import time
+import asyncio
+import logging
+from typing import Optional, Dict, Any, List
+from dotenv import load_dotenv
+from fastapi import HTTPException, status
+
+try:
+    from .auth import User
+    from .database import DatabaseHandler, is_user_id
+    from .single_flight import SingleFlight
+    from . import metrics
+except ImportError:
+    from backend.auth import User
+    from backend.database import DatabaseHandler, is_user_id
+    from backend.single_flight import SingleFlight
+    from backend import metrics
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+FREE_TIER_MONTHLY_LIMIT = int(os.getenv("FREE_TIER_MONTHLY_LIMIT", "3"))
+# Upscale requests per minute; short bursts of up to this many are allowed
+RATE_LIMIT_FREE_PER_MINUTE = float(os.getenv("RATE_LIMIT_FREE_PER_MINUTE", "10"))
+RATE_LIMIT_PRO_PER_MINUTE = float(os.getenv("RATE_LIMIT_PRO_PER_MINUTE", "60"))
+# How often in-memory counters are corrected from the database
+QUOTA_RECONCILE_INTERVAL_SECONDS = float(os.getenv("QUOTA_RECONCILE_INTERVAL_SECONDS", "30"))
+# Users are forgotten after this long without a request
+QUOTA_IDLE_SECONDS = float(os.getenv("QUOTA_IDLE_SECONDS", "3600"))
+# Users read per reconcile query
+QUOTA_RECONCILE_BATCH = int(os.getenv("QUOTA_RECONCILE_BATCH", "200"))
+
+
+class TokenBucket:
+    """
+    Refills at `rate` tokens per second up to `capacity`.
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def take(self, now: float, amount: float = 1.0) -> float:
+        """
+        Takes tokens if there are enough.
+
+        Returns:
+            float: 0 if the tokens were taken, otherwise the seconds until they will be available
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+
+class UserQuota:
+    """
+    A user's plan, request rate and images used this month.
+
+    `stored` is the count last read from the database and `local` what this
+    process has counted since, so the images used are their sum. `reserved`
+    are images admitted but not finished yet.
+    """
+
+    __slots__ = ("tier", "stored", "local", "reserved", "bucket", "last_seen")
+
+    def __init__(self, user: User, now: float):
+        self.tier = user.subscription_tier
+        self.stored = user.images_processed_this_month
+        self.local = 0
+        self.reserved = 0
+        rate = _rate_for(self.tier)
+        self.bucket = TokenBucket(rate / 60, rate, now)
+        self.last_seen = now
+
+    @property
+    def used(self) -> int:
+        return self.stored + self.local
+
+    def set_tier(self, tier: str) -> None:
+        if tier != self.tier:
+            self.tier = tier
+            rate = _rate_for(tier)
+            self.bucket.rate = rate / 60
+            self.bucket.capacity = rate
+
+
+def _rate_for(tier: str) -> float:
+    return RATE_LIMIT_FREE_PER_MINUTE if tier == "free" else RATE_LIMIT_PRO_PER_MINUTE
+
+
+class Reservation:
+    """
+    Images admitted for a request. Commit the ones that were processed;
+    anything not committed is handed back by release().
+    """
+
+    __slots__ = ("_entry", "_images")
+
+    def __init__(self, entry: Optional[UserQuota], images: int):
+        self._entry = entry
+        self._images = images
+
+    def commit(self, images: Optional[int] = None) -> None:
+        """
+        Counts processed images against the monthly limit and releases the rest.
+
+        Args:
+            images: The number of images processed (defaults to all reserved)
+        """
+        if self._entry is not None:
+            self._entry.local += self._images if images is None else min(images, self._images)
+        self.release()
+
+    def release(self) -> None:
+        """
+        Hands back the reserved images. Does nothing once committed or released.
+        """
+        if self._entry is not None:
+            self._entry.reserved -= self._images
+            self._entry = None
+
+
+class QuotaService:
+    """
+    Admits upscale requests against per-user rate limits and the free-tier
+    monthly limit from memory.
+
+    A user's count is read from the database the first time the user is
+    seen (and again after they have been forgotten for being idle), then
+    corrected in the background every QUOTA_RECONCILE_INTERVAL_SECONDS.
+    Until that first read succeeds, free-tier requests are refused rather
+    than admitted against auth's possibly stale count. Each worker process
+    counts its own requests; usage from other processes is seen after the
+    next usage flush and reconcile.
+    """
+
+    def __init__(self, interval: float = QUOTA_RECONCILE_INTERVAL_SECONDS):
+        self.interval = interval
+        self._users: Dict[str, UserQuota] = {}
+        self._unsynced = set()
+        # Concurrent first requests of a user share one read
+        self._syncs = SingleFlight("quota_sync")
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._stats = {
+            "admitted": 0,
+            "rate_limited": 0,
+            "quota_exceeded": 0,
+            "reconciles": 0,
+            "reconciled_users": 0,
+            "reconcile_errors": 0,
+            "unsynced_refused": 0,
+        }
+
+    def _entry(self, user: User, now: float) -> UserQuota:
+        entry = self._users.get(user.username)
+        if entry is None:
+            entry = self._users[user.username] = UserQuota(user, now)
+            # Auth's copy of the user may be stale; users without a row in
+            # the database have nothing more to read
+            if is_user_id(user.username):
+                self._unsynced.add(user.username)
+        entry.last_seen = now
+        return entry
+
+    async def _sync(self, user_id: str) -> bool:
+        """
+        Reads a user's count from the database, once per user at a time.
+
+        Returns:
+            bool: True once the user has been read
+        """
+        async def read() -> bool:
+            if user_id not in self._unsynced:
+                return True
+            counts = await self._read([user_id])
+            if counts is None:
+                # Try again in the background
+                if self._wake is not None:
+                    self._wake.set()
+                return False
+            self._unsynced.discard(user_id)
+            return True
+
+        return await self._syncs.run(user_id, read, share=lambda synced: synced)
+
+    async def admit(self, user: Optional[User], images: int = 1) -> Reservation:
+        """
+        Admits a request for `images` images or rejects it.
+
+        Args:
+            user: The authenticated user, or None for anonymous requests
+            images: The number of images in the request
+
+        Returns:
+            Reservation: The admitted images
+
+        Raises:
+            HTTPException: 403 if the monthly limit would be exceeded, 429 if
+            the user is sending requests too fast, 503 if a free-tier user's
+            count could not be read yet
+        """
+        if user is None:
+            return Reservation(None, 0)
+
+        entry = self._entry(user, time.monotonic())
+        if user.username in self._unsynced and not await self._sync(user.username) and entry.tier == "free":
+            self._stats["unsynced_refused"] += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Your usage could not be checked. Please try again shortly.",
+                headers={"Retry-After": "5"},
+            )
+        now = time.monotonic()
+
+        if entry.tier == "free":
+            remaining = max(0, FREE_TIER_MONTHLY_LIMIT - entry.used - entry.reserved)
+            if images > remaining:
+                self._stats["quota_exceeded"] += 1
+                if images == 1:
+                    detail = (
+                        f"You have reached your monthly limit of {FREE_TIER_MONTHLY_LIMIT} images. "
+                        "Please upgrade to the Pro plan."
+                    )
+                else:
+                    detail = (
+                        f"This batch has {images} images but you have {remaining} left this month. "
+                        "Please upgrade to the Pro plan."
+                    )
+                raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=detail)
+
+        # A batch is one request as far as the rate limit is concerned
+        wait = entry.bucket.take(now)
+        if wait:
+            self._stats["rate_limited"] += 1
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests. Please slow down.",
+                headers={"Retry-After": str(math.ceil(wait))},
+            )
+
+        entry.reserved += images
+        self._stats["admitted"] += 1
+        return Reservation(entry, images)
+
+    async def usage(self, user: User) -> Dict[str, Any]:
+        """
+        Returns the user's plan and images used this month, reading them
+        from the database first if this worker has not yet.
+
+        Args:
+            user: The authenticated user
+
+        Returns:
+            Dict[str, Any]: The usage, in the format of the /usage endpoint
+        """
+        entry = self._entry(user, time.monotonic())
+        if user.username in self._unsynced:
+            await self._sync(user.username)
+        return {
+            "subscription_tier": entry.tier,
+            "images_processed_this_month": entry.used,
+            "max_images_per_month": FREE_TIER_MONTHLY_LIMIT if entry.tier == "free" else float("inf"),
+        }
+
+    async def reconcile(self, user_ids: Optional[List[str]] = None) -> int:
+        """
+        Reads the plans and counts of users from the database.
+
+        Args:
+            user_ids: The users to read; by default every active user, after
+                forgetting idle ones
+
+        Returns:
+            int: The number of users updated
+        """
+        if user_ids is None:
+            now = time.monotonic()
+            for user_id, entry in list(self._users.items()):
+                if entry.reserved <= 0 and now - entry.last_seen > QUOTA_IDLE_SECONDS:
+                    del self._users[user_id]
+            user_ids = list(self._users)
+            self._unsynced.clear()
+
+        updated = 0
+        for start in range(0, len(user_ids), QUOTA_RECONCILE_BATCH):
+            counts = await self._read(user_ids[start:start + QUOTA_RECONCILE_BATCH])
+            if counts is not None:
+                updated += len(counts)
+        self._stats["reconciles"] += 1
+        return updated
+
+    async def _read(self, user_ids: List[str]) -> Optional[Dict[str, Dict[str, Any]]]:
+        """
+        Reads the plans and counts of up to QUOTA_RECONCILE_BATCH users and
+        applies them.
+
+        Returns:
+            Optional[Dict[str, Dict[str, Any]]]: The rows applied, or None
+            if the database could not be read
+        """
+        # Images committed while the query runs are not in its counts,
+        # so only what was counted locally before it is replaced
+        counted = {user_id: self._users[user_id].local for user_id in user_ids if user_id in self._users}
+        counts = await DatabaseHandler.get_usage_counts(user_ids)
+        if counts is None:
+            self._stats["reconcile_errors"] += 1
+            return None
+        applied = {}
+        for user_id, row in counts.items():
+            entry = self._users.get(user_id)
+            if entry is None or user_id not in counted:
+                continue
+            entry.set_tier(row.get("subscription_tier") or "free")
+            entry.stored = row.get("images_processed_this_month") or 0
+            entry.local = max(0, entry.local - counted[user_id])
+            applied[user_id] = row
+        self._stats["reconciled_users"] += len(applied)
+        return applied
+
+    async def _reconciler(self) -> None:
+        loop = asyncio.get_running_loop()
+        next_full = loop.time() + self.interval
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), max(0.0, next_full - loop.time()))
+            except asyncio.TimeoutError:
+                pass
+            if self._stopping.is_set():
+                return
+            self._wake.clear()
+            try:
+                if loop.time() >= next_full:
+                    await self.reconcile()
+                    next_full = loop.time() + self.interval
+                elif self._unsynced:
+                    user_ids = list(self._unsynced)
+                    self._unsynced.clear()
+                    await self.reconcile(user_ids)
+            except Exception as e:
+                logger.error(f"Error reconciling quotas: {str(e)}")
+                self._stats["reconcile_errors"] += 1
+
+    async def start(self) -> None:
+        """
+        Starts reconciling on the configured interval.
+        """
+        if self._task is None:
+            self._stopping = asyncio.Event()
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._reconciler())
+
+    async def stop(self) -> None:
+        """
+        Stops reconciling.
+        """
+        if self._task is not None:
+            self._stopping.set()
+            self._wake.set()
+            await self._task
+            self._task = None
+            self._wake = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._stats,
+            "users": len(self._users),
+            "reserved_images": sum(entry.reserved for entry in self._users.values()),
+        }
+
+
+# Shared quota service
+quota = QuotaService()
+metrics.register_collector("quota", quota.stats)
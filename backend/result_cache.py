@@ -0,0 +1,325 @@
+import os
+import time
+import fcntl
+import asyncio
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Tuple
+from dotenv import load_dotenv
+
+try:
+    from . import metrics
+    from .results import UpscaleResult
+except ImportError:
+    from backend import metrics
+    from backend.results import UpscaleResult
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+RESULT_CACHE_MEMORY_BYTES = int(os.getenv("RESULT_CACHE_MEMORY_BYTES", str(256 * 1024 * 1024)))
+RESULT_CACHE_DISK_BYTES = int(os.getenv("RESULT_CACHE_DISK_BYTES", str(2 * 1024 * 1024 * 1024)))
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "upscaloro-cache"))
+# Larger results skip the memory tier and live on disk only
+RESULT_CACHE_MAX_MEMORY_ITEM_BYTES = int(os.getenv("RESULT_CACHE_MAX_MEMORY_ITEM_BYTES", str(32 * 1024 * 1024)))
+# How often the disk tier is rescanned for entries written by other workers
+# sharing the directory, and trimmed to RESULT_CACHE_DISK_BYTES
+RESULT_CACHE_SCAN_SECONDS = float(os.getenv("RESULT_CACHE_SCAN_SECONDS", "60"))
+
+
+class ResultCache:
+    """
+    Content-addressed cache of upscale results with a bounded in-memory LRU
+    tier in front of a size-capped on-disk tier.
+
+    The disk tier may be shared by several worker processes. Each keeps an
+    index of the directory and picks up entries written by the others when
+    it looks them up; the size cap is enforced over the whole directory,
+    by whichever worker holds the sweep lock.
+    """
+
+    def __init__(
+        self,
+        memory_bytes: int = RESULT_CACHE_MEMORY_BYTES,
+        disk_bytes: int = RESULT_CACHE_DISK_BYTES,
+        directory: str = RESULT_CACHE_DIR
+    ):
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_size = 0
+        self._disk: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_size = 0
+        self._disk_loaded = False
+        self._disk_scanned = 0.0
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "memory_evictions": 0,
+            "disk_evictions": 0,
+        }
+
+    @staticmethod
+    def make_key(
+        content_hash: str,
+        scale_factor: int,
+        mode: str,
+        output_format: str,
+        dynamic: int,
+        handfix: bool,
+        creativity: float,
+        resemblance: float
+    ) -> str:
+        """
+        Builds a cache key from the input hash and the normalized parameters.
+
+        Args:
+            content_hash: SHA-256 hex digest of the input image
+            scale_factor: The scale factor
+            mode: The upscaling mode
+            output_format: Output format (jpg and jpeg are treated the same)
+            dynamic: Dynamic parameter
+            handfix: Whether handfix is enabled
+            creativity: Creativity parameter
+            resemblance: Resemblance parameter
+
+        Returns:
+            str: The cache key
+        """
+        output_format = output_format.lower()
+        if output_format == "jpg":
+            output_format = "jpeg"
+        params = (
+            f"{content_hash}|{int(scale_factor)}|{mode}|{output_format}|{int(dynamic)}|"
+            f"{int(bool(handfix))}|{round(float(creativity), 4)}|{round(float(resemblance), 4)}"
+        )
+        return hashlib.sha256(params.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _scan_disk(self) -> List[Tuple[float, str, int]]:
+        """
+        Lists the entries in the cache directory as (mtime, key, size),
+        oldest first.
+        """
+        entries = []
+        try:
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    if name.endswith((".tmp", ".lock")):
+                        continue
+                    try:
+                        stat = os.stat(os.path.join(root, name))
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, name, stat.st_size))
+        except OSError as e:
+            logger.warning(f"Could not scan result cache directory: {e}")
+        return sorted(entries)
+
+    def _index(self, entries: List[Tuple[float, str, int]]) -> None:
+        """
+        Replaces the disk tier index. Must be called with the lock held.
+        """
+        self._disk.clear()
+        self._disk_size = 0
+        for _, name, size in entries:
+            self._disk[name] = size
+            self._disk_size += size
+        self._disk_scanned = time.monotonic()
+
+    def _load_disk_index(self) -> None:
+        """
+        Builds the disk tier index from the cache directory, oldest first.
+        Must be called with the lock held.
+        """
+        if self._disk_loaded:
+            return
+        self._disk_loaded = True
+        self._index(self._scan_disk())
+        if self._disk:
+            logger.info(f"Loaded {len(self._disk)} cached results ({self._disk_size} bytes) from {self.directory}")
+
+    def _sweep_disk(self) -> None:
+        """
+        Trims the cache directory to RESULT_CACHE_DISK_BYTES, least recently
+        used first, and rebuilds the index from what is left. Only one
+        worker sweeps at a time; the others skip it.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, "sweep.lock"), "a") as lock:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # Another worker is sweeping
+                return
+            entries = self._scan_disk()
+            total = sum(size for _, _, size in entries)
+            evicted = 0
+            while total > self.disk_bytes and len(entries) > 1:
+                _, key, size = entries.pop(0)
+                try:
+                    os.unlink(self._path(key))
+                except OSError:
+                    pass
+                total -= size
+                evicted += 1
+        with self._lock:
+            self._index(entries)
+            self._stats["disk_evictions"] += evicted
+
+    def _remember(self, key: str, data: bytes) -> None:
+        """
+        Adds an entry to the memory tier, evicting the least recently used
+        entries. Must be called with the lock held.
+        """
+        if len(data) > min(self.memory_bytes, RESULT_CACHE_MAX_MEMORY_ITEM_BYTES):
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_size -= len(previous)
+        self._memory[key] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+            self._stats["memory_evictions"] += 1
+
+    def _read_disk(self, key: str) -> Optional[UpscaleResult]:
+        with self._lock:
+            self._load_disk_index()
+            size = self._disk.get(key)
+        path = self._path(key)
+        if size is None:
+            # Possibly written by another worker since the index was built
+            try:
+                size = os.stat(path).st_size
+            except OSError:
+                return None
+            with self._lock:
+                if key not in self._disk:
+                    self._disk[key] = size
+                    self._disk_size += size
+        try:
+            if size <= min(self.memory_bytes, RESULT_CACHE_MAX_MEMORY_ITEM_BYTES):
+                with open(path, "rb") as f:
+                    result = UpscaleResult(data=f.read())
+                metrics.count_bytes("cache_disk_read", result.size, copied=result.size)
+            else:
+                # Large entries are served from disk
+                result = UpscaleResult.from_shared_file(path)
+            os.utime(path)
+        except OSError:
+            # Evicted by another worker sharing the directory
+            with self._lock:
+                size = self._disk.pop(key, None)
+                if size is not None:
+                    self._disk_size -= size
+            return None
+        with self._lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+            if result.data is not None:
+                self._remember(key, result.data)
+        return result
+
+    def _write_disk(self, key: str, result: UpscaleResult) -> None:
+        if result.size > self.disk_bytes:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            result.save_to(path)
+        except OSError as e:
+            logger.warning(f"Could not write cached result: {e}")
+            return
+
+        with self._lock:
+            self._load_disk_index()
+            previous = self._disk.pop(key, None)
+            if previous is not None:
+                self._disk_size -= previous
+            self._disk[key] = result.size
+            self._disk_size += result.size
+            # The index only knows about the other workers' entries it has
+            # seen, so the directory is rescanned now and then even below the cap
+            sweep = (
+                self._disk_size > self.disk_bytes
+                or time.monotonic() - self._disk_scanned > RESULT_CACHE_SCAN_SECONDS
+            )
+        if sweep:
+            self._sweep_disk()
+
+    async def get(self, key: str) -> Optional[UpscaleResult]:
+        """
+        Looks up a cached result, checking memory before disk.
+
+        Args:
+            key: The cache key
+
+        Returns:
+            Optional[UpscaleResult]: The cached result, or None on a miss
+        """
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return UpscaleResult(data=data)
+
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(None, self._read_disk, key)
+        with self._lock:
+            self._stats["disk_hits" if result is not None else "misses"] += 1
+        return result
+
+    async def put(self, key: str, result: UpscaleResult) -> None:
+        """
+        Stores a result in both tiers. File-backed results are linked into
+        the disk tier rather than copied.
+
+        Args:
+            key: The cache key
+            result: The result
+        """
+        with self._lock:
+            if result.data is not None:
+                self._remember(key, result.data)
+            self._stats["stores"] += 1
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._write_disk, key, result)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns hit and miss statistics and the size of each tier.
+
+        Returns:
+            Dict[str, Any]: The cache statistics
+        """
+        with self._lock:
+            lookups = self._stats["memory_hits"] + self._stats["disk_hits"] + self._stats["misses"]
+            hits = self._stats["memory_hits"] + self._stats["disk_hits"]
+            return {
+                **self._stats,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_size,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_size,
+            }
+
+
+# Shared cache instance
+result_cache = ResultCache()
+metrics.register_collector("result_cache", result_cache.stats)
@@ -0,0 +1,350 @@
+import os
+import re
+import time
+import shutil
+import asyncio
+import logging
+import tempfile
+from io import BytesIO
+from typing import Optional, Dict, Any, Tuple, BinaryIO
+from dotenv import load_dotenv
+from starlette.responses import Response
+from starlette.background import BackgroundTask
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+# Results at least this large are spooled to disk instead of kept in memory
+RESULT_SPOOL_BYTES = int(os.getenv("RESULT_SPOOL_BYTES", str(8 * 1024 * 1024)))
+RESULT_SPOOL_DIR = os.getenv("RESULT_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "upscaloro-results"))
+RESPONSE_CHUNK_SIZE = 256 * 1024
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class UpscaleResult:
+    """
+    An upscaled image, held either in memory or in a file on local disk.
+
+    File-backed results that own their file delete it when closed. Results
+    served from shared storage (the cache or the job store) do not.
+    """
+
+    def __init__(
+        self,
+        data: Optional[bytes] = None,
+        path: Optional[str] = None,
+        size: Optional[int] = None,
+        owned: bool = False
+    ):
+        if (data is None) == (path is None):
+            raise ValueError("Exactly one of data and path is required")
+        self.data = data
+        self.path = path
+        self.owned = owned
+        # How the provider produced it (see scale_planner.ScalePlan.to_dict)
+        self.plan: Optional[Dict[str, Any]] = None
+        if size is not None:
+            self.size = size
+        elif data is not None:
+            self.size = len(data)
+        else:
+            self.size = os.path.getsize(path)
+
+    @classmethod
+    def spool_file(cls) -> Tuple[BinaryIO, str]:
+        """
+        Creates a new file in the result spool directory.
+
+        Returns:
+            Tuple[BinaryIO, str]: The open file and its path
+        """
+        os.makedirs(RESULT_SPOOL_DIR, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=RESULT_SPOOL_DIR, suffix=".bin")
+        return os.fdopen(fd, "wb"), path
+
+    @classmethod
+    def from_shared_file(cls, path: str) -> "UpscaleResult":
+        """
+        Creates a result from a file owned by shared storage such as the
+        cache or the job store. The file is hard-linked (or copied) into the
+        spool, so it stays readable if the original is evicted mid-response.
+
+        Args:
+            path: The shared file
+
+        Returns:
+            UpscaleResult: An owned, file-backed result
+        """
+        spool, spool_path = cls.spool_file()
+        spool.close()
+        try:
+            os.unlink(spool_path)
+            os.link(path, spool_path)
+        except OSError:
+            try:
+                shutil.copyfile(path, spool_path)
+            except OSError:
+                try:
+                    os.unlink(spool_path)
+                except OSError:
+                    pass
+                raise
+        return cls(path=spool_path, owned=True)
+
+    def share(self) -> "UpscaleResult":
+        """
+        Returns another handle on the same image that can be sent and closed
+        independently of this one. Nothing is copied: in-memory results
+        share their bytes and file-backed results are hard-linked.
+
+        Returns:
+            UpscaleResult: The new handle
+        """
+        if self.data is not None:
+            shared = UpscaleResult(data=self.data)
+        else:
+            shared = UpscaleResult.from_shared_file(self.path)
+        shared.plan = self.plan
+        return shared
+
+    @property
+    def on_disk(self) -> bool:
+        return self.path is not None
+
+    def open(self) -> BinaryIO:
+        """
+        Opens the result for reading. In-memory results are not copied.
+
+        Returns:
+            BinaryIO: A binary file object
+        """
+        if self.data is not None:
+            return BytesIO(self.data)
+        return open(self.path, "rb")
+
+    def read_sync(self) -> bytes:
+        if self.data is not None:
+            return self.data
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    async def read(self) -> bytes:
+        """
+        Reads the whole result, loading it from disk off the event loop.
+
+        Returns:
+            bytes: The image data
+        """
+        if self.data is not None:
+            return self.data
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.read_sync)
+
+    def save_to(self, path: str) -> None:
+        """
+        Writes the result to a path, hard-linking file-backed results when
+        possible instead of copying them.
+
+        Args:
+            path: The destination path
+        """
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        if self.data is not None:
+            with open(tmp_path, "wb") as f:
+                f.write(self.data)
+        else:
+            try:
+                os.link(self.path, tmp_path)
+            except OSError:
+                shutil.copyfile(self.path, tmp_path)
+        os.replace(tmp_path, path)
+
+    def close(self) -> None:
+        """
+        Deletes the backing file if this result owns it.
+        """
+        if self.owned and self.path is not None:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            self.owned = False
+
+
+def media_type_for(output_format: str) -> str:
+    """
+    Returns the MIME type for an output format.
+
+    Args:
+        output_format: Output format (jpeg, png, jpg, webp)
+
+    Returns:
+        str: The MIME type
+    """
+    output_format = output_format.lower()
+    return "image/jpeg" if output_format == "jpg" else f"image/{output_format}"
+
+
+def sweep_spool(max_age_seconds: float) -> int:
+    """
+    Removes spool files left behind by crashed or killed workers.
+
+    Args:
+        max_age_seconds: Files older than this are removed
+
+    Returns:
+        int: The number of files removed
+    """
+    removed = 0
+    cutoff = time.time() - max_age_seconds
+    try:
+        names = os.listdir(RESULT_SPOOL_DIR)
+    except OSError:
+        return 0
+    for name in names:
+        path = os.path.join(RESULT_SPOOL_DIR, name)
+        try:
+            if os.stat(path).st_mtime < cutoff:
+                os.unlink(path)
+                removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+class ResultResponse(Response):
+    """
+    Streams an UpscaleResult with an accurate Content-Length and support
+    for single-range requests.
+
+    File-backed results are sent with the ASGI zero-copy or path-send
+    extensions when the server offers them, and read in chunks otherwise.
+    """
+
+    def __init__(
+        self,
+        result: UpscaleResult,
+        media_type: str,
+        range_header: Optional[str] = None,
+        if_range: Optional[str] = None,
+        etag: Optional[str] = None,
+        headers: Optional[dict] = None,
+        background: Optional[BackgroundTask] = None
+    ):
+        self.result = result
+        self.media_type = media_type
+        self.background = background
+        self.start = 0
+        self.end = result.size - 1
+        self.status_code = 200
+
+        extra = {"accept-ranges": "bytes"}
+        if etag:
+            extra["etag"] = etag
+        if headers:
+            extra.update(headers)
+
+        # A stale If-Range means the client must get the full, new body
+        if range_header and (if_range is None or (etag is not None and if_range == etag)):
+            byte_range = self._parse_range(range_header, result.size)
+            if byte_range is None:
+                self.status_code = 416
+                self.start, self.end = 0, -1
+                extra["content-range"] = f"bytes */{result.size}"
+            elif byte_range != (0, result.size - 1):
+                self.status_code = 206
+                self.start, self.end = byte_range
+                extra["content-range"] = f"bytes {self.start}-{self.end}/{result.size}"
+
+        self.body = b""
+        self.init_headers(extra)
+        self.headers["content-length"] = str(self.end - self.start + 1)
+
+    @staticmethod
+    def _parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+        """
+        Parses a single "bytes=" range. Multiple ranges are answered with
+        the full body.
+
+        Returns:
+            Optional[Tuple[int, int]]: The inclusive byte range, or None if unsatisfiable
+        """
+        if "," in range_header:
+            return 0, size - 1
+        match = RANGE_PATTERN.match(range_header.strip())
+        if not match or match.groups() == ("", ""):
+            return 0, size - 1
+        first, last = match.groups()
+        if first == "":
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length == 0:
+                return None
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+        if start >= size or end < start:
+            return None
+        return start, min(end, size - 1)
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await self._send_body(scope, send)
+        finally:
+            # Owned spool files are removed once they have been sent
+            self.result.close()
+
+        if self.background is not None:
+            await self.background()
+
+    async def _send_body(self, scope, send) -> None:
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+
+        count = self.end - self.start + 1
+        extensions = scope.get("extensions") or {}
+        if scope["method"].upper() == "HEAD" or count <= 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        elif self.result.data is not None:
+            if count == self.result.size and count <= RESPONSE_CHUNK_SIZE:
+                await send({"type": "http.response.body", "body": self.result.data, "more_body": False})
+                return
+            view = memoryview(self.result.data)
+            for offset in range(self.start, self.end + 1, RESPONSE_CHUNK_SIZE):
+                chunk_end = min(offset + RESPONSE_CHUNK_SIZE, self.end + 1)
+                await send({
+                    "type": "http.response.body",
+                    "body": bytes(view[offset:chunk_end]),
+                    "more_body": chunk_end <= self.end,
+                })
+        elif "http.response.zerocopysend" in extensions:
+            with open(self.result.path, "rb") as f:
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": f,
+                    "offset": self.start,
+                    "count": count,
+                    "more_body": False,
+                })
+        elif "http.response.pathsend" in extensions and self.status_code == 200:
+            await send({"type": "http.response.pathsend", "path": self.result.path})
+        else:
+            loop = asyncio.get_running_loop()
+            with open(self.result.path, "rb") as f:
+                f.seek(self.start)
+                remaining = count
+                while remaining > 0:
+                    chunk = await loop.run_in_executor(None, f.read, min(RESPONSE_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+            if remaining > 0:
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
@@ -0,0 +1,182 @@
+import os
+import math
+import logging
+from typing import Optional, Dict, Any, List, Tuple
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+# The scale the model's network computes at. Real-ESRGAN x4plus always runs
+# at 4x and resizes its output for any other requested scale, so asking it
+# for more than this only makes the prediction resample on the GPU.
+UPSCALE_MODEL_NATIVE_SCALE = int(os.getenv("UPSCALE_MODEL_NATIVE_SCALE", "4"))
+# The largest scale the model accepts in one pass
+UPSCALE_MODEL_MAX_SCALE = int(os.getenv("UPSCALE_MODEL_MAX_SCALE", "10"))
+# Larger inputs are downscaled before upload; the model slows down sharply
+# and can run out of GPU memory above this
+UPSCALE_MODEL_MAX_INPUT_PIXELS = int(os.getenv("UPSCALE_MODEL_MAX_INPUT_PIXELS", str(2_000_000)))
+# Most model passes chained in one plan
+UPSCALE_MAX_MODEL_PASSES = int(os.getenv("UPSCALE_MAX_MODEL_PASSES", "2"))
+# Largest factor left to the local LANCZOS resample after the model
+UPSCALE_MAX_RESAMPLE_FACTOR = float(os.getenv("UPSCALE_MAX_RESAMPLE_FACTOR", "4"))
+
+# Cost model used to rank plans. Prediction time is billed per second and
+# grows with the pixels the network reads and the pixels it writes out.
+UPSCALE_GPU_PRICE_PER_SECOND = float(os.getenv("UPSCALE_GPU_PRICE_PER_SECOND", "0.000225"))
+UPSCALE_PASS_OVERHEAD_SECONDS = float(os.getenv("UPSCALE_PASS_OVERHEAD_SECONDS", "1.0"))
+UPSCALE_MODEL_SECONDS_PER_INPUT_MP = float(os.getenv("UPSCALE_MODEL_SECONDS_PER_INPUT_MP", "2.0"))
+UPSCALE_MODEL_SECONDS_PER_OUTPUT_MP = float(os.getenv("UPSCALE_MODEL_SECONDS_PER_OUTPUT_MP", "0.05"))
+# Unbilled time spent moving pixels to and from the model
+UPSCALE_TRANSFER_SECONDS_PER_MP = float(os.getenv("UPSCALE_TRANSFER_SECONDS_PER_MP", "0.05"))
+# Local CPU time per output megapixel of a LANCZOS resample
+UPSCALE_RESAMPLE_SECONDS_PER_MP = float(os.getenv("UPSCALE_RESAMPLE_SECONDS_PER_MP", "0.02"))
+
+
+class ScalePlan:
+    """
+    How one upscale is carried out: an optional downscale of the input
+    before upload, one or more model passes, and a local resample of the
+    model output to the exact requested size.
+    """
+
+    def __init__(
+        self,
+        input_size: Tuple[int, int],
+        scale_factor: int,
+        model_input_size: Tuple[int, int],
+        model_scales: List[float]
+    ):
+        self.input_size = input_size
+        self.scale_factor = scale_factor
+        self.output_size = (input_size[0] * scale_factor, input_size[1] * scale_factor)
+        self.model_input_size = model_input_size
+        self.model_scales = model_scales
+
+        # Pixel counts, in megapixels, read and written by each model pass
+        self._passes: List[Tuple[float, float]] = []
+        width, height = model_input_size
+        for scale in model_scales:
+            # The model truncates, like int()
+            out_width, out_height = int(width * scale), int(height * scale)
+            self._passes.append((width * height / 1e6, out_width * out_height / 1e6))
+            width, height = out_width, out_height
+        self.model_output_size = (width, height)
+
+        self.gpu_seconds = sum(
+            UPSCALE_PASS_OVERHEAD_SECONDS
+            + UPSCALE_MODEL_SECONDS_PER_INPUT_MP * in_mp
+            + UPSCALE_MODEL_SECONDS_PER_OUTPUT_MP * out_mp
+            for in_mp, out_mp in self._passes
+        )
+        self.cost_usd = self.gpu_seconds * UPSCALE_GPU_PRICE_PER_SECOND
+        local_mp = 0.0
+        if self.downscales:
+            local_mp += model_input_size[0] * model_input_size[1] / 1e6
+        if self.resamples:
+            local_mp += self.output_size[0] * self.output_size[1] / 1e6
+        self.seconds = (
+            self.gpu_seconds
+            + UPSCALE_TRANSFER_SECONDS_PER_MP * sum(in_mp + out_mp for in_mp, out_mp in self._passes)
+            + UPSCALE_RESAMPLE_SECONDS_PER_MP * local_mp
+        )
+
+    @property
+    def downscales(self) -> bool:
+        return self.model_input_size != self.input_size
+
+    @property
+    def resamples(self) -> bool:
+        return self.model_output_size != self.output_size
+
+    @property
+    def resample_factor(self) -> float:
+        return self.output_size[0] / self.model_output_size[0]
+
+    def describe(self) -> str:
+        steps = []
+        if self.downscales:
+            steps.append(f"downscale to {self.model_input_size[0]}x{self.model_input_size[1]}")
+        steps.extend(f"model x{scale:g}" for scale in self.model_scales)
+        if self.resamples:
+            steps.append(f"resample to {self.output_size[0]}x{self.output_size[1]}")
+        return " > ".join(steps)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "steps": self.describe(),
+            "model_input_size": list(self.model_input_size),
+            "model_scales": self.model_scales,
+            "output_size": list(self.output_size),
+            "estimated_gpu_seconds": round(self.gpu_seconds, 2),
+            "estimated_cost_usd": round(self.cost_usd, 6),
+            "estimated_seconds": round(self.seconds, 2),
+        }
+
+
+def _candidate_passes(factor: float) -> List[List[float]]:
+    """
+    Lists the sequences of model scales worth considering for an overall
+    factor. Each pass runs at the native scale, or at a smaller scale when
+    less than that is left to do; a single pass at the whole factor (what
+    the model does when simply asked for it) is included for comparison.
+    """
+    native = UPSCALE_MODEL_NATIVE_SCALE
+    candidates = []
+    for passes in range(1, UPSCALE_MAX_MODEL_PASSES + 1):
+        remaining = factor / native ** (passes - 1)
+        if remaining < 1 or (passes > 1 and remaining < 2):
+            # A pass that barely enlarges costs a prediction for nothing
+            break
+        candidates.append([native] * (passes - 1) + [min(remaining, native)])
+    if native < factor <= UPSCALE_MODEL_MAX_SCALE:
+        candidates.append([factor])
+    return candidates
+
+
+def plan_upscale(width: int, height: int, scale_factor: int) -> ScalePlan:
+    """
+    Picks the cheapest way to upscale an image with the model.
+
+    Plans are ranked by estimated prediction cost, then by how little is
+    left to the local resample (the model recovers detail a resample
+    cannot), then by estimated wall time. A plan leaving more than
+    UPSCALE_MAX_RESAMPLE_FACTOR to the resample is only chosen when no
+    other plan fits.
+
+    Args:
+        width: The input width
+        height: The input height
+        scale_factor: The requested scale factor
+
+    Returns:
+        ScalePlan: The plan
+    """
+    # Oversized inputs are downscaled before upload, which leaves a larger
+    # factor for the model and the resample to make up
+    factor: float = scale_factor
+    model_input_size = (width, height)
+    ratio = math.sqrt(UPSCALE_MODEL_MAX_INPUT_PIXELS / (width * height))
+    if ratio < 1:
+        model_input_size = (max(1, int(width * ratio)), max(1, int(height * ratio)))
+        factor = round(scale_factor * width / model_input_size[0], 4)
+
+    best: Optional[ScalePlan] = None
+    best_key = None
+    for model_scales in _candidate_passes(factor):
+        plan = ScalePlan((width, height), scale_factor, model_input_size, model_scales)
+        # Every pass after the first reads the previous pass's output
+        if any(in_mp * 1e6 > UPSCALE_MODEL_MAX_INPUT_PIXELS for in_mp, _ in plan._passes[1:]):
+            continue
+        key = (
+            plan.resample_factor > UPSCALE_MAX_RESAMPLE_FACTOR,
+            round(plan.cost_usd, 6),
+            round(plan.resample_factor, 3),
+            plan.seconds,
+        )
+        if best is None or key < best_key:
+            best, best_key = plan, key
+    return best
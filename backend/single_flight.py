@@ -0,0 +1,112 @@
+import asyncio
+import logging
+from typing import Optional, Dict, Any, Callable, Awaitable, Generic, TypeVar
+
+try:
+    from . import metrics
+except ImportError:
+    from backend import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class _Flight(Generic[T]):
+    def __init__(self, task: "asyncio.Future[T]"):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls: the first caller for a key starts
+    the work, and callers arriving while it runs wait for the same work
+    instead of starting their own.
+
+    The work runs as its own task. A waiter that is cancelled (for example
+    because its client disconnected) stops waiting without disturbing the
+    others; the work is cancelled only when its last waiter is. Each waiter
+    receives its own handle on the result, made with `share`, and the
+    original is released with `release` once every waiter has one.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._flights: Dict[str, _Flight] = {}
+        self._stats = {"started": 0, "coalesced": 0, "cancelled": 0}
+
+    def in_flight(self, key: str) -> bool:
+        return key in self._flights
+
+    def _forget(self, key: str, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def run(
+        self,
+        key: str,
+        fn: Callable[[], Awaitable[T]],
+        share: Callable[[T], T],
+        release: Optional[Callable[[T], None]] = None
+    ) -> T:
+        """
+        Runs fn, or waits for the run already in flight for the same key.
+
+        Args:
+            key: Identifies the work; calls with equal keys are coalesced
+            fn: Starts the work
+            share: Makes a waiter's own handle on the work's result
+            release: Releases the work's result once every waiter has shared it
+
+        Returns:
+            The shared result
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            async def call() -> T:
+                try:
+                    return await fn()
+                finally:
+                    # Later callers start afresh (and will likely hit the cache)
+                    self._forget(key, flight)
+
+            flight = _Flight(asyncio.ensure_future(call()))
+            self._flights[key] = flight
+            self._stats["started"] += 1
+        else:
+            self._stats["coalesced"] += 1
+            metrics.count(f"{self.name}_coalesced")
+
+        flight.waiters += 1
+        try:
+            value = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            flight.waiters -= 1
+            if flight.waiters == 0:
+                if not flight.task.done():
+                    # Nobody is left to use the result
+                    self._forget(key, flight)
+                    flight.task.cancel()
+                    self._stats["cancelled"] += 1
+                    logger.debug("Cancelled %s %.12s; all its waiters went away", self.name, key)
+                elif release is not None and not flight.task.cancelled() and flight.task.exception() is None:
+                    release(flight.task.result())
+            raise
+        except BaseException:
+            flight.waiters -= 1
+            raise
+
+        flight.waiters -= 1
+        try:
+            return share(value)
+        finally:
+            if flight.waiters == 0 and release is not None:
+                release(value)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._stats,
+            "in_flight": len(self._flights),
+            "waiters": sum(flight.waiters for flight in self._flights.values()),
+        }
@@ -0,0 +1,356 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+import tempfile
+from typing import Optional, Dict, Any, List
+from dotenv import load_dotenv
+
+try:
+    from .database import DatabaseHandler
+    from .results import UpscaleResult
+    from . import metrics
+except ImportError:
+    from backend.database import DatabaseHandler
+    from backend.results import UpscaleResult
+    from backend import metrics
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+STORAGE_UPLOAD_CONCURRENCY = int(os.getenv("STORAGE_UPLOAD_CONCURRENCY", "4"))
+STORAGE_UPLOAD_RETRIES = int(os.getenv("STORAGE_UPLOAD_RETRIES", "3"))
+STORAGE_RETRY_DELAY_SECONDS = float(os.getenv("STORAGE_RETRY_DELAY_SECONDS", "1"))
+# Queued uploads beyond this many bytes wait on disk instead of in memory
+STORAGE_QUEUE_MEMORY_BYTES = int(os.getenv("STORAGE_QUEUE_MEMORY_BYTES", str(64 * 1024 * 1024)))
+STORAGE_QUEUE_DIR = os.getenv("STORAGE_QUEUE_DIR", os.path.join(tempfile.gettempdir(), "upscaloro-storage-queue"))
+STORAGE_DRAIN_TIMEOUT_SECONDS = float(os.getenv("STORAGE_DRAIN_TIMEOUT_SECONDS", "20"))
+# How often uploads left on disk (by failed uploads or other processes) are picked up
+STORAGE_RECOVER_INTERVAL_SECONDS = float(os.getenv("STORAGE_RECOVER_INTERVAL_SECONDS", "300"))
+# Times an upload that keeps failing is picked up again before it is dropped
+STORAGE_MAX_RECOVERIES = int(os.getenv("STORAGE_MAX_RECOVERIES", "12"))
+
+
+class StorageUpload:
+    """
+    A result waiting to be stored, held in memory or in a spill file.
+    """
+
+    def __init__(
+        self,
+        user_id: str,
+        file_name: str,
+        data: Optional[bytes] = None,
+        path: Optional[str] = None,
+        upload_id: Optional[str] = None,
+        recoveries: int = 0
+    ):
+        self.id = upload_id or uuid.uuid4().hex
+        self.user_id = user_id
+        self.file_name = file_name
+        self.data = data
+        self.path = path
+        self.attempts = 0
+        # Times the upload has been picked up from disk
+        self.recoveries = recoveries
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"id": self.id, "user_id": self.user_id, "file_name": self.file_name, "recoveries": self.recoveries}
+
+
+class StorageQueue:
+    """
+    Uploads results to Supabase Storage in the background, so responses
+    never wait for storage.
+
+    Uploads run STORAGE_UPLOAD_CONCURRENCY at a time and are retried with
+    backoff. Up to STORAGE_QUEUE_MEMORY_BYTES of backlog is held in memory
+    and the rest waits on disk. Uploads that run out of retries, and
+    anything still queued at shutdown, are left on disk, where they are
+    picked up again every STORAGE_RECOVER_INTERVAL_SECONDS by this or
+    another process.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = STORAGE_UPLOAD_CONCURRENCY,
+        memory_bytes: int = STORAGE_QUEUE_MEMORY_BYTES,
+        directory: str = STORAGE_QUEUE_DIR
+    ):
+        self.concurrency = concurrency
+        self.memory_bytes = memory_bytes
+        self.directory = directory
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks = []
+        self._memory_size = 0
+        self._uploading = 0
+        self._stats = {
+            "enqueued": 0,
+            "spilled": 0,
+            "uploaded": 0,
+            "retries": 0,
+            "failed": 0,
+            "persisted": 0,
+            "dropped": 0,
+            "upload_seconds": 0.0,
+            "max_upload_seconds": 0.0,
+        }
+
+    def _paths(self, upload_id: str):
+        base = os.path.join(self.directory, upload_id)
+        return f"{base}.bin", f"{base}.json"
+
+    def _spill(self, upload: StorageUpload, result: Optional[UpscaleResult] = None) -> None:
+        """
+        Moves an upload's data to disk, linking file-backed results instead
+        of copying them.
+        """
+        data_path, _ = self._paths(upload.id)
+        os.makedirs(self.directory, exist_ok=True)
+        if result is not None:
+            result.save_to(data_path)
+        elif upload.data is not None:
+            with open(data_path + ".tmp", "wb") as f:
+                f.write(upload.data)
+            os.replace(data_path + ".tmp", data_path)
+        upload.data = None
+        upload.path = data_path
+
+    def _persist(self, upload: StorageUpload) -> None:
+        """
+        Hands an upload over to the next process to start. Spill files
+        without a metadata file still belong to a running queue.
+        """
+        if upload.data is not None:
+            self._spill(upload)
+        _, meta_path = self._paths(upload.id)
+        with open(meta_path + ".tmp", "w") as f:
+            json.dump(upload.to_dict(), f)
+        os.replace(meta_path + ".tmp", meta_path)
+        try:
+            # Left by this process recovering it
+            os.unlink(meta_path + ".claimed")
+        except OSError:
+            pass
+
+    def _remove(self, upload: StorageUpload) -> None:
+        if upload.path is None:
+            return
+        data_path, meta_path = self._paths(upload.id)
+        for path in (data_path, meta_path + ".claimed"):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def _recover(self) -> List[StorageUpload]:
+        """
+        Claims uploads left on disk. Each one is claimed with an atomic
+        rename, so only one worker process picks it up.
+        """
+        recovered = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return recovered
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if name.endswith(".bin"):
+                # Spilled by a process that died without handing it over
+                try:
+                    meta_path = path[:-4] + ".json"
+                    if (
+                        os.stat(path).st_mtime < time.time() - 86400
+                        and not os.path.exists(meta_path)
+                        and not os.path.exists(meta_path + ".claimed")
+                    ):
+                        os.unlink(path)
+                except OSError:
+                    pass
+                continue
+            if not name.endswith(".json"):
+                continue
+            try:
+                os.rename(path, path + ".claimed")
+                with open(path + ".claimed") as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue
+            data_path, _ = self._paths(meta["id"])
+            if not os.path.exists(data_path):
+                continue
+            recovered.append(StorageUpload(
+                meta["user_id"],
+                meta["file_name"],
+                path=data_path,
+                upload_id=meta["id"],
+                recoveries=meta.get("recoveries", 0) + 1
+            ))
+        return recovered
+
+    async def _requeue_recovered(self) -> int:
+        loop = asyncio.get_running_loop()
+        uploads = await loop.run_in_executor(None, self._recover)
+        for upload in uploads:
+            self._queue.put_nowait(upload)
+        return len(uploads)
+
+    async def _recoverer(self) -> None:
+        while True:
+            await asyncio.sleep(STORAGE_RECOVER_INTERVAL_SECONDS)
+            try:
+                recovered = await self._requeue_recovered()
+            except Exception as e:
+                logger.error(f"Error recovering storage uploads: {str(e)}")
+                continue
+            if recovered:
+                logger.info(f"Recovered {recovered} pending storage uploads from {self.directory}")
+
+    async def start(self) -> None:
+        """
+        Starts the upload workers and queues any spilled backlog.
+        """
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue()
+        recovered = await self._requeue_recovered()
+        if recovered:
+            logger.info(f"Recovered {recovered} pending storage uploads from {self.directory}")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        self._tasks.append(asyncio.create_task(self._recoverer()))
+
+    async def stop(self, timeout: float = STORAGE_DRAIN_TIMEOUT_SECONDS) -> None:
+        """
+        Waits up to `timeout` seconds for queued uploads to finish, then
+        hands whatever is left to the next process through the disk.
+        """
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Storage queue not drained after {timeout}s; spilling {self._queue.qsize()} uploads")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        loop = asyncio.get_running_loop()
+        while not self._queue.empty():
+            upload = self._queue.get_nowait()
+            try:
+                await loop.run_in_executor(None, self._persist, upload)
+            except OSError as e:
+                logger.error(f"Lost storage upload {upload.file_name} for {upload.user_id}: {str(e)}")
+        self._queue = None
+        self._memory_size = 0
+
+    async def enqueue(self, user_id: str, result: UpscaleResult, file_name: str) -> None:
+        """
+        Queues a result for upload. The caller keeps ownership of the result.
+
+        Args:
+            user_id: The user ID
+            result: The result to store
+            file_name: The file name
+        """
+        if self._queue is None:
+            raise RuntimeError("Storage queue is not running")
+        upload = StorageUpload(user_id, file_name)
+        if result.data is not None and self._memory_size + result.size <= self.memory_bytes:
+            # The bytes are immutable, so keeping a reference is not a copy
+            upload.data = result.data
+            self._memory_size += result.size
+        else:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._spill, upload, result)
+            self._stats["spilled"] += 1
+        self._stats["enqueued"] += 1
+        self._queue.put_nowait(upload)
+
+    async def _upload(self, upload: StorageUpload) -> bool:
+        if upload.data is not None:
+            return await DatabaseHandler.store_image(upload.user_id, upload.data, upload.file_name) is not None
+        loop = asyncio.get_running_loop()
+        f = await loop.run_in_executor(None, open, upload.path, "rb")
+        try:
+            return await DatabaseHandler.store_image(upload.user_id, f, upload.file_name) is not None
+        finally:
+            f.close()
+
+    async def _worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            upload = await self._queue.get()
+            self._uploading += 1
+            try:
+                stored = False
+                while True:
+                    upload.attempts += 1
+                    started = time.monotonic()
+                    with metrics.timed("store_image"):
+                        stored = await self._upload(upload)
+                    elapsed = time.monotonic() - started
+                    self._stats["upload_seconds"] += elapsed
+                    self._stats["max_upload_seconds"] = max(self._stats["max_upload_seconds"], elapsed)
+                    if stored:
+                        self._stats["uploaded"] += 1
+                        break
+                    if upload.attempts > STORAGE_UPLOAD_RETRIES:
+                        logger.error(
+                            f"Giving up on storing {upload.file_name} for {upload.user_id} "
+                            f"after {upload.attempts} attempts; leaving it to be recovered"
+                        )
+                        self._stats["failed"] += 1
+                        break
+                    self._stats["retries"] += 1
+                    await asyncio.sleep(STORAGE_RETRY_DELAY_SECONDS * 2 ** (upload.attempts - 1))
+
+                if upload.data is not None:
+                    self._memory_size -= len(upload.data)
+                if stored or upload.recoveries >= STORAGE_MAX_RECOVERIES:
+                    if not stored:
+                        logger.error(f"Dropping {upload.file_name} for {upload.user_id} after {upload.recoveries} recoveries")
+                        self._stats["dropped"] += 1
+                    upload.data = None
+                    await loop.run_in_executor(None, self._remove, upload)
+                else:
+                    await loop.run_in_executor(None, self._persist, upload)
+                    upload.data = None
+                    self._stats["persisted"] += 1
+            except asyncio.CancelledError:
+                # Put it back so stop() can spill it
+                self._queue.put_nowait(upload)
+                raise
+            except Exception as e:
+                logger.error(f"Error storing {upload.file_name} for {upload.user_id}: {str(e)}")
+                self._stats["failed"] += 1
+            finally:
+                self._uploading -= 1
+                self._queue.task_done()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns queue depth and upload latency statistics.
+
+        Returns:
+            Dict[str, Any]: The storage queue statistics
+        """
+        attempts = self._stats["uploaded"] + self._stats["retries"] + self._stats["failed"]
+        return {
+            **self._stats,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "uploading": self._uploading,
+            "memory_bytes": self._memory_size,
+            "avg_upload_seconds": self._stats["upload_seconds"] / attempts if attempts else 0.0,
+        }
+
+
+# Shared storage queue
+storage_queue = StorageQueue()
+metrics.register_collector("storage_queue", storage_queue.stats)
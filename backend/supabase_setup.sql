@@ -98,4 +98,46 @@ CREATE POLICY api_usage_policy ON api_usage
 -- Create storage buckets
 -- This needs to be done in the Supabase dashboard or via the API
 -- The following is a comment for reference:
--- CREATE STORAGE BUCKET images WITH public = false; 
\ No newline at end of file
+-- CREATE STORAGE BUCKET images WITH public = false; 
+-- Atomically add image counts for many users in one round trip.
+-- increments is a JSON array of {"user_id": ..., "amount": ...} objects with
+-- at most one entry per user, as sent by the backend's usage aggregator.
+-- Entries whose user_id is not a UUID, or whose amount is not a positive
+-- integer, are skipped rather than failing the whole statement; the CASEs
+-- keep the casts from running on them, which a plain AND in the WHERE
+-- clause would not guarantee.
+CREATE OR REPLACE FUNCTION increment_processed_images(increments JSONB)
+RETURNS TABLE (id UUID, images_processed_this_month INTEGER) AS $$
+    UPDATE users AS u
+    SET images_processed_this_month = u.images_processed_this_month + (i.value->>'amount')::INTEGER
+    FROM jsonb_array_elements(increments) AS i
+    WHERE u.id = CASE
+        WHEN i.value->>'user_id' ~* '^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$'
+        THEN (i.value->>'user_id')::UUID
+    END
+    AND CASE
+        WHEN i.value->>'amount' ~ '^[0-9]{1,9}$' THEN (i.value->>'amount')::INTEGER > 0
+        ELSE FALSE
+    END
+    RETURNING u.id, u.images_processed_this_month;
+$$ LANGUAGE sql SECURITY DEFINER SET search_path = public;
+
+-- Only the backend (which connects with the service role key) may count
+-- usage; PostgREST would otherwise expose this to every client as an RPC
+REVOKE EXECUTE ON FUNCTION increment_processed_images(JSONB) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION increment_processed_images(JSONB) TO service_role;
+
+-- Progress of scheduled maintenance jobs such as the image sweeper
+CREATE TABLE maintenance_checkpoints (
+    name TEXT PRIMARY KEY,
+    value JSONB NOT NULL DEFAULT '{}'::JSONB,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+CREATE TRIGGER update_maintenance_checkpoints_updated_at
+BEFORE UPDATE ON maintenance_checkpoints
+FOR EACH ROW
+EXECUTE FUNCTION update_updated_at_column();
+
+-- Only the service role reads and writes checkpoints
+ALTER TABLE maintenance_checkpoints ENABLE ROW LEVEL SECURITY;
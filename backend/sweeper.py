@@ -0,0 +1,214 @@
+"""
+Deletes stored images once they are older than IMAGE_RETENTION_HOURS.
+
+Images are stored under one folder per UTC hour (see image_partition), so a
+sweep lists the bucket root, picks the folders whose whole hour has expired
+and empties each one with paged list calls and bulk removes. Work is
+proportional to what has expired since the last run, not to everything
+ever stored.
+
+Emptied folders disappear from the listing and removing a file is
+idempotent, so an interrupted run simply resumes at the first folder that
+still has files. The maintenance_checkpoints table records whether any
+legacy files are left to look for, and when the sweep last ran.
+
+Runs on a schedule outside the web workers:
+
+    python -m backend.sweeper
+"""
+import os
+import re
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Dict, Any, List, Tuple
+from dotenv import load_dotenv
+
+try:
+    from .database import DatabaseHandler, image_partition, shutdown_executor
+    from .logging_config import configure_logging, shutdown_logging
+except ImportError:
+    from backend.database import DatabaseHandler, image_partition, shutdown_executor
+    from backend.logging_config import configure_logging, shutdown_logging
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+IMAGE_RETENTION_HOURS = int(os.getenv("IMAGE_RETENTION_HOURS", "24"))
+# Entries listed and files removed per storage request (the storage API allows up to 1000)
+SWEEP_BATCH_SIZE = int(os.getenv("SWEEP_BATCH_SIZE", "1000"))
+
+CHECKPOINT_NAME = "image_sweeper"
+PARTITION_PATTERN = re.compile(r"^\d{10}$")
+# Images stored before hour folders existed: user_id_YYYYMMDDHHMMSS_file_name
+LEGACY_TIMESTAMP_PATTERN = re.compile(r"_(\d{14})_")
+
+
+class SweepError(Exception):
+    """
+    Raised when a storage request fails during a sweep.
+    """
+
+
+class ImageSweeper:
+    """
+    Removes expired images from the images bucket in bulk.
+    """
+
+    def __init__(self, retention_hours: int = IMAGE_RETENTION_HOURS, batch_size: int = SWEEP_BATCH_SIZE):
+        self.retention = timedelta(hours=retention_hours)
+        self.batch_size = max(1, min(batch_size, 1000))
+
+    async def _remove(self, paths: List[str]) -> int:
+        removed = 0
+        for start in range(0, len(paths), self.batch_size):
+            count = await DatabaseHandler.remove_images(paths[start:start + self.batch_size])
+            if count is None:
+                raise SweepError("Removing images failed")
+            removed += count
+        return removed
+
+    async def _scan_root(self, cutoff: str, now: datetime, legacy: bool) -> Tuple[List[str], List[str], bool]:
+        """
+        Lists the bucket root and returns the expired hour folders, the
+        expired legacy files, and whether any legacy files will remain.
+        """
+        partitions: List[str] = []
+        legacy_expired: List[str] = []
+        legacy_remaining = False
+        offset = 0
+        while True:
+            entries = await DatabaseHandler.list_images("", limit=self.batch_size, offset=offset)
+            if entries is None:
+                raise SweepError("Listing the bucket root failed")
+            for entry in entries:
+                name = entry.get("name", "")
+                if entry.get("id") is None:
+                    if PARTITION_PATTERN.match(name) and name < cutoff:
+                        partitions.append(name)
+                    continue
+                if not legacy:
+                    continue
+                match = LEGACY_TIMESTAMP_PATTERN.search(name)
+                if match is None:
+                    continue
+                try:
+                    stored_at = datetime.strptime(match.group(1), "%Y%m%d%H%M%S").replace(tzinfo=timezone.utc)
+                except ValueError:
+                    continue
+                if now - stored_at > self.retention:
+                    legacy_expired.append(name)
+                else:
+                    legacy_remaining = True
+
+            if len(entries) < self.batch_size:
+                break
+            # Once the legacy files are gone the root holds only hour
+            # folders, in time order, so the rest has not expired yet
+            if not legacy and entries[-1].get("name", "") >= cutoff:
+                break
+            offset += len(entries)
+        return partitions, legacy_expired, legacy_remaining
+
+    async def _empty_partition(self, partition: str) -> int:
+        """
+        Removes every file in an hour folder, a page at a time.
+        """
+        removed = 0
+        while True:
+            # Removed files drop out of the listing, so always read the first page
+            entries = await DatabaseHandler.list_images(partition, limit=self.batch_size, offset=0)
+            if entries is None:
+                raise SweepError(f"Listing {partition} failed")
+            paths = [f"{partition}/{entry['name']}" for entry in entries if entry.get("id") is not None]
+            if not paths:
+                return removed
+            count = await self._remove(paths)
+            removed += count
+            if count == 0:
+                logger.warning(f"Could not remove any of {len(paths)} files in {partition}; skipping it")
+                return removed
+            if len(entries) < self.batch_size:
+                return removed
+
+    async def _save_checkpoint(self, checkpoint: Dict[str, Any]) -> None:
+        checkpoint["updated_at"] = datetime.now(timezone.utc).isoformat()
+        await DatabaseHandler.save_checkpoint(CHECKPOINT_NAME, checkpoint)
+
+    async def sweep(self, now: Optional[datetime] = None) -> Dict[str, Any]:
+        """
+        Deletes every image stored more than the retention period ago.
+
+        Args:
+            now: The current time (defaults to now)
+
+        Returns:
+            Dict[str, Any]: A summary of the run; "completed" is False if it stopped on an error
+        """
+        now = now or datetime.now(timezone.utc)
+        # An hour folder expires once the newest image it can hold has expired
+        cutoff = image_partition(now - self.retention)
+        started = time.monotonic()
+        checkpoint = await DatabaseHandler.get_checkpoint(CHECKPOINT_NAME) or {}
+        # Written by earlier versions, but never used to resume
+        checkpoint.pop("swept_through", None)
+        summary = {
+            "completed": False,
+            "cutoff": cutoff,
+            "partitions": 0,
+            "removed": 0,
+            "legacy_removed": 0,
+        }
+
+        try:
+            legacy = not checkpoint.get("legacy_done", False)
+            partitions, legacy_expired, legacy_remaining = await self._scan_root(cutoff, now, legacy)
+
+            if legacy_expired:
+                summary["legacy_removed"] = await self._remove(legacy_expired)
+            if legacy and not legacy_remaining:
+                checkpoint["legacy_done"] = True
+                await self._save_checkpoint(checkpoint)
+
+            for partition in partitions:
+                summary["removed"] += await self._empty_partition(partition)
+                summary["partitions"] += 1
+
+            await self._save_checkpoint(checkpoint)
+            summary["completed"] = True
+        except SweepError as e:
+            logger.error(f"Image sweep stopped: {str(e)}")
+
+        summary["seconds"] = round(time.monotonic() - started, 2)
+        logger.info(
+            f"Image sweep {'finished' if summary['completed'] else 'stopped'} in {summary['seconds']}s: "
+            f"removed {summary['removed']} images from {summary['partitions']} hour folders before {cutoff} "
+            f"and {summary['legacy_removed']} legacy images"
+        )
+        return summary
+
+
+async def _main() -> bool:
+    try:
+        summary = await ImageSweeper().sweep()
+        return summary["completed"]
+    finally:
+        shutdown_executor()
+
+
+def main() -> None:
+    configure_logging()
+    try:
+        succeeded = asyncio.run(_main())
+    finally:
+        shutdown_logging()
+    if not succeeded:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
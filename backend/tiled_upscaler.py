@@ -0,0 +1,401 @@
+import os
+import math
+import time
+import logging
+import struct
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Executor, Future
+from io import BytesIO
+from typing import BinaryIO, Deque, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+from dotenv import load_dotenv
+
+try:
+    from . import encoder
+except ImportError:
+    from backend import encoder
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+# Edge length (in input pixels) of the tiles handed to the worker processes
+TILE_SIZE = int(os.getenv("TILED_UPSCALE_TILE_SIZE", "256"))
+# Number of worker processes; 0 means one per CPU core
+WORKERS = int(os.getenv("TILED_UPSCALE_WORKERS", "0")) or (os.cpu_count() or 1)
+# Outputs smaller than this (in pixels) are resized in a single pass
+MIN_TILED_PIXELS = int(os.getenv("TILED_UPSCALE_MIN_PIXELS", str(4_000_000)))
+# Upper bound on the size of one band of output rows held in memory
+BAND_BYTES = int(os.getenv("TILED_UPSCALE_BAND_BYTES", str(64 * 1024 * 1024)))
+
+# LANCZOS reads 3 source pixels on each side when enlarging, and 3 times
+# the reduction factor when shrinking; one extra pixel guards against
+# rounding at the tile edges. See _margin.
+LANCZOS_SUPPORT = 3
+
+# How many bands may be in flight in the process pool at once
+BANDS_IN_FLIGHT = 2
+
+# PNG color types for the modes the streaming encoder supports
+PNG_COLOR_TYPES = {"L": 0, "RGB": 2, "LA": 4, "RGBA": 6}
+
+PNG_FILTER_SUB = encoder.PNG_FILTERS["sub"]
+PNG_FILTER_UP = encoder.PNG_FILTERS["up"]
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> Optional[Executor]:
+    """
+    Returns the shared process pool, creating it on first use.
+
+    Returns:
+        Optional[Executor]: The pool, or None when tiles should run inline
+    """
+    global _pool
+    if WORKERS <= 1:
+        return None
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                logger.info(f"Starting tiled upscale pool with {WORKERS} workers")
+                _pool = ProcessPoolExecutor(max_workers=WORKERS)
+    return _pool
+
+
+def shutdown_pool() -> None:
+    """
+    Shuts down the shared process pool if it was started.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def _resize_tile(
+    mode: str,
+    size: Tuple[int, int],
+    data: bytes,
+    box: Tuple[float, float, float, float],
+    out_size: Tuple[int, int]
+) -> bytes:
+    """
+    Resizes one tile. Runs inside a worker process.
+
+    Args:
+        mode: The PIL mode of the tile
+        size: The size of the tile including its margin
+        data: The raw pixel data of the tile
+        box: The region of the tile (excluding the margin) to resample
+        out_size: The size of the resized region
+
+    Returns:
+        bytes: The raw pixel data of the resized region
+    """
+    tile = Image.frombytes(mode, size, data)
+    return tile.resize(out_size, Image.LANCZOS, box=box).tobytes()
+
+
+class PNGStreamWriter:
+    """
+    Writes a PNG file row band by row band without holding the full image.
+    """
+
+    def __init__(
+        self,
+        fp: BinaryIO,
+        width: int,
+        height: int,
+        mode: str,
+        compress_level: int = encoder.PNG_COMPRESS_LEVEL,
+        filter_name: str = encoder.PNG_FILTER
+    ):
+        if mode not in PNG_COLOR_TYPES:
+            raise ValueError(f"Unsupported mode for PNG streaming: {mode}")
+        if filter_name not in encoder.PNG_FILTERS:
+            raise ValueError(f"Unknown PNG filter: {filter_name}. Must be one of: {', '.join(encoder.PNG_FILTERS)}")
+        self.fp = fp
+        self.compressor = zlib.compressobj(compress_level)
+        self.filter_type = encoder.PNG_FILTERS[filter_name]
+        self.bytes_per_pixel = len(mode)
+        self.bytes_written = 0
+        self.encode_seconds = 0.0
+        self._previous_row: Optional[np.ndarray] = None
+        self._write_signature()
+        self._write_chunk(
+            b"IHDR",
+            struct.pack(">IIBBBBB", width, height, 8, PNG_COLOR_TYPES[mode], 0, 0, 0)
+        )
+
+    def _write_signature(self) -> None:
+        self.fp.write(b"\x89PNG\r\n\x1a\n")
+        self.bytes_written += 8
+
+    def _write_chunk(self, chunk_type: bytes, data: bytes) -> None:
+        self.bytes_written += len(data) + 12
+        self.fp.write(struct.pack(">I", len(data)))
+        self.fp.write(chunk_type)
+        self.fp.write(data)
+        self.fp.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type))))
+
+    def write_rows(self, rows: np.ndarray) -> None:
+        """
+        Compresses a band of rows.
+
+        Args:
+            rows: A (height, width * channels) uint8 array of raw pixel rows
+        """
+        started = time.perf_counter()
+        filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = self.filter_type
+        # uint8 arithmetic wraps modulo 256, as the PNG filters require
+        if self.filter_type == PNG_FILTER_SUB:
+            bpp = self.bytes_per_pixel
+            filtered[:, 1:bpp + 1] = rows[:, :bpp]
+            np.subtract(rows[:, bpp:], rows[:, :-bpp], out=filtered[:, bpp + 1:])
+        elif self.filter_type == PNG_FILTER_UP:
+            # The first row of a band is filtered against the last row of the
+            # previous band; the first row of the image against zeros
+            if self._previous_row is None:
+                filtered[0, 1:] = rows[0]
+            else:
+                np.subtract(rows[0], self._previous_row, out=filtered[0, 1:])
+            np.subtract(rows[1:], rows[:-1], out=filtered[1:, 1:])
+            self._previous_row = rows[-1].copy()
+        else:
+            filtered[:, 1:] = rows
+        data = self.compressor.compress(filtered.data)
+        if data:
+            self._write_chunk(b"IDAT", data)
+        self.encode_seconds += time.perf_counter() - started
+
+    def close(self) -> None:
+        """
+        Flushes the compressor and writes the end of the file.
+        """
+        started = time.perf_counter()
+        data = self.compressor.flush()
+        if data:
+            self._write_chunk(b"IDAT", data)
+        self._write_chunk(b"IEND", b"")
+        self.encode_seconds += time.perf_counter() - started
+
+
+def _margin(size: int, out_size: int) -> int:
+    """
+    Returns how many source pixels a tile needs beyond its edges so that
+    every output pixel sees all the pixels the filter reads for it. With
+    it, tiles stitch into exactly a full-frame resize at whole-number
+    enlargements (2x, 3x, 4x). At other factors the filter weights of a
+    tile are computed from slightly different floating-point offsets, so
+    a value can land a step or two away; in RGBA the color of a nearly
+    transparent pixel, which is divided by its alpha, can differ by much
+    more while the composited pixel still differs by at most two.
+    """
+    return math.ceil(LANCZOS_SUPPORT * max(1.0, size / out_size)) + 1
+
+
+class TiledUpscaler:
+    """
+    Upscales images with LANCZOS resampling, splitting large images into
+    overlapping tiles that are resized in a process pool.
+    """
+
+    @staticmethod
+    def _prepare(img: Image.Image, pil_format: str) -> Image.Image:
+        """
+        Converts an image to a mode that the tile workers and the target
+        encoder can handle.
+        """
+        img.load()
+        if img.mode == "P":
+            img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+        elif img.mode not in PNG_COLOR_TYPES:
+            img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+        if pil_format == "JPEG" and img.mode in ("RGBA", "LA"):
+            img = img.convert("RGB" if img.mode == "RGBA" else "L")
+        return img
+
+    @staticmethod
+    def _submit_band(
+        pool: Optional[Executor],
+        img: Image.Image,
+        y0: int,
+        y1: int,
+        out_size: Tuple[int, int]
+    ) -> List[Future]:
+        """
+        Submits every tile of the band of input rows [y0, y1) for resizing.
+
+        Tile edges are mapped to whole output pixels, and each tile resamples
+        exactly the source region behind its output pixels, so fractional
+        scale factors stitch without seams too.
+        """
+        width, height = img.size
+        out_width, out_height = out_size
+        out_y0 = y0 * out_height // height
+        out_y1 = y1 * out_height // height
+        margin_x = _margin(width, out_width)
+        margin_y = _margin(height, out_height)
+        crop_y0 = max(0, y0 - margin_y)
+        crop_y1 = min(height, y1 + margin_y)
+        futures = []
+        for x0 in range(0, width, TILE_SIZE):
+            x1 = min(width, x0 + TILE_SIZE)
+            out_x0 = x0 * out_width // width
+            out_x1 = x1 * out_width // width
+            crop_x0 = max(0, x0 - margin_x)
+            crop_x1 = min(width, x1 + margin_x)
+            tile = img.crop((crop_x0, crop_y0, crop_x1, crop_y1))
+            args = (
+                tile.mode,
+                tile.size,
+                tile.tobytes(),
+                (
+                    out_x0 * width / out_width - crop_x0,
+                    out_y0 * height / out_height - crop_y0,
+                    out_x1 * width / out_width - crop_x0,
+                    out_y1 * height / out_height - crop_y0,
+                ),
+                (out_x1 - out_x0, out_y1 - out_y0),
+            )
+            if pool is None:
+                future: Future = Future()
+                future.set_result(_resize_tile(*args))
+            else:
+                future = pool.submit(_resize_tile, *args)
+            futures.append(future)
+        return futures
+
+    @staticmethod
+    def _iter_bands(img: Image.Image, out_size: Tuple[int, int]):
+        """
+        Yields each band of resized rows as a (height, width * channels) array,
+        keeping at most BANDS_IN_FLIGHT bands queued in the pool.
+        """
+        width, height = img.size
+        channels = len(img.getbands())
+        out_row_bytes = out_size[0] * channels
+        band_rows = max(1, min(TILE_SIZE, BAND_BYTES * height // (out_row_bytes * out_size[1])))
+        pool = _get_pool()
+
+        pending: Deque[Tuple[int, int, List[Future]]] = deque()
+        next_y = 0
+        while next_y < height or pending:
+            while next_y < height and len(pending) < BANDS_IN_FLIGHT:
+                y1 = min(height, next_y + band_rows)
+                pending.append((next_y, y1, TiledUpscaler._submit_band(pool, img, next_y, y1, out_size)))
+                next_y = y1
+
+            y0, y1, futures = pending.popleft()
+            out_y0 = y0 * out_size[1] // height
+            out_rows = y1 * out_size[1] // height - out_y0
+            band = np.empty((out_rows, out_row_bytes), dtype=np.uint8)
+            offset = 0
+            for future in futures:
+                tile = np.frombuffer(future.result(), dtype=np.uint8).reshape(out_rows, -1)
+                band[:, offset:offset + tile.shape[1]] = tile
+                offset += tile.shape[1]
+            yield out_y0, band
+
+    @staticmethod
+    def resize(
+        img: Image.Image,
+        out_size: Tuple[int, int],
+        output_format: str,
+        out: BinaryIO
+    ) -> None:
+        """
+        Resizes an image to an exact size, usually larger, and writes the
+        encoded result to a file object.
+
+        PNG output is encoded band by band as the tiles complete, so only a
+        few bands are ever held in memory. Other formats need the whole
+        canvas for their encoder, so the tiles are pasted into it first;
+        encoder.check_size refuses canvases over ENCODE_MAX_BUFFERED_PIXELS.
+
+        Args:
+            img: The image to resize
+            out_size: The output (width, height)
+            output_format: Output format (jpeg, png, jpg, webp)
+            out: The file object to write the encoded image to
+        """
+        pil_format = encoder.pil_format(output_format)
+        encoder.check_size(output_format, out_size)
+
+        img = TiledUpscaler._prepare(img, pil_format)
+        width, height = img.size
+
+        if out_size[0] * out_size[1] < MIN_TILED_PIXELS:
+            encoder.encode(img.resize(out_size, Image.LANCZOS), output_format, out)
+            return
+
+        logger.info(f"Tiled upscale of {width}x{height} to {out_size[0]}x{out_size[1]} ({pil_format})")
+
+        if pil_format == "PNG":
+            writer = PNGStreamWriter(out, out_size[0], out_size[1], img.mode)
+            for _, band in TiledUpscaler._iter_bands(img, out_size):
+                writer.write_rows(band)
+            writer.close()
+            encoder.record(
+                output_format,
+                out_size[0] * out_size[1] * len(img.getbands()),
+                writer.bytes_written,
+                writer.encode_seconds
+            )
+            return
+
+        canvas = Image.new(img.mode, out_size)
+        for out_y, band in TiledUpscaler._iter_bands(img, out_size):
+            canvas.paste(
+                Image.frombuffer(img.mode, (out_size[0], band.shape[0]), band, "raw", img.mode, 0, 1),
+                (0, out_y)
+            )
+        encoder.encode(canvas, output_format, out)
+
+    @staticmethod
+    def upscale(
+        img: Image.Image,
+        scale_factor: int,
+        output_format: str,
+        out: BinaryIO
+    ) -> None:
+        """
+        Upscales an image by a whole factor and writes the encoded result to
+        a file object.
+
+        Args:
+            img: The image to upscale
+            scale_factor: The scale factor
+            output_format: Output format (jpeg, png, jpg, webp)
+            out: The file object to write the encoded image to
+        """
+        width, height = img.size
+        TiledUpscaler.resize(img, (width * scale_factor, height * scale_factor), output_format, out)
+
+    @staticmethod
+    def upscale_to_bytes(image_data: bytes, scale_factor: int, output_format: str) -> bytes:
+        """
+        Upscales encoded image data.
+
+        Args:
+            image_data: The image data in bytes
+            scale_factor: The scale factor
+            output_format: Output format (jpeg, png, jpg, webp)
+
+        Returns:
+            bytes: The encoded upscaled image
+        """
+        output = BytesIO()
+        with Image.open(BytesIO(image_data)) as img:
+            TiledUpscaler.upscale(img, scale_factor, output_format, output)
+        return output.getvalue()
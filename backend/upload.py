@@ -0,0 +1,245 @@
+import os
+import json
+import hashlib
+import logging
+from io import BytesIO
+from typing import Optional, Dict, Tuple
+from dotenv import load_dotenv
+from fastapi import UploadFile, HTTPException
+from PIL import Image, UnidentifiedImageError
+
+try:
+    from . import metrics
+except ImportError:
+    from backend import metrics
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(25 * 1024 * 1024)))
+# Whole request body of a /batch upload, across all of its files
+MAX_BATCH_UPLOAD_BYTES = int(os.getenv("MAX_BATCH_UPLOAD_BYTES", str(500 * 1024 * 1024)))
+MAX_INPUT_PIXELS = int(os.getenv("MAX_INPUT_PIXELS", str(40_000_000)))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Most of an upload read while looking for its image header
+PROBE_MAX_BYTES = 4 * 1024 * 1024
+
+# Request body limits per path prefix, enforced while the body arrives.
+# Multipart framing adds a little on top of the file itself.
+BODY_LIMITS: Dict[str, int] = {
+    "/upscale": MAX_UPLOAD_BYTES + 64 * 1024,
+    "/jobs": MAX_UPLOAD_BYTES + 64 * 1024,
+    "/batch": MAX_BATCH_UPLOAD_BYTES + 1024 * 1024,
+}
+
+
+def _body_too_large(limit: int) -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=f"Upload too large. The maximum size is {limit // (1024 * 1024)} MB."
+    )
+
+
+class UploadLimitMiddleware:
+    """
+    ASGI middleware that rejects request bodies over the configured limit
+    with 413, before the multipart parser has buffered them.
+    """
+
+    def __init__(self, app, limits: Optional[Dict[str, int]] = None):
+        self.app = app
+        self.limits = limits if limits is not None else BODY_LIMITS
+
+    def _limit_for(self, path: str) -> Optional[int]:
+        for prefix, limit in self.limits.items():
+            if path == prefix or path.startswith(prefix + "/"):
+                return limit
+        return None
+
+    async def _reject(self, send, limit: int) -> None:
+        body = json.dumps({"detail": _body_too_large(limit).detail}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("ascii")),
+                (b"connection", b"close"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        limit = self._limit_for(scope["path"])
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        # Reject up front when the client announces an oversized body
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                try:
+                    if int(value) > limit:
+                        logger.warning(f"Rejected {scope['path']} body of {int(value)} bytes (limit {limit})")
+                        await self._reject(send, limit)
+                        return
+                except ValueError:
+                    pass
+                break
+
+        # Otherwise count the bytes as they arrive (chunked or lying clients)
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    logger.warning(f"Aborted {scope['path']} body after {received} bytes (limit {limit})")
+                    raise _body_too_large(limit)
+            return message
+
+        async def tracked_send(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracked_send)
+        except HTTPException as e:
+            if e.status_code != 413 or response_started:
+                raise
+            await self._reject(send, limit)
+
+
+class IngestedUpload:
+    """
+    An uploaded image that has been size-checked, hashed and probed.
+
+    The data stays in the upload's spooled temporary file, which keeps small
+    uploads in memory and spills larger ones to disk.
+    """
+
+    def __init__(
+        self,
+        file: UploadFile,
+        size: int,
+        sha256: str,
+        image_format: str,
+        width: int,
+        height: int
+    ):
+        self.file = file
+        self.filename = file.filename
+        self.content_type = file.content_type
+        self.size = size
+        self.sha256 = sha256
+        self.format = image_format
+        self.width = width
+        self.height = height
+
+    async def read(self) -> bytes:
+        """
+        Reads the whole upload into the single buffer that the rest of the
+        pipeline shares.
+
+        Returns:
+            bytes: The image data
+        """
+        await self.file.seek(0)
+        data = await self.file.read()
+        metrics.count_bytes("ingest", len(data), copied=len(data))
+        return data
+
+
+async def ingest_upload(file: UploadFile, max_bytes: int = MAX_UPLOAD_BYTES) -> IngestedUpload:
+    """
+    Streams an upload in chunks, enforcing the size limit while computing the
+    content hash and probing the image header in the same pass.
+
+    Args:
+        file: The uploaded file
+        max_bytes: The maximum allowed size in bytes
+
+    Returns:
+        IngestedUpload: The ingested upload
+
+    Raises:
+        HTTPException: 413 if the upload is too large, 400 if it is not an image
+    """
+    with metrics.timed("upload"):
+        return await _ingest(file, max_bytes)
+
+
+def _probe(header: bytes) -> Tuple[str, int, int]:
+    """
+    Reads the format and size from the start of an image. Image.open only
+    parses the header, so no pixel buffer is allocated here.
+    """
+    with Image.open(BytesIO(header)) as image:
+        return image.format, image.width, image.height
+
+
+async def _ingest(file: UploadFile, max_bytes: int) -> IngestedUpload:
+    digest = hashlib.sha256()
+    # The start of the upload, kept until its header has been read
+    header = bytearray()
+    probed: Optional[Tuple[str, int, int]] = None
+    size = 0
+
+    await file.seek(0)
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_bytes:
+            raise _body_too_large(max_bytes)
+        digest.update(chunk)
+
+        if probed is None and len(header) < PROBE_MAX_BYTES:
+            header += chunk[:PROBE_MAX_BYTES - len(header)]
+            try:
+                probed = _probe(bytes(header))
+            except Image.DecompressionBombError:
+                # Rejected below
+                break
+            except Exception:
+                # The header may continue in the next chunk
+                pass
+            if probed is not None:
+                header = bytearray()
+
+    if probed is None:
+        try:
+            probed = _probe(bytes(header))
+        except Image.DecompressionBombError:
+            # Far past MAX_INPUT_PIXELS as well
+            raise HTTPException(
+                status_code=413,
+                detail=f"Image dimensions too large. The maximum is {MAX_INPUT_PIXELS} pixels."
+            )
+        except UnidentifiedImageError:
+            raise HTTPException(status_code=400, detail="Invalid image: unrecognized image format")
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Invalid image: {str(e)}")
+
+    image_format, width, height = probed
+    if width * height > MAX_INPUT_PIXELS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Image dimensions too large. The maximum is {MAX_INPUT_PIXELS} pixels."
+        )
+
+    await file.seek(0)
+    return IngestedUpload(file, size, digest.hexdigest(), image_format, width, height)
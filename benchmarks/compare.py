@@ -0,0 +1,65 @@
+"""
+Compares two benchmark result files of the same kind:
+
+    python -m benchmarks.compare benchmarks/results/load-A.json benchmarks/results/load-B.json
+
+Prints every latency, throughput and memory figure present in both runs
+with the relative change from the first to the second.
+"""
+import sys
+import json
+import argparse
+from typing import Dict, Any
+
+try:
+    from . import report
+except ImportError:
+    from benchmarks import report
+
+# Figures worth comparing; counts and configuration are left out
+COMPARED_SUFFIXES = ("_ms", "_us", "rps", "_mb")
+
+
+def flatten(value: Any, prefix: str = "") -> Dict[str, float]:
+    figures = {}
+    if isinstance(value, dict):
+        for key, item in value.items():
+            figures.update(flatten(item, f"{prefix}.{key}" if prefix else str(key)))
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            figures.update(flatten(item, f"{prefix}[{index}]"))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        if prefix.endswith(COMPARED_SUFFIXES):
+            figures[prefix] = float(value)
+    return figures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--filter", default=None, help="Only show figures whose name contains this")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    if baseline.get("kind") != candidate.get("kind"):
+        sys.exit(f"Cannot compare a {baseline.get('kind')} run with a {candidate.get('kind')} run")
+
+    before = flatten(baseline["results"])
+    after = flatten(candidate["results"])
+    rows = []
+    for name in before:
+        if name not in after or (args.filter and args.filter not in name):
+            continue
+        change = "-" if not before[name] else f"{(after[name] - before[name]) / before[name] * 100:+.1f}%"
+        rows.append([name, before[name], after[name], change])
+
+    print(f"{baseline['run'].get('git_revision')} -> {candidate['run'].get('git_revision')}")
+    report.print_table(rows, ["", "baseline", "candidate", "change"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+Local stand-in for the Supabase and Stripe APIs the backend calls: the
+users table and the usage RPC, storage uploads, and the Stripe endpoints
+used for metered billing.
+
+Together with fake_replicate.py this lets the app run with no network
+access, so benchmarks measure the app rather than third-party services:
+
+    python -m benchmarks.fake_backends --port 8002 --latency 0.005
+    SUPABASE_URL=http://127.0.0.1:8002 STRIPE_API_BASE=http://127.0.0.1:8002 uvicorn backend.main:app
+
+Every option can also be set with the matching FAKE_BACKENDS_* variable.
+"""
+import os
+import re
+import uuid
+import time
+import asyncio
+import argparse
+import logging
+from typing import Dict, Any, List
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+# Configuration
+# Simulated round-trip time of every call in seconds
+FAKE_BACKENDS_LATENCY = float(os.getenv("FAKE_BACKENDS_LATENCY", "0.005"))
+# Plan given to users the fake has not seen before
+FAKE_BACKENDS_TIER = os.getenv("FAKE_BACKENDS_TIER", "free")
+
+IN_FILTER_PATTERN = re.compile(r"^in\.\((.*)\)$")
+
+app = FastAPI(title="Fake Supabase and Stripe")
+
+_users: Dict[str, Dict[str, Any]] = {}
+_stats = {"rest": 0, "rpc": 0, "storage_uploads": 0, "storage_bytes": 0, "stripe": 0}
+
+
+def _user(user_id: str) -> Dict[str, Any]:
+    user = _users.get(user_id)
+    if user is None:
+        user = _users[user_id] = {
+            "id": user_id,
+            "username": user_id,
+            "subscription_tier": FAKE_BACKENDS_TIER,
+            "images_processed_this_month": 0,
+        }
+    return user
+
+
+async def _delay() -> None:
+    if FAKE_BACKENDS_LATENCY > 0:
+        await asyncio.sleep(FAKE_BACKENDS_LATENCY)
+
+
+def _filtered_users(request: Request) -> List[Dict[str, Any]]:
+    id_filter = request.query_params.get("id", "")
+    if id_filter.startswith("eq."):
+        return [_user(id_filter[3:])]
+    match = IN_FILTER_PATTERN.match(id_filter)
+    if match:
+        return [_user(user_id.strip('"')) for user_id in match.group(1).split(",") if user_id]
+    return list(_users.values())
+
+
+# Supabase PostgREST
+
+@app.post("/rest/v1/rpc/increment_processed_images")
+async def increment_processed_images(request: Request):
+    await _delay()
+    _stats["rpc"] += 1
+    body = await request.json()
+    rows = []
+    for increment in body.get("increments", []):
+        user = _user(str(increment["user_id"]))
+        user["images_processed_this_month"] += int(increment["amount"])
+        rows.append({"id": user["id"], "images_processed_this_month": user["images_processed_this_month"]})
+    return rows
+
+
+@app.get("/rest/v1/users")
+async def select_users(request: Request):
+    await _delay()
+    _stats["rest"] += 1
+    return _filtered_users(request)
+
+
+@app.patch("/rest/v1/users")
+async def update_users(request: Request):
+    await _delay()
+    _stats["rest"] += 1
+    changes = await request.json()
+    users = _filtered_users(request)
+    for user in users:
+        user.update(changes)
+    return users
+
+
+@app.api_route("/rest/v1/{table}", methods=["GET", "POST", "PATCH", "DELETE"])
+async def other_table(table: str):
+    await _delay()
+    _stats["rest"] += 1
+    return []
+
+
+# Supabase Storage
+
+@app.post("/storage/v1/object/{bucket}/{path:path}")
+async def upload_object(bucket: str, path: str, request: Request):
+    await _delay()
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+    _stats["storage_uploads"] += 1
+    _stats["storage_bytes"] += size
+    return {"Key": f"{bucket}/{path}", "Id": uuid.uuid4().hex}
+
+
+@app.post("/storage/v1/object/list/{bucket}")
+async def list_objects(bucket: str):
+    await _delay()
+    return []
+
+
+@app.delete("/storage/v1/object/{bucket}")
+async def remove_objects(bucket: str, request: Request):
+    await _delay()
+    body = await request.json()
+    return [{"name": prefix} for prefix in body.get("prefixes", [])]
+
+
+# Stripe
+
+@app.get("/v1/subscriptions")
+async def list_subscriptions(request: Request):
+    await _delay()
+    _stats["stripe"] += 1
+    customer = request.query_params.get("customer", "cus_bench")
+    return {
+        "object": "list",
+        "has_more": False,
+        "url": "/v1/subscriptions",
+        "data": [{
+            "id": f"sub_{customer}",
+            "object": "subscription",
+            "customer": customer,
+            "status": "active",
+            "items": {
+                "object": "list",
+                "has_more": False,
+                "url": "/v1/subscription_items",
+                "data": [{
+                    "id": f"si_{customer}",
+                    "object": "subscription_item",
+                    "price": {"id": os.getenv("STRIPE_API_USAGE_PRICE_ID", "price_0987654321"), "object": "price"},
+                }],
+            },
+        }],
+    }
+
+
+@app.post("/v1/subscription_items/{item_id}/usage_records")
+async def create_usage_record(item_id: str, request: Request):
+    await _delay()
+    _stats["stripe"] += 1
+    form = await request.form()
+    return {
+        "id": f"mbur_{uuid.uuid4().hex[:24]}",
+        "object": "usage_record",
+        "subscription_item": item_id,
+        "quantity": int(form.get("quantity", 0)),
+        "timestamp": int(form.get("timestamp", time.time())),
+    }
+
+
+@app.api_route("/v1/{path:path}", methods=["GET", "POST", "DELETE"])
+async def other_stripe(path: str):
+    _stats["stripe"] += 1
+    return JSONResponse(
+        status_code=404,
+        content={"error": {"type": "invalid_request_error", "message": f"The fake does not implement /v1/{path}"}},
+    )
+
+
+@app.get("/_stats")
+async def get_stats():
+    return {**_stats, "users": len(_users)}
+
+
+def main() -> None:
+    global FAKE_BACKENDS_LATENCY, FAKE_BACKENDS_TIER
+
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the Supabase and Stripe APIs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8002)
+    parser.add_argument("--latency", type=float, default=FAKE_BACKENDS_LATENCY, help="Round-trip time in seconds")
+    parser.add_argument("--tier", default=FAKE_BACKENDS_TIER, choices=["free", "pro"],
+                        help="Plan given to new users")
+    args = parser.parse_args()
+
+    FAKE_BACKENDS_LATENCY = args.latency
+    FAKE_BACKENDS_TIER = args.tier
+
+    import uvicorn
+
+    logger.info(f"Fake Supabase and Stripe on {args.host}:{args.port} (latency={args.latency}s, tier={args.tier})")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
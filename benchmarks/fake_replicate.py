@@ -0,0 +1,267 @@
+"""
+Local stand-in for the parts of Replicate's HTTP API the backend uses:
+the files API, predictions (including "Prefer: wait"), cancellation and
+output downloads.
+
+Point the backend at it to load-test and profile the pipeline without
+spending money or depending on the network:
+
+    python -m benchmarks.fake_replicate --port 8001 --latency 2 --failure-rate 0.05
+    REPLICATE_API_BASE=http://127.0.0.1:8001/v1 uvicorn backend.main:app
+
+Every option can also be set with the matching FAKE_REPLICATE_* variable.
+"""
+import os
+import re
+import uuid
+import random
+import asyncio
+import argparse
+import logging
+from io import BytesIO
+from typing import Optional, Dict, Any
+from PIL import Image
+from fastapi import FastAPI, File, Header, HTTPException, Request, UploadFile
+from fastapi.responses import Response
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+# Configuration
+# Simulated model run time in seconds, plus uniform jitter on either side
+FAKE_REPLICATE_LATENCY = float(os.getenv("FAKE_REPLICATE_LATENCY", "1.0"))
+FAKE_REPLICATE_JITTER = float(os.getenv("FAKE_REPLICATE_JITTER", "0.0"))
+# Fraction of predictions that fail
+FAKE_REPLICATE_FAILURE_RATE = float(os.getenv("FAKE_REPLICATE_FAILURE_RATE", "0.0"))
+# "scaled" returns the input resized by the requested scale; "WxH" returns a fixed image of that size
+FAKE_REPLICATE_OUTPUT = os.getenv("FAKE_REPLICATE_OUTPUT", "scaled")
+# Base URL used in the URLs handed back to clients
+FAKE_REPLICATE_PUBLIC_URL = os.getenv("FAKE_REPLICATE_PUBLIC_URL", "")
+# Finished outputs kept for download; older ones are dropped first
+FAKE_REPLICATE_MAX_OUTPUTS = int(os.getenv("FAKE_REPLICATE_MAX_OUTPUTS", "1000"))
+
+OUTPUT_SIZE_PATTERN = re.compile(r"^(\d+)x(\d+)$")
+TERMINAL_STATUSES = ("succeeded", "failed", "canceled")
+
+app = FastAPI(title="Fake Replicate")
+
+_files: Dict[str, bytes] = {}
+_outputs: Dict[str, bytes] = {}
+_predictions: Dict[str, Dict[str, Any]] = {}
+_tasks: Dict[str, asyncio.Task] = {}
+_fixed_outputs: Dict[str, bytes] = {}
+
+
+def _base_url(request: Request) -> str:
+    return FAKE_REPLICATE_PUBLIC_URL.rstrip("/") or str(request.base_url).rstrip("/")
+
+
+def _encode(img: Image.Image, output_format: str) -> bytes:
+    output_format = output_format.upper()
+    if output_format == "JPG":
+        output_format = "JPEG"
+    if output_format == "JPEG" and img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    output = BytesIO()
+    # Favour speed: the stand-in should not be the bottleneck being measured
+    if output_format == "PNG":
+        img.save(output, format="PNG", compress_level=1)
+    elif output_format == "WEBP":
+        img.save(output, format="WEBP", quality=80, method=0)
+    else:
+        img.save(output, format=output_format, quality=85)
+    return output.getvalue()
+
+
+def _render_output(image_data: Optional[bytes], scale: float, output_format: str) -> bytes:
+    match = OUTPUT_SIZE_PATTERN.match(FAKE_REPLICATE_OUTPUT)
+    if match:
+        # Fixed outputs are encoded once per format and reused
+        if output_format not in _fixed_outputs:
+            size = (int(match.group(1)), int(match.group(2)))
+            _fixed_outputs[output_format] = _encode(Image.new("RGB", size, (128, 128, 128)), output_format)
+        return _fixed_outputs[output_format]
+
+    if image_data is None:
+        raise ValueError("Input image not found")
+    with Image.open(BytesIO(image_data)) as img:
+        img.load()
+        return _encode(img.resize((int(img.width * scale), int(img.height * scale)), Image.NEAREST), output_format)
+
+
+async def _run_prediction(prediction: Dict[str, Any]) -> None:
+    prediction["status"] = "processing"
+    delay = max(0.0, FAKE_REPLICATE_LATENCY + random.uniform(-FAKE_REPLICATE_JITTER, FAKE_REPLICATE_JITTER))
+    await asyncio.sleep(delay)
+
+    if random.random() < FAKE_REPLICATE_FAILURE_RATE:
+        prediction["status"] = "failed"
+        prediction["error"] = "Simulated failure"
+        return
+
+    params = prediction["input"]
+    file_id = str(params.get("image", "")).rstrip("/").rsplit("/", 1)[-1]
+    try:
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(
+            None,
+            _render_output,
+            _files.pop(file_id, None),
+            float(params.get("scale", 4)),
+            str(params.get("output_format", "png")),
+        )
+    except Exception as e:
+        prediction["status"] = "failed"
+        prediction["error"] = str(e)
+        return
+
+    _outputs[prediction["id"]] = data
+    # Keep memory flat during long load tests
+    while len(_outputs) > FAKE_REPLICATE_MAX_OUTPUTS:
+        evicted = next(iter(_outputs))
+        del _outputs[evicted]
+        _predictions.pop(evicted, None)
+    prediction["output"] = prediction["urls"]["output"]
+    prediction["status"] = "succeeded"
+
+
+def _public(prediction: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": prediction["id"],
+        "version": prediction["version"],
+        "status": prediction["status"],
+        "input": prediction["input"],
+        "output": prediction["output"],
+        "error": prediction["error"],
+        "urls": {"get": prediction["urls"]["get"], "cancel": prediction["urls"]["cancel"]},
+    }
+
+
+@app.post("/v1/files", status_code=201)
+async def create_file(request: Request, content: UploadFile = File(...)):
+    file_id = uuid.uuid4().hex
+    _files[file_id] = await content.read()
+    return {
+        "id": file_id,
+        "name": content.filename,
+        "content_type": content.content_type,
+        "size": len(_files[file_id]),
+        "urls": {"get": f"{_base_url(request)}/v1/files/{file_id}"},
+    }
+
+
+@app.get("/v1/files/{file_id}")
+async def get_file(file_id: str):
+    if file_id not in _files:
+        raise HTTPException(status_code=404, detail="Not found")
+    return Response(content=_files[file_id], media_type="application/octet-stream")
+
+
+@app.post("/v1/predictions", status_code=201)
+async def create_prediction(request: Request, prefer: Optional[str] = Header(None)):
+    body = await request.json()
+    prediction_id = uuid.uuid4().hex
+    base_url = _base_url(request)
+    prediction = {
+        "id": prediction_id,
+        "version": body.get("version"),
+        "input": body.get("input") or {},
+        "status": "starting",
+        "output": None,
+        "error": None,
+        "urls": {
+            "get": f"{base_url}/v1/predictions/{prediction_id}",
+            "cancel": f"{base_url}/v1/predictions/{prediction_id}/cancel",
+            "output": f"{base_url}/outputs/{prediction_id}",
+        },
+    }
+    _predictions[prediction_id] = prediction
+    task = asyncio.create_task(_run_prediction(prediction))
+    _tasks[prediction_id] = task
+    task.add_done_callback(lambda _: _tasks.pop(prediction_id, None))
+
+    # "Prefer: wait" or "Prefer: wait=N" holds the request until the prediction finishes
+    if prefer and prefer.strip().startswith("wait"):
+        _, _, seconds = prefer.partition("=")
+        try:
+            timeout = float(seconds) if seconds else 60.0
+        except ValueError:
+            timeout = 60.0
+        try:
+            await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    return _public(prediction)
+
+
+@app.get("/v1/predictions/{prediction_id}")
+async def get_prediction(prediction_id: str):
+    if prediction_id not in _predictions:
+        raise HTTPException(status_code=404, detail="Not found")
+    return _public(_predictions[prediction_id])
+
+
+@app.post("/v1/predictions/{prediction_id}/cancel")
+async def cancel_prediction(prediction_id: str):
+    prediction = _predictions.get(prediction_id)
+    if prediction is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    if prediction["status"] not in TERMINAL_STATUSES:
+        task = _tasks.get(prediction_id)
+        if task is not None:
+            task.cancel()
+        prediction["status"] = "canceled"
+    return _public(prediction)
+
+
+@app.get("/outputs/{prediction_id}")
+async def get_output(prediction_id: str):
+    data = _outputs.get(prediction_id)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    output_format = str(_predictions[prediction_id]["input"].get("output_format", "png")).lower()
+    return Response(content=data, media_type="image/jpeg" if output_format == "jpg" else f"image/{output_format}")
+
+
+def main() -> None:
+    global FAKE_REPLICATE_LATENCY, FAKE_REPLICATE_JITTER, FAKE_REPLICATE_FAILURE_RATE
+    global FAKE_REPLICATE_OUTPUT, FAKE_REPLICATE_PUBLIC_URL
+
+    parser = argparse.ArgumentParser(description="Run a local stand-in for Replicate's HTTP API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=FAKE_REPLICATE_LATENCY, help="Model run time in seconds")
+    parser.add_argument("--jitter", type=float, default=FAKE_REPLICATE_JITTER, help="Uniform jitter in seconds")
+    parser.add_argument("--failure-rate", type=float, default=FAKE_REPLICATE_FAILURE_RATE,
+                        help="Fraction of predictions that fail")
+    parser.add_argument("--output", default=FAKE_REPLICATE_OUTPUT,
+                        help='"scaled" to resize the input, or a fixed size such as 4096x4096')
+    parser.add_argument("--public-url", default=FAKE_REPLICATE_PUBLIC_URL,
+                        help="Base URL used in returned URLs (defaults to the request's)")
+    args = parser.parse_args()
+
+    if args.output != "scaled" and not OUTPUT_SIZE_PATTERN.match(args.output):
+        parser.error('--output must be "scaled" or WIDTHxHEIGHT')
+
+    FAKE_REPLICATE_LATENCY = args.latency
+    FAKE_REPLICATE_JITTER = args.jitter
+    FAKE_REPLICATE_FAILURE_RATE = args.failure_rate
+    FAKE_REPLICATE_OUTPUT = args.output
+    FAKE_REPLICATE_PUBLIC_URL = args.public_url
+
+    import uvicorn
+
+    logger.info(
+        f"Fake Replicate on {args.host}:{args.port} (latency={args.latency}s, jitter={args.jitter}s, "
+        f"failure_rate={args.failure_rate}, output={args.output})"
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
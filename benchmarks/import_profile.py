@@ -0,0 +1,92 @@
+"""
+Import-time profile of the app. Imports a module in a fresh interpreter
+with -X importtime and reports the slowest imports, by cumulative and by
+self time, plus the total wall time to import:
+
+    python -m benchmarks.import_profile
+    python -m benchmarks.import_profile --module wsgi --top 30
+
+Run it before and after changing what is imported at startup, and compare
+the saved results with benchmarks.compare.
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+from typing import Dict, Any, List
+
+try:
+    from . import report
+except ImportError:
+    from benchmarks import report
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def profile(module: str) -> Dict[str, Any]:
+    """
+    Imports `module` in a subprocess and parses its import timings.
+
+    Returns:
+        Dict[str, Any]: The wall time and the per-module timings in microseconds
+    """
+    env = {**os.environ, "PYTHONPATH": REPO_ROOT}
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=REPO_ROOT, env=env, capture_output=True, text=True,
+    )
+    wall = time.perf_counter() - started
+    if completed.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{completed.stderr[-2000:]}")
+
+    modules: List[Dict[str, Any]] = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        modules.append({
+            "module": name.strip(),
+            "depth": (len(name) - len(name.lstrip()) - 1) // 2,
+            "self_us": int(self_us),
+            "cumulative_us": int(cumulative_us),
+        })
+    return {"wall_seconds": round(wall, 3), "modules": modules}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Profile the import time of the app")
+    parser.add_argument("--module", default="backend.main", help="The module to import")
+    parser.add_argument("--top", type=int, default=20, help="Modules to show per table")
+    parser.add_argument("--output", default=None, help="Result file (defaults to benchmarks/results/imports-*.json)")
+    args = parser.parse_args()
+
+    profiled = profile(args.module)
+    modules = profiled["modules"]
+    top_level = {entry["module"].split(".")[0] for entry in modules if entry["depth"] == 0}
+    results = {
+        "wall_ms": round(profiled["wall_seconds"] * 1000, 1),
+        "import_ms": round(sum(entry["self_us"] for entry in modules) / 1000, 1),
+        "modules_imported": len(modules),
+        "loaded_packages": sorted(top_level),
+        "slowest_cumulative": sorted(modules, key=lambda entry: -entry["cumulative_us"])[:args.top],
+        "slowest_self": sorted(modules, key=lambda entry: -entry["self_us"])[:args.top],
+    }
+    config = {key: value for key, value in vars(args).items() if key != "output"}
+    path = report.save("imports", config, results, args.output)
+
+    print(f"import {args.module}: {results['import_ms']} ms importing {len(modules)} modules, "
+          f"{results['wall_ms']} ms wall including interpreter start")
+    for title, section, key in (
+        ("Cumulative", "slowest_cumulative", "cumulative_us"),
+        ("Self", "slowest_self", "self_us"),
+    ):
+        print()
+        rows = [[entry["module"], round(entry[key] / 1000, 1)] for entry in results[section]]
+        report.print_table(rows, [f"{title} (top {args.top})", "ms"])
+    print(f"\nResults written to {path}")
+
+
+if __name__ == "__main__":
+    main()
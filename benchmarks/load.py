@@ -0,0 +1,391 @@
+"""
+Load test for backend.main:app.
+
+Starts the app under gunicorn with fake Replicate, Supabase and Stripe
+backends (fake_replicate.py and fake_backends.py), drives /upscale, /usage
+and /upscale/options at a fixed concurrency with a mix of image sizes, and
+reports latency percentiles, requests per second and the peak RSS of each
+worker. Results are saved as JSON for benchmarks.compare:
+
+    python -m benchmarks.load --workers 2 --concurrency 16 --duration 30 \\
+        --endpoints upscale=6,usage=3,options=1 --sizes 256x256=7,1024x1024=3
+
+Pass --url to drive an app that is already running instead; RSS is then
+not measured. The load generator runs on the same machine as the app, so
+leave it some CPU when comparing runs.
+"""
+import os
+import sys
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from io import BytesIO
+from typing import Dict, Any, List, Optional, Tuple
+
+import httpx
+from PIL import Image
+from jose import jwt
+
+try:
+    from . import report
+except ImportError:
+    from benchmarks import report
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENDPOINTS = ("upscale", "usage", "options")
+
+# Any string in JWT form passes the Supabase client's key check
+FAKE_SUPABASE_KEY = "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoic2VydmljZV9yb2xlIn0.bench"
+
+
+def parse_weights(text: str, allowed: Tuple[str, ...]) -> Dict[str, float]:
+    weights = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in allowed:
+            raise argparse.ArgumentTypeError(f"Unknown endpoint {name}; expected one of {', '.join(allowed)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def parse_sizes(text: str) -> Dict[str, float]:
+    sizes = {}
+    for part in text.split(","):
+        size, _, weight = part.partition("=")
+        width, _, height = size.strip().partition("x")
+        if not (width.isdigit() and height.isdigit()):
+            raise argparse.ArgumentTypeError(f"Invalid image size {size}; expected WIDTHxHEIGHT")
+        sizes[f"{int(width)}x{int(height)}"] = float(weight or 1)
+    return sizes
+
+
+def make_images(sizes: Dict[str, float], variants: int, seed: int) -> Dict[str, List[bytes]]:
+    """
+    Encodes `variants` noise PNGs per size. Noise does not compress, so the
+    uploads are as large as real photos of the same size.
+    """
+    rng = random.Random(seed)
+    images = {}
+    for label in sizes:
+        width, height = (int(n) for n in label.split("x"))
+        images[label] = []
+        for _ in range(variants):
+            img = Image.frombytes("RGB", (width, height), rng.randbytes(width * height * 3))
+            output = BytesIO()
+            img.save(output, format="PNG", compress_level=1)
+            images[label].append(output.getvalue())
+    return images
+
+
+def make_tokens(users: int) -> List[str]:
+    """
+    Mints Supabase-style access tokens for synthetic users.
+    """
+    expires = int(time.time()) + 86400
+    return [
+        jwt.encode(
+            {"sub": f"00000000-0000-4000-8000-{index:012d}", "aud": "authenticated",
+             "email": f"bench{index}@example.com", "exp": expires},
+            "benchmark",
+            algorithm="HS256",
+        )
+        for index in range(users)
+    ]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Stack:
+    """
+    The app and its fake backends, each in its own process.
+    """
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.directory = tempfile.mkdtemp(prefix="upscaloro-bench-")
+        self.processes: List[subprocess.Popen] = []
+        self.app: Optional[subprocess.Popen] = None
+        self.port = args.port or free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+
+    def _spawn(self, name: str, command: List[str], env: Dict[str, str]) -> subprocess.Popen:
+        log = open(os.path.join(self.directory, f"{name}.log"), "w")
+        process = subprocess.Popen(command, cwd=REPO_ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+        self.processes.append(process)
+        return process
+
+    def start(self) -> None:
+        args = self.args
+        env = {**os.environ, "PYTHONPATH": REPO_ROOT}
+        replicate_port = free_port()
+        backends_port = free_port()
+
+        self._spawn("fake_replicate", [
+            sys.executable, "-m", "benchmarks.fake_replicate", "--port", str(replicate_port),
+            "--latency", str(args.model_latency), "--jitter", str(args.model_jitter),
+            "--failure-rate", str(args.failure_rate),
+        ], env)
+        self._spawn("fake_backends", [
+            sys.executable, "-m", "benchmarks.fake_backends", "--port", str(backends_port),
+            "--latency", str(args.backend_latency),
+        ], env)
+
+        app_env = {
+            **env,
+            "REPLICATE_API_BASE": f"http://127.0.0.1:{replicate_port}/v1",
+            "REPLICATE_API_TOKEN": "r8_benchmark",
+            "REPLICATE_POLL_INTERVAL": "0.1",
+            "SUPABASE_URL": f"http://127.0.0.1:{backends_port}",
+            "SUPABASE_KEY": FAKE_SUPABASE_KEY,
+            "STRIPE_API_BASE": f"http://127.0.0.1:{backends_port}",
+            "STRIPE_API_KEY": "sk_test_benchmark",
+            # Measure throughput, not the plan limits
+            "FREE_TIER_MONTHLY_LIMIT": "1000000000",
+            "RATE_LIMIT_FREE_PER_MINUTE": "1000000000",
+            "RATE_LIMIT_PRO_PER_MINUTE": "1000000000",
+            "JOB_DIR": os.path.join(self.directory, "jobs"),
+            "RESULT_SPOOL_DIR": os.path.join(self.directory, "results"),
+            "RESULT_CACHE_DIR": os.path.join(self.directory, "cache"),
+            "STORAGE_QUEUE_DIR": os.path.join(self.directory, "storage-queue"),
+            "USAGE_LOG_DIR": os.path.join(self.directory, "usage"),
+        }
+        if not args.cache:
+            app_env["RESULT_CACHE_MEMORY_BYTES"] = "0"
+            app_env["RESULT_CACHE_DISK_BYTES"] = "0"
+
+        self.app = self._spawn("app", [
+            sys.executable, "-m", "gunicorn", "backend.main:app",
+            "--workers", str(args.workers), "--worker-class", "uvicorn.workers.UvicornWorker",
+            "--bind", f"127.0.0.1:{self.port}", "--timeout", "300",
+        ], app_env)
+
+    def worker_pids(self) -> List[int]:
+        """
+        Returns the PIDs of the app's worker processes.
+        """
+        pids = []
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            try:
+                with open(f"/proc/{name}/stat") as f:
+                    # The command name may contain spaces, so split after it
+                    fields = f.read().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            if int(fields[1]) == self.app.pid:
+                pids.append(int(name))
+        return sorted(pids)
+
+    def stop(self) -> None:
+        # The app goes first so it can flush usage to the fakes on shutdown
+        for process in reversed(self.processes):
+            process.terminate()
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def peak_rss_mb(pid: int) -> Optional[float]:
+    """
+    Returns a process's peak resident set size in MB (Linux only).
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+async def wait_ready(url: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                if (await client.get(f"{url}/ready")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"The app did not become ready at {url} within {timeout}s")
+            await asyncio.sleep(0.2)
+
+
+async def drive(
+    args: argparse.Namespace,
+    url: str,
+    images: Dict[str, List[bytes]],
+    tokens: List[str]
+) -> Tuple[List[Tuple[str, Optional[str], int, float]], float]:
+    """
+    Sends requests from `args.concurrency` clients for the warmup and the
+    measured duration.
+
+    Returns:
+        The measured samples as (endpoint, image size, status, seconds), and the measured window length
+    """
+    rng = random.Random(args.seed)
+    endpoints = list(args.endpoints)
+    endpoint_weights = [args.endpoints[name] for name in endpoints]
+    sizes = list(args.sizes)
+    size_weights = [args.sizes[label] for label in sizes]
+    samples: List[Tuple[str, Optional[str], int, float]] = []
+
+    started = time.monotonic()
+    measure_from = started + args.warmup
+    deadline = measure_from + args.duration
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=args.timeout) as client:
+
+        async def run_client() -> None:
+            while time.monotonic() < deadline:
+                endpoint = rng.choices(endpoints, endpoint_weights)[0]
+                headers = {"Authorization": f"Bearer {rng.choice(tokens)}"}
+                size = None
+                request_started = time.monotonic()
+                try:
+                    if endpoint == "upscale":
+                        size = rng.choices(sizes, size_weights)[0]
+                        response = await client.post(
+                            "/upscale",
+                            headers=headers,
+                            files={"file": ("bench.png", rng.choice(images[size]), "image/png")},
+                            data={"scale_factor": str(args.scale), "output_format": args.output_format},
+                        )
+                    elif endpoint == "usage":
+                        response = await client.get("/usage", headers=headers)
+                    else:
+                        response = await client.get("/upscale/options", headers=headers)
+                    status = response.status_code
+                except httpx.HTTPError:
+                    status = 0
+                finished = time.monotonic()
+                if request_started >= measure_from and finished <= deadline:
+                    samples.append((endpoint, size, status, finished - request_started))
+
+        await asyncio.gather(*(run_client() for _ in range(args.concurrency)))
+
+    return samples, args.duration
+
+
+def summarize(samples: List[Tuple[str, Optional[str], int, float]], window: float) -> Dict[str, Any]:
+    def section(selected):
+        ok = [seconds for _, _, status, seconds in selected if 200 <= status < 300]
+        statuses: Dict[str, int] = {}
+        for _, _, status, _ in selected:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        return {
+            "requests": len(selected),
+            "errors": len(selected) - len(ok),
+            "rps": round(len(ok) / window, 2),
+            "status_codes": statuses,
+            "latency": report.percentiles(ok),
+        }
+
+    results = {"window_seconds": window, "total": section(samples), "endpoints": {}, "upscale_by_size": {}}
+    for endpoint in ENDPOINTS:
+        selected = [sample for sample in samples if sample[0] == endpoint]
+        if selected:
+            results["endpoints"][endpoint] = section(selected)
+    for size in sorted({sample[1] for sample in samples if sample[1]}):
+        results["upscale_by_size"][size] = section([sample for sample in samples if sample[1] == size])
+    return results
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    images = make_images(args.sizes, args.variants, args.seed)
+    tokens = make_tokens(args.users)
+
+    stack = None
+    url = args.url
+    if url is None:
+        stack = Stack(args)
+        stack.start()
+        url = stack.url
+    try:
+        await wait_ready(url, args.startup_timeout)
+        samples, window = await drive(args, url, images, tokens)
+        results = summarize(samples, window)
+
+        async with httpx.AsyncClient(timeout=10) as client:
+            try:
+                # One worker's view of where the time went
+                results["app_stats_sample"] = (await client.get(f"{url}/stats")).json().get("latency")
+            except (httpx.HTTPError, ValueError):
+                results["app_stats_sample"] = None
+
+        if stack is not None:
+            results["workers"] = [{"pid": pid, "peak_rss_mb": peak_rss_mb(pid)} for pid in stack.worker_pids()]
+            results["master_peak_rss_mb"] = peak_rss_mb(stack.app.pid)
+            results["logs"] = stack.directory
+        return results
+    finally:
+        if stack is not None:
+            stack.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load-test the upscale API against fake backends")
+    parser.add_argument("--url", default=None, help="Drive an already running app instead of starting one")
+    parser.add_argument("--port", type=int, default=0, help="Port for the app (defaults to a free port)")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent clients")
+    parser.add_argument("--duration", type=float, default=30.0, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=5.0, help="Unmeasured seconds before measuring")
+    parser.add_argument("--endpoints", type=lambda text: parse_weights(text, ENDPOINTS),
+                        default="upscale=6,usage=3,options=1", help="Weighted endpoint mix")
+    parser.add_argument("--sizes", type=parse_sizes, default="256x256=7,1024x1024=3",
+                        help="Weighted input image sizes for /upscale")
+    parser.add_argument("--variants", type=int, default=8, help="Distinct images per size")
+    parser.add_argument("--scale", type=int, default=2, help="Scale factor sent to /upscale")
+    parser.add_argument("--output-format", default="png")
+    parser.add_argument("--users", type=int, default=50, help="Distinct users sending requests")
+    parser.add_argument("--model-latency", type=float, default=0.5, help="Fake Replicate run time in seconds")
+    parser.add_argument("--model-jitter", type=float, default=0.1, help="Fake Replicate jitter in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of fake predictions that fail")
+    parser.add_argument("--backend-latency", type=float, default=0.005,
+                        help="Fake Supabase and Stripe round-trip time in seconds")
+    parser.add_argument("--cache", action=argparse.BooleanOptionalAction, default=False,
+                        help="Keep the result cache enabled (repeated images become cache hits)")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Per-request timeout in seconds")
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None, help="Result file (defaults to benchmarks/results/load-*.json)")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    config = {key: value for key, value in vars(args).items() if key != "output"}
+    path = report.save("load", config, results, args.output)
+
+    rows = []
+    for name, section in [("total", results["total"])] + list(results["endpoints"].items()) + [
+        (f"upscale {size}", section) for size, section in results["upscale_by_size"].items()
+    ]:
+        latency = section["latency"]
+        rows.append([
+            name, section["requests"], section["errors"], section["rps"],
+            latency.get("p50_ms", "-"), latency.get("p95_ms", "-"), latency.get("p99_ms", "-"),
+        ])
+    report.print_table(rows, ["", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"])
+    for worker in results.get("workers", []):
+        print(f"worker {worker['pid']}: peak RSS {worker['peak_rss_mb']} MB")
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+Microbenchmarks for the hot functions of the request path: image
+validation, the local PIL upscale path, output encoding, authentication
+and admission.
+They run in-process with no network access:
+
+    python -m benchmarks.micro
+    python -m benchmarks.micro --filter auth --repeat 10
+
+Each benchmark is calibrated to run for at least --min-time seconds per
+repeat, and the per-call time of every repeat is recorded.
+"""
+import os
+import time
+import random
+import asyncio
+import argparse
+import statistics
+from io import BytesIO
+from typing import Callable, Awaitable, Dict, Any, List, Tuple
+
+# The backend reads its configuration at import time; keep it offline
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:8002")
+os.environ.setdefault("SUPABASE_KEY", "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoic2VydmljZV9yb2xlIn0.bench")
+os.environ.setdefault("UPSCALE_PROVIDER", "local")
+# Admission is measured on the fast path, not on rejections
+os.environ.setdefault("RATE_LIMIT_PRO_PER_MINUTE", "1000000000")
+
+from PIL import Image
+from jose import jwt
+
+try:
+    from . import report
+except ImportError:
+    from benchmarks import report
+
+from backend import metrics, encoder
+from backend.auth import User, get_current_user, token_cache, create_access_token, verify_password
+from backend.image_processor import ImageProcessor
+from backend.providers import LocalProvider
+from backend.quota import QuotaService
+
+
+def _image(width: int, height: int, format: str = "PNG") -> bytes:
+    rng = random.Random(width * height)
+    img = Image.frombytes("RGB", (width, height), rng.randbytes(width * height * 3))
+    output = BytesIO()
+    img.save(output, format=format)
+    return output.getvalue()
+
+
+def _supabase_token(user_id: str) -> str:
+    return jwt.encode(
+        {"sub": user_id, "aud": "authenticated", "exp": int(time.time()) + 86400},
+        "benchmark",
+        algorithm="HS256",
+    )
+
+
+def build() -> Dict[str, Callable[[], Awaitable[Any]]]:
+    """
+    Returns the benchmarks by name. Each is a coroutine function making one call.
+    """
+    small_png = _image(256, 256)
+    large_png = _image(2048, 2048)
+    small_jpeg = _image(256, 256, "JPEG")
+    # Encoders are measured on resampled output, which compresses like real results
+    with Image.open(BytesIO(_image(512, 512))) as img:
+        upscaled = img.resize((2048, 2048), Image.LANCZOS)
+    provider = LocalProvider()
+    supabase_token = _supabase_token("00000000-0000-4000-8000-000000000001")
+    app_token = create_access_token({"sub": "johndoe"})
+    password_hash = "$2b$12$BHu43/wPQo7HRc9/x0yIbudaT941SzXTbdcY.Z71vM3OGcrzuui3K"
+    quota = QuotaService()
+    user = User(username="bench", subscription_tier="pro")
+
+    async def validate_small():
+        await ImageProcessor.validate_image(small_png)
+
+    async def validate_large():
+        await ImageProcessor.validate_image(large_png)
+
+    async def local_upscale_png_x2():
+        result = await provider.upscale(small_png, 2, "fast", "png")
+        result.close()
+
+    async def local_upscale_jpeg_x4():
+        result = await provider.upscale(small_jpeg, 4, "fast", "jpeg")
+        result.close()
+
+    def encode(output_format: str) -> Callable[[], Awaitable[None]]:
+        async def run():
+            encoder.encode(upscaled, output_format, BytesIO())
+        return run
+
+    async def auth_cached():
+        await get_current_user(supabase_token)
+
+    async def auth_uncached_supabase():
+        token_cache.clear()
+        await get_current_user(supabase_token)
+
+    async def auth_uncached_app():
+        token_cache.clear()
+        await get_current_user(app_token)
+
+    async def password_verify():
+        verify_password("secret", password_hash)
+
+    async def quota_admit():
+        (await quota.admit(user)).release()
+
+    async def metrics_timed():
+        with metrics.timed("benchmark"):
+            pass
+
+    return {
+        "validate_image_256": validate_small,
+        "validate_image_2048": validate_large,
+        "local_upscale_256_png_x2": local_upscale_png_x2,
+        "local_upscale_256_jpeg_x4": local_upscale_jpeg_x4,
+        "encode_2048_png": encode("png"),
+        "encode_2048_jpeg": encode("jpeg"),
+        "encode_2048_webp": encode("webp"),
+        "auth_cached": auth_cached,
+        "auth_uncached_supabase": auth_uncached_supabase,
+        "auth_uncached_app": auth_uncached_app,
+        "verify_password": password_verify,
+        "quota_admit": quota_admit,
+        "metrics_timed": metrics_timed,
+    }
+
+
+async def measure(call: Callable[[], Awaitable[Any]], min_time: float, repeat: int) -> Tuple[int, List[float]]:
+    """
+    Times `call` like timeit: finds a loop count that runs for at least
+    `min_time`, then times `repeat` loops of that many calls.
+
+    Returns:
+        The calls per loop and the seconds per call of each loop
+    """
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            await call()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        loops = max(loops * 2, int(loops * min_time / max(elapsed, 1e-9) * 1.2))
+
+    per_call = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(loops):
+            await call()
+        per_call.append((time.perf_counter() - started) / loops)
+    return loops, per_call
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    results = {}
+    for name, call in build().items():
+        if args.filter and args.filter not in name:
+            continue
+        loops, per_call = await measure(call, args.min_time, args.repeat)
+        results[name] = {
+            "loops": loops,
+            "repeat": len(per_call),
+            "best_us": round(min(per_call) * 1e6, 3),
+            "median_us": round(statistics.median(per_call) * 1e6, 3),
+            "mean_us": round(statistics.fmean(per_call) * 1e6, 3),
+        }
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run microbenchmarks of the request path")
+    parser.add_argument("--filter", default=None, help="Only run benchmarks whose name contains this")
+    parser.add_argument("--min-time", type=float, default=0.2, help="Minimum seconds per timed loop")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed loops per benchmark")
+    parser.add_argument("--output", default=None, help="Result file (defaults to benchmarks/results/micro-*.json)")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    config = {key: value for key, value in vars(args).items() if key != "output"}
+    path = report.save("micro", config, results, args.output)
+
+    rows = [
+        [name, result["loops"], result["best_us"], result["median_us"], result["mean_us"]]
+        for name, result in results.items()
+    ]
+    report.print_table(rows, ["", "loops", "best µs", "median µs", "mean µs"])
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
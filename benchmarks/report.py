@@ -0,0 +1,111 @@
+"""
+Shared helpers for benchmark results. Every run is saved as one JSON file
+with the run's configuration and environment, so runs can be compared
+with benchmarks.compare.
+"""
+import os
+import sys
+import json
+import math
+import time
+import platform
+import subprocess
+from typing import Dict, Any, List, Optional
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+RESULT_FORMAT_VERSION = 1
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """
+    Summarizes durations in seconds as milliseconds, using nearest-rank percentiles.
+
+    Args:
+        samples: The durations
+
+    Returns:
+        Dict[str, float]: count, mean, min, p50, p95, p99 and max
+    """
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def rank(q: float) -> float:
+        index = min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))
+        return round(ordered[index] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "min_ms": round(ordered[0] * 1000, 3),
+        "p50_ms": rank(0.50),
+        "p95_ms": rank(0.95),
+        "p99_ms": rank(0.99),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, timeout=5,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+        return revision or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_info() -> Dict[str, Any]:
+    """
+    Describes the code and machine a run happened on.
+    """
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "git_revision": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def save(kind: str, config: Dict[str, Any], results: Dict[str, Any], output: Optional[str] = None) -> str:
+    """
+    Writes a run's results as JSON.
+
+    Args:
+        kind: The benchmark kind (load or micro)
+        config: The options the run used
+        results: The measurements
+        output: The file to write (defaults to a timestamped file in benchmarks/results)
+
+    Returns:
+        str: The path written
+    """
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{kind}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    document = {
+        "format_version": RESULT_FORMAT_VERSION,
+        "kind": kind,
+        "run": run_info(),
+        "config": config,
+        "results": results,
+    }
+    with open(output, "w") as f:
+        json.dump(document, f, indent=2, sort_keys=True)
+        f.write("\n")
+    return output
+
+
+def print_table(rows: List[List[Any]], header: List[str], file=sys.stdout) -> None:
+    """
+    Prints rows as an aligned text table.
+    """
+    cells = [header] + [[str(cell) for cell in row] for row in rows]
+    widths = [max(len(row[i]) for row in cells) for i in range(len(header))]
+    for index, row in enumerate(cells):
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip(), file=file)
+        if index == 0:
+            print("  ".join("-" * width for width in widths), file=file)
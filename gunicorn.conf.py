@@ -0,0 +1,26 @@
+"""
+Gunicorn settings for the API, used by the Procfile and render.yaml:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+With preload_app the application is imported once in the master process
+and the workers are forked from it, so every worker shares the imported
+libraries instead of importing its own copy. External clients (Supabase,
+Stripe, HTTP) are created in each worker after the fork; a worker's
+/ready endpoint returns 200 once they exist.
+"""
+import os
+import gc
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "4"))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+
+def when_ready(server):
+    # Runs in the master after the app is loaded and before the workers are
+    # forked. Frozen objects are skipped by the garbage collector, so
+    # collections in the workers do not write to (and copy) shared pages.
+    if preload_app:
+        gc.freeze()